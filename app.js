@@ -180,9 +180,16 @@ document.addEventListener('DOMContentLoaded', () => {
     let currentPageIndex = 0; // Index of the currently active whiteboard page
     let currentColor = '#FFFFFF'; // Default drawing color (white)
     let currentBrushSize = 5; // Default brush size in pixels
-    const MAX_HISTORY_STEPS = 10; // Maximum number of undo/redo states to store per page
-    let undoStack = []; // Stores deep copies of whiteboardPages[currentPageIndex] for undo functionality
-    let redoStack = []; // Stores deep copies of whiteboardPages[currentPageIndex] for redo functionality
+    const MAX_HISTORY_STEPS = 10; // Maximum number of undo/redo steps to keep per page
+    let undoStack = []; // { pageIndex, actionId } of this user's drawing commands that can be undone, newest last
+    let redoStack = []; // { pageIndex, actionId } of undone drawing commands that can be redone, newest last
+    let whiteboardCursor = null; // Highest whiteboard action sequence number reflected in whiteboardPages (for delta sync)
+    let whiteboardCursorClassroomId = null; // Classroom the cursor belongs to
+    let liveWhiteboardSeqs = new Set(); // Sequence numbers applied from live events since the cursor was taken
+    let whiteboardHistoryLoading = false; // True while a full history load is in flight (a rendered preview may be shown)
+    let chatHistoryBefore = null; // Cursor (id or timestamp) of the oldest chat message shown, for loading older pages
+    let chatHistoryHasMore = false; // Whether older chat messages exist on the server
+    let chatHistoryLoading = false; // True while a chat history page is being fetched
     
     // Text Tool specific variables
     let activeTextInput = null; // Reference to the currently active textarea for text input
@@ -331,8 +338,8 @@ document.addEventListener('DOMContentLoaded', () => {
         });
         if (colorPicker) colorPicker.disabled = !isAdmin;
         if (brushSizeSlider) brushSizeSlider.disabled = !isAdmin;
-        if (undoButton) undoButton.disabled = !isAdmin || undoStack.length <= 1;
-        if (redoButton) redoButton.disabled = !isAdmin || redoStack.length === 0;
+        if (undoButton) undoButton.disabled = !isAdmin || lastUndoEntryIndex(undoStack) === -1;
+        if (redoButton) redoButton.disabled = !isAdmin || lastUndoEntryIndex(redoStack) === -1;
         if (clearButton) clearButton.disabled = !isAdmin;
         if (saveButton) saveButton.disabled = !isAdmin; // Allow save for non-admin if desired, but here restricted
 
@@ -675,6 +682,7 @@ function enterClassroom(id, name) {
 
     loadAssessments(); // Load available assessments
     loadLibraryFiles(); // Load library files.
+    loadChatHistory(); // Load the newest page of chat messages
 }
 
     /**
@@ -712,6 +720,9 @@ function enterClassroom(id, name) {
         currentPageIndex = 0;
         undoStack = []; // Clear undo stack
         redoStack = []; // Clear redo stack
+        whiteboardCursor = null; // Forget the delta sync cursor
+        whiteboardCursorClassroomId = null;
+        liveWhiteboardSeqs.clear();
         updateUndoRedoButtons(); // Update button states
         updateWhiteboardPageDisplay(); // Reset page display
 
@@ -791,7 +802,8 @@ function initializeSocketIO() {
                 'classroomId': currentClassroom.id,
                 'role': currentUser.role,
                 'username': currentUser.username, // Include username for server logs/peer display
-                'userId': currentUser.id // Include userId for server identification
+                'userId': currentUser.id, // Include userId for server identification
+                'batchedWhiteboard': true // Receive whiteboard events as per-tick 'whiteboard_batch' frames
             });
             showNotification(`Connected to classroom: ${currentClassroom.name}`);
 
@@ -879,7 +891,7 @@ socket.on('chat_history', (history) => {
     console.log('Received chat history:', history);
     if (chatMessages) chatMessages.innerHTML = ''; // Clear previous messages
     history.forEach(msg => {
-        renderMessage(msg, true); // Pass true to indicate it's history
+        renderMessage(msg);
     });
     if (chatMessages) chatMessages.scrollTop = chatMessages.scrollHeight; // Auto-scroll to latest message
 });
@@ -955,6 +967,17 @@ socket.on('whiteboard_snapshot', (data) => {
         }
     });
 
+    // Batched whiteboard events: the server coalesces a room's whiteboard events over a short tick
+    // and sends them in order as one frame. Each entry is dispatched to the handler of its original event.
+    socket.on('whiteboard_batch', (frame) => {
+        if (!frame || !Array.isArray(frame.events)) return;
+        frame.events.forEach((entry) => {
+            // Events the server would not have echoed back to their sender are skipped here.
+            if (entry.skipSid && entry.skipSid === socket.id) return;
+            socket.listeners(entry.event).forEach((listener) => listener(entry.data));
+        });
+    });
+
     // Whiteboard data synchronization event
     socket.on('whiteboard_data', (data) => {
         if (!whiteboardCtx) {
@@ -970,6 +993,10 @@ socket.on('whiteboard_snapshot', (data) => {
         }
 
         const { action, pageIndex } = data;
+        // Remember live actions so a later delta sync does not apply them twice
+        if (typeof data.seq === 'number') {
+            liveWhiteboardSeqs.add(data.seq);
+        }
 
         if (action === 'draw') {
             const drawingItem = data.data;
@@ -982,16 +1009,35 @@ socket.on('whiteboard_snapshot', (data) => {
             while (whiteboardPages.length <= pageIndex) {
                 whiteboardPages.push([]);
             }
+            // Our own drawing commands come back to us as well; they are already on the page
+            if (drawingItem.actionId && findWhiteboardItem(pageIndex, drawingItem.actionId)) {
+                return;
+            }
             whiteboardPages[pageIndex].push(drawingItem); // Store the drawing command
 
             // Only render if it's the currently active page
             if (pageIndex === currentPageIndex) {
                 renderCurrentWhiteboardPage(); // Re-render the entire page to include the new item
             }
+        } else if (action === 'undo' || action === 'redo') {
+            // Undo/redo ops only reference the drawing command by id; toggling it twice is harmless
+            if (!data.data) return;
+            while (whiteboardPages.length <= pageIndex) {
+                whiteboardPages.push([]);
+            }
+            if (!setWhiteboardItemUndone(pageIndex, data.data.targetId, action === 'undo')) {
+                if (action !== 'redo' || !data.data.item) return;
+                // Restores a drawing command that was already undone when this page was loaded
+                whiteboardPages[pageIndex].push(data.data.item);
+            }
+            if (pageIndex === currentPageIndex) {
+                renderCurrentWhiteboardPage();
+            }
         } else if (action === 'clear') {
             // Clear local data for the specified page
             if (whiteboardPages[pageIndex]) {
                 whiteboardPages[pageIndex] = [];
+                forgetUndoHistory(pageIndex); // The cleared drawing commands are gone for good
                 showNotification(`Whiteboard page ${pageIndex + 1} cleared by admin.`);
             }
             // If it's the current page, clear the canvas visually and redraw
@@ -1008,7 +1054,7 @@ socket.on('whiteboard_snapshot', (data) => {
             currentPageIndex = 0; // Reset to the first page on history load
             renderCurrentWhiteboardPage(); // Render the first page
             updateWhiteboardPageDisplay(); // Update page display and buttons
-            pushToUndoStack(); // Save initial loaded history to undo stack
+            forgetUndoHistory(); // Undo/redo only covers drawing commands made since the history was loaded
             showNotification('Whiteboard history loaded.');
         }
     });
@@ -1022,9 +1068,7 @@ socket.on('whiteboard_snapshot', (data) => {
         }
         whiteboardPages = [[]]; // Reset to a single, empty page
         currentPageIndex = 0;
-        undoStack = [];
-        redoStack = [];
-        updateUndoRedoButtons();
+        forgetUndoHistory();
         updateWhiteboardPageDisplay();
     });
     
@@ -1049,8 +1093,7 @@ socket.on('whiteboard_snapshot', (data) => {
         renderCurrentWhiteboardPage();
         updateWhiteboardPageDisplay();
         showNotification(`Whiteboard page changed to ${newPageIndex + 1}`);
-        // Also push to undo stack for the new page
-        pushToUndoStack();
+        updateUndoRedoButtons(); // Undo/redo applies to the drawing commands of the new page
     });
 socket.on('webrtc_offer', async (data) => {
     // This function will be triggered by the server when the admin sends an offer.
@@ -1123,13 +1166,64 @@ socket.on('webrtc_ice_candidate', async (data) => {
         }
     });
 
-    // New Socket.IO event: Assessment has started (server-side push)
+    // Socket.IO event: Assessment has started (pushed once to the classroom by the server's scheduler)
     socket.on('assessment_started', (data) => {
         console.log('[Assessment] Received assessment_started event:', data);
-        // Only act if the user is currently viewing or has set this assessment to take
-        if (currentAssessmentToTake && currentAssessmentToTake.id === data.assessmentId) {
-            showNotification(`Assessment "${data.title}" has started!`);
-            startAssessmentTimer(new Date(data.endTime)); // Start the client-side countdown
+        showNotification(`Assessment "${data.title}" has started!`);
+        // If the user is waiting on this assessment, reload it to show the questions and start the countdown
+        if (currentAssessmentToTake && currentAssessmentToTake.id === data.assessmentId &&
+            takeAssessmentContainer && !takeAssessmentContainer.classList.contains('hidden')) {
+            takeAssessment(data.assessmentId, currentAssessmentToTake.title, currentAssessmentToTake.description);
+        }
+    });
+
+    // Socket.IO event: Assessment has ended (pushed once to the classroom by the server's scheduler)
+    socket.on('assessment_ended', (data) => {
+        console.log('[Assessment] Received assessment_ended event:', data);
+        // Submit what the user has if they are still taking this assessment; the server records
+        // an empty submission for anyone who has not submitted shortly after the end.
+        if (currentAssessmentToTake && currentAssessmentToTake.id === data.assessmentId &&
+            submitAnswersBtn && !submitAnswersBtn.disabled) {
+            showNotification(`Assessment "${data.title}" has ended. Your answers have been automatically submitted.`);
+            submitAnswers(true);
+            if (takeAssessmentForm) {
+                takeAssessmentForm.querySelectorAll('input, textarea, button').forEach(el => el.disabled = true);
+            }
+            submitAnswersBtn.disabled = true;
+        }
+    });
+
+    // Socket.IO event: A queued submission has been graded and stored (server-side push)
+    socket.on('submission_graded', (data) => {
+        console.log('[Assessment] Received submission_graded event:', data);
+        if (data.status === 'failed') {
+            showNotification('Your assessment submission could not be saved. Please submit again.', true);
+            if (currentAssessmentToTake && currentAssessmentToTake.id === data.assessmentId) {
+                if (submitAnswersBtn) submitAnswersBtn.disabled = false;
+                if (takeAssessmentForm) {
+                    takeAssessmentForm.querySelectorAll('input, textarea, button').forEach(el => el.disabled = false); // Re-enable form
+                }
+            }
+            return;
+        }
+        if (currentAssessmentToTake && currentAssessmentToTake.id === data.assessmentId && assessmentSubmissionMessage) {
+            assessmentSubmissionMessage.textContent = `Assessment submitted! Your score: ${data.score}/${data.total_questions}`;
+        }
+        showNotification(`Assessment graded! Score: ${data.score}/${data.total_questions}`);
+        // After a short delay, return to the assessment list
+        setTimeout(() => {
+            loadAssessments();
+        }, 2000);
+    });
+
+    // Socket.IO event: All submissions of an assessment have been regraded (one summary per regrade)
+    socket.on('submissions_regraded', (data) => {
+        console.log('[Assessment] Received submissions_regraded event:', data);
+        showNotification(`Assessment "${data.assessmentTitle}" has been regraded.`);
+        if (currentUser && currentUser.role === 'admin' && viewSubmissionsContainer && !viewSubmissionsContainer.classList.contains('hidden')) {
+            if (submissionsAssessmentTitle.dataset.assessmentId === data.assessmentId) {
+                viewSubmissions(data.assessmentId, data.assessmentTitle);
+            }
         }
     });
 
@@ -1863,7 +1957,6 @@ function handleDrawingEnd(e) {
     if (isDraggingText) {
         isDraggingText = false;
         draggedTextItemIndex = -1;
-        pushToUndoStack();
         // The text item has already been updated in the array, so just emit the page data.
         emitWhiteboardData('page_update', whiteboardPages[currentPageIndex]);
         renderCurrentWhiteboardPage();
@@ -1893,8 +1986,9 @@ function handleDrawingEnd(e) {
     }
 
     if (newItem) {
+        newItem.actionId = generateWhiteboardActionId(); // Lets undo/redo refer to this drawing command by id
         whiteboardPages[currentPageIndex].push(newItem);
-        pushToUndoStack();
+        pushToUndoStack(newItem.actionId);
         emitWhiteboardData('draw', newItem);
         renderCurrentWhiteboardPage();
     }
@@ -1914,7 +2008,7 @@ function handleDrawingEnd(e) {
         // Iterate through text items in reverse to pick the topmost (most recently drawn)
         for (let i = currentPageCommands.length - 1; i >= 0; i--) {
             const item = currentPageCommands[i];
-            if (item.type === 'text' && item.x && item.y && item.text) {
+            if (item.type === 'text' && !item.undone && item.x && item.y && item.text) {
                 // For text, 'y' is the baseline. We need to approximate its bounding box.
                 // Measure the text width on the canvas context (need to set font first).
                 whiteboardCtx.save();
@@ -2210,12 +2304,13 @@ function getCanvasCoords(e) {
             x: textX,
             y: textY, // Y is the top of the textarea, `drawWhiteboardItem` adjusts for baseline
             color: currentColor,
-            size: currentBrushSize * 2
+            size: currentBrushSize * 2,
+            actionId: generateWhiteboardActionId() // Lets undo/redo refer to this drawing command by id
         };
 
         whiteboardPages[currentPageIndex].push(textData);
         emitWhiteboardData('draw', textData);
-        pushToUndoStack(); // Save state for undo
+        pushToUndoStack(textData.actionId); // Save state for undo
 
         removeTextInput(); // Remove the textarea after committing
         renderCurrentWhiteboardPage(); // Redraw the canvas to show the committed text.
@@ -2250,13 +2345,13 @@ function getCanvasCoords(e) {
         // Use a custom modal or notification for confirmation instead of `confirm()`
         // For now, a simple confirm dialog for quick implementation.
         // In a production app, replace with a custom modal.
-        if (!window.confirm(`Are you sure you want to clear page ${currentPageIndex + 1}? This cannot be undone by other users.`)) {
+        if (!window.confirm(`Are you sure you want to clear page ${currentPageIndex + 1}? This cannot be undone.`)) {
             return; // User cancelled
         }
 
         whiteboardPages[currentPageIndex] = []; // Clear local drawing data for the current page
         renderCurrentWhiteboardPage(); // Re-render to show an empty page
-        pushToUndoStack(); // Push the cleared state to undo stack (so undo can restore previous state)
+        forgetUndoHistory(currentPageIndex); // Cleared drawing commands cannot be brought back
         
         if (emitEvent && socket && currentClassroom && currentClassroom.id) {
             emitWhiteboardData('clear', {}); // Emit clear event
@@ -2291,64 +2386,154 @@ function getCanvasCoords(e) {
     }
 
     /**
-     * Saves a deep copy of the current page's drawing commands to the `undoStack`.
-     * Clears the `redoStack` whenever a new state is pushed.
+     * Generates the id of a new drawing command. Undo/redo ops refer to drawing commands by this id.
+     * @returns {string} A random UUID (version 4).
      */
-    function pushToUndoStack() {
-        // Deep copy the array of drawing commands for the current page
-        // This ensures that the undo stack stores distinct states, not references
-        const currentStateCopy = JSON.parse(JSON.stringify(whiteboardPages[currentPageIndex] || []));
-        undoStack.push(currentStateCopy);
-        if (undoStack.length > MAX_HISTORY_STEPS) {
-            undoStack.shift(); // Remove the oldest state if stack size exceeds limit
-        }
-        redoStack = []; // Clear redo stack on any new action
+    function generateWhiteboardActionId() {
+        if (window.crypto && typeof window.crypto.randomUUID === 'function') {
+            return window.crypto.randomUUID();
+        }
+        // Fallback for browsers without crypto.randomUUID (e.g. pages served over plain HTTP)
+        return 'xxxxxxxx-xxxx-4xxx-yxxx-xxxxxxxxxxxx'.replace(/[xy]/g, (c) => {
+            const r = Math.random() * 16 | 0;
+            return (c === 'x' ? r : (r & 0x3 | 0x8)).toString(16);
+        });
+    }
+
+    /**
+     * Finds a drawing command on a page by its action id.
+     * @param {number} pageIndex - The page to search.
+     * @param {string} actionId - The id of the drawing command.
+     * @returns {object|null} The drawing command, or null if it is not on the page.
+     */
+    function findWhiteboardItem(pageIndex, actionId) {
+        const page = whiteboardPages[pageIndex];
+        if (!page || !actionId) return null;
+        for (let i = page.length - 1; i >= 0; i--) {
+            if (page[i] && page[i].actionId === actionId) return page[i];
+        }
+        return null;
+    }
+
+    /**
+     * Marks a drawing command as undone (hidden) or restores it. Undone commands stay on the page
+     * so a redo brings them back in their original place.
+     * @param {number} pageIndex - The page holding the drawing command.
+     * @param {string} actionId - The id of the drawing command.
+     * @param {boolean} undone - True to undo, false to redo.
+     * @returns {boolean} True if the drawing command was found.
+     */
+    function setWhiteboardItemUndone(pageIndex, actionId, undone) {
+        const item = findWhiteboardItem(pageIndex, actionId);
+        if (!item) return false;
+        if (undone) {
+            item.undone = true;
+        } else {
+            delete item.undone;
+        }
+        return true;
+    }
+
+    /**
+     * Returns the position of the newest entry for the current page in an undo/redo stack.
+     * @param {Array} stack - `undoStack` or `redoStack`.
+     * @returns {number} The index of the entry, or -1 if the current page has none.
+     */
+    function lastUndoEntryIndex(stack) {
+        for (let i = stack.length - 1; i >= 0; i--) {
+            if (stack[i].pageIndex === currentPageIndex) return i;
+        }
+        return -1;
+    }
+
+    /**
+     * Records a drawing command made by this user on the current page so it can be undone.
+     * Clears the page's redo entries, as a new drawing command starts a new branch of history.
+     * @param {string} actionId - The id of the new drawing command.
+     */
+    function pushToUndoStack(actionId) {
+        undoStack.push({ pageIndex: currentPageIndex, actionId: actionId });
+        const pageEntries = undoStack.filter(entry => entry.pageIndex === currentPageIndex);
+        if (pageEntries.length > MAX_HISTORY_STEPS) {
+            undoStack.splice(undoStack.indexOf(pageEntries[0]), 1); // Drop the page's oldest step
+        }
+        redoStack = redoStack.filter(entry => entry.pageIndex !== currentPageIndex); // Clear redo for this page
         updateUndoRedoButtons(); // Update button enabled/disabled states
-        console.log(`[Whiteboard] State saved for undo. Undo stack size: ${undoStack.length}`);
+        console.log(`[Whiteboard] Action ${actionId} saved for undo. Undo stack size: ${undoStack.length}`);
     }
 
     /**
-     * Performs an undo operation: restores the previous whiteboard state for the current page.
+     * Drops the undo/redo entries of one page, or of all pages if no page index is given.
+     * @param {number} [pageIndex] - The page whose entries should be dropped.
      */
-    function undo() {
-        if (undoStack.length > 1) { // Need at least one state to revert *to* (the one before the last action)
-            const lastState = undoStack.pop(); // Remove the current state from undo stack
-            redoStack.push(lastState); // Push it to redo stack
-            whiteboardPages[currentPageIndex] = JSON.parse(JSON.stringify(undoStack[undoStack.length - 1])); // Load the previous state (deep copy)
-            renderCurrentWhiteboardPage(); // Redraw the canvas with the restored state
-            updateUndoRedoButtons();
-            showNotification("Undo action performed.");
-            console.log(`[Whiteboard] Undo successful. Undo stack: ${undoStack.length}, Redo stack: ${redoStack.length}`);
-        } else if (undoStack.length === 1) { // Special case: going back to the initial empty state
-            const lastState = undoStack.pop();
-            redoStack.push(lastState);
-            whiteboardPages[currentPageIndex] = []; // Effectively clear the page
-            renderCurrentWhiteboardPage();
-            updateUndoRedoButtons();
-            showNotification("Undo to empty page performed.");
-            console.log(`[Whiteboard] Undo to empty. Undo stack: ${undoStack.length}, Redo stack: ${redoStack.length}`);
+    function forgetUndoHistory(pageIndex) {
+        if (typeof pageIndex === 'number') {
+            undoStack = undoStack.filter(entry => entry.pageIndex !== pageIndex);
+            redoStack = redoStack.filter(entry => entry.pageIndex !== pageIndex);
+        } else {
+            undoStack = [];
+            redoStack = [];
+        }
+        updateUndoRedoButtons();
+    }
+
+    /**
+     * Sends an undo/redo op to the server. Only the id of the affected drawing command is sent;
+     * the server persists the op and relays it to the rest of the classroom.
+     * @param {string} op - 'undo' or 'redo'.
+     * @param {object} entry - The { pageIndex, actionId } stack entry the op applies to.
+     */
+    function emitWhiteboardUndoRedo(op, entry) {
+        if (socket && socket.connected && currentClassroom && currentClassroom.id) {
+            socket.emit('whiteboard_undo_redo', {
+                classroomId: currentClassroom.id,
+                pageIndex: entry.pageIndex,
+                op: op,
+                actionId: entry.actionId
+            });
         } else {
+            console.warn(`[Whiteboard] Socket not connected or classroom not set. Cannot emit ${op}.`);
+        }
+    }
+
+    /**
+     * Performs an undo operation: hides this user's most recent drawing command on the current page.
+     */
+    function undo() {
+        const index = lastUndoEntryIndex(undoStack);
+        if (index === -1) {
             showNotification("Nothing to undo.", true);
             console.warn('[Whiteboard] Undo failed: Undo stack is empty.');
+            return;
         }
+        const [entry] = undoStack.splice(index, 1);
+        redoStack.push(entry);
+        setWhiteboardItemUndone(entry.pageIndex, entry.actionId, true);
+        emitWhiteboardUndoRedo('undo', entry);
+        renderCurrentWhiteboardPage(); // Redraw the canvas without the undone drawing command
+        updateUndoRedoButtons();
+        showNotification("Undo action performed.");
+        console.log(`[Whiteboard] Undo successful. Undo stack: ${undoStack.length}, Redo stack: ${redoStack.length}`);
     }
 
     /**
-     * Performs a redo operation: reapplies the last undone whiteboard state for the current page.
+     * Performs a redo operation: restores the most recently undone drawing command on the current page.
      */
     function redo() {
-        if (redoStack.length > 0) {
-            const nextState = redoStack.pop(); // Get the last undone state from redo stack
-            undoStack.push(JSON.parse(JSON.stringify(nextState))); // Push it back to undo stack (deep copy)
-            whiteboardPages[currentPageIndex] = JSON.parse(JSON.stringify(nextState)); // Apply the state to the current page (deep copy)
-            renderCurrentWhiteboardPage(); // Redraw the canvas
-            updateUndoRedoButtons();
-            showNotification("Redo action performed.");
-            console.log(`[Whiteboard] Redo successful. Undo stack: ${undoStack.length}, Redo stack: ${redoStack.length}`);
-        } else {
+        const index = lastUndoEntryIndex(redoStack);
+        if (index === -1) {
             showNotification("Nothing to redo.", true);
             console.warn('[Whiteboard] Redo failed: Redo stack is empty.');
+            return;
         }
+        const [entry] = redoStack.splice(index, 1);
+        undoStack.push(entry);
+        setWhiteboardItemUndone(entry.pageIndex, entry.actionId, false);
+        emitWhiteboardUndoRedo('redo', entry);
+        renderCurrentWhiteboardPage(); // Redraw the canvas with the restored drawing command
+        updateUndoRedoButtons();
+        showNotification("Redo action performed.");
+        console.log(`[Whiteboard] Redo successful. Undo stack: ${undoStack.length}, Redo stack: ${redoStack.length}`);
     }
 
     /**
@@ -2356,8 +2541,8 @@ function getCanvasCoords(e) {
      */
     function updateUndoRedoButtons() {
         // Disable if not admin, or if stack state doesn't allow (e.g., only initial empty state for undo)
-        if (undoButton) undoButton.disabled = !currentUser || currentUser.role !== 'admin' || undoStack.length <= 1;
-        if (redoButton) redoButton.disabled = !currentUser || currentUser.role !== 'admin' || redoStack.length === 0;
+        if (undoButton) undoButton.disabled = !currentUser || currentUser.role !== 'admin' || lastUndoEntryIndex(undoStack) === -1;
+        if (redoButton) redoButton.disabled = !currentUser || currentUser.role !== 'admin' || lastUndoEntryIndex(redoStack) === -1;
     }
 
     /**
@@ -2374,6 +2559,17 @@ function getCanvasCoords(e) {
             return;
         }
 
+        // On reconnect, only fetch the actions recorded since our cursor
+        if (whiteboardCursor !== null && whiteboardCursorClassroomId === currentClassroom.id) {
+            if (await syncWhiteboardDelta()) {
+                return;
+            }
+        }
+
+        // Show a server-rendered image of the first page until the full history has been drawn
+        whiteboardHistoryLoading = true;
+        showWhiteboardPreview();
+
         try {
             console.log(`[Whiteboard] Requesting whiteboard history for classroom ${currentClassroom.id}...`);
             const response = await fetch(`/api/whiteboard-history/${currentClassroom.id}`);
@@ -2394,10 +2590,13 @@ function getCanvasCoords(e) {
             if (whiteboardPages.length === 0) {
                 whiteboardPages = [[]]; // Ensure at least one page exists
             }
+            whiteboardCursor = typeof data.cursor === 'number' ? data.cursor : null;
+            whiteboardCursorClassroomId = currentClassroom.id;
+            liveWhiteboardSeqs.clear();
             currentPageIndex = 0; // Always reset to the first page when history is loaded
             renderCurrentWhiteboardPage(); // Render the content of the first page
             updateWhiteboardPageDisplay(); // Update the page indicator
-            pushToUndoStack(); // Save this initial state to undo stack
+            forgetUndoHistory(); // Undo/redo only covers drawing commands made since the history was loaded
             showNotification("Whiteboard history loaded successfully.");
             console.log(`[Whiteboard] Whiteboard history loaded. Total pages: ${whiteboardPages.length}`);
         } catch (error) {
@@ -2407,6 +2606,80 @@ function getCanvasCoords(e) {
             renderCurrentWhiteboardPage();
             updateWhiteboardPageDisplay();
             showNotification("Failed to load whiteboard history.", true);
+        } finally {
+            whiteboardHistoryLoading = false;
+        }
+    }
+
+    /**
+     * Draws a server-rendered image of the first whiteboard page onto the canvas while the full
+     * history is loading, so late joiners see the board right away. Once the history arrives the
+     * page is redrawn from its drawing commands and the image is gone.
+     */
+    function showWhiteboardPreview() {
+        if (!whiteboardCtx || !whiteboardCanvas || !currentClassroom || !currentClassroom.id) return;
+        const classroomId = currentClassroom.id;
+        const preview = new Image();
+        preview.onload = () => {
+            // Skip the preview if the history won the race or the user left the classroom
+            if (whiteboardHistoryLoading && currentClassroom && currentClassroom.id === classroomId) {
+                whiteboardCtx.drawImage(preview, 0, 0, whiteboardCanvas.width, whiteboardCanvas.height);
+            }
+        };
+        preview.src = `/api/whiteboard-render/${classroomId}/0?width=${Math.round(whiteboardCanvas.width)}&format=webp`;
+    }
+
+    /**
+     * Fetches only the whiteboard actions recorded after `whiteboardCursor` and applies them.
+     * Pages the server marks with `reset` (cleared in the meantime) are replaced instead of appended to.
+     * @returns {Promise<boolean>} True if the delta was applied, false if a full reload is needed.
+     */
+    async function syncWhiteboardDelta() {
+        try {
+            console.log(`[Whiteboard] Requesting whiteboard delta since ${whiteboardCursor} for classroom ${currentClassroom.id}...`);
+            const response = await fetch(`/api/whiteboard-history/${currentClassroom.id}?since=${whiteboardCursor}`);
+            if (!response.ok) {
+                throw new Error(`HTTP error! status: ${response.status}`);
+            }
+            const delta = await response.json();
+            if (delta.full || !Array.isArray(delta.pages)) {
+                return false; // Too much changed; fall back to a full history load
+            }
+            delta.pages.forEach(page => {
+                while (whiteboardPages.length <= page.pageIndex) {
+                    whiteboardPages.push([]);
+                }
+                if (page.reset) {
+                    whiteboardPages[page.pageIndex] = [];
+                    forgetUndoHistory(page.pageIndex);
+                }
+                page.actions.forEach(entry => {
+                    if (!page.reset && liveWhiteboardSeqs.has(entry.seq)) {
+                        return; // Already applied from the live event or an earlier delta
+                    }
+                    liveWhiteboardSeqs.add(entry.seq);
+                    if (entry.action === 'draw') {
+                        whiteboardPages[page.pageIndex].push(entry.data);
+                    } else if (entry.action === 'undo' || entry.action === 'redo') {
+                        const undone = entry.action === 'undo';
+                        if (!setWhiteboardItemUndone(page.pageIndex, entry.data.targetId, undone) && !undone && entry.data.item) {
+                            // Restores a drawing command that was already undone when this page was loaded
+                            whiteboardPages[page.pageIndex].push(entry.data.item);
+                        }
+                    }
+                });
+            });
+            whiteboardCursor = delta.cursor;
+            // The cursor may stop short of actions still being stored; keep those marked as applied
+            // so the next delta, which sends them again, does not apply them twice.
+            liveWhiteboardSeqs = new Set([...liveWhiteboardSeqs].filter(seq => seq > whiteboardCursor));
+            renderCurrentWhiteboardPage();
+            updateWhiteboardPageDisplay();
+            console.log(`[Whiteboard] Whiteboard delta applied. ${delta.pages.length} page(s) changed, cursor now ${whiteboardCursor}.`);
+            return true;
+        } catch (error) {
+            console.error("[Whiteboard] Error fetching whiteboard delta:", error);
+            return false;
         }
     }
 
@@ -2427,6 +2700,7 @@ function getCanvasCoords(e) {
         const currentPageCommands = whiteboardPages[currentPageIndex];
         if (currentPageCommands && currentPageCommands.length > 0) {
             currentPageCommands.forEach(command => {
+                if (command.undone) return; // Undone drawing commands stay on the page for redo, but are not drawn
                 drawWhiteboardItem(command); // Redraw each item
             });
             // console.log(`[Whiteboard] Rendered page ${currentPageIndex + 1} with ${currentPageCommands.length} items.`);
@@ -2483,7 +2757,7 @@ function getCanvasCoords(e) {
         }
         renderCurrentWhiteboardPage(); // Render the new current page
         updateWhiteboardPageDisplay(); // Update page indicator and buttons
-        pushToUndoStack(); // Save the new page's empty state to undo stack
+        updateUndoRedoButtons(); // Undo/redo applies to the drawing commands of the new page
         // Emit page change event to synchronize with other users
         emitWhiteboardPageChange(currentPageIndex);
     }
@@ -2496,7 +2770,7 @@ function getCanvasCoords(e) {
             currentPageIndex--; // Decrement page index
             renderCurrentWhiteboardPage(); // Render the previous page
             updateWhiteboardPageDisplay(); // Update page indicator and buttons
-            pushToUndoStack(); // Save the previous page's state to undo stack
+            updateUndoRedoButtons(); // Undo/redo applies to the drawing commands of the new page
             // Emit page change event to synchronize with other users
             emitWhiteboardPageChange(currentPageIndex);
             showNotification(`Moved to whiteboard page ${currentPageIndex + 1}`);
@@ -2581,7 +2855,78 @@ const sendMessage = (message, type = 'text', fileUrl = null) => {
 };
 
 // Function to render a single message in the chat
-function renderMessage(data) {
+/**
+ * Fetches one page of the current classroom's chat history.
+ * @param {string|null} before - Cursor of the oldest message already shown, or null for the newest page.
+ * @returns {Promise<object|null>} The page ({ messages, has_more, before, after }), or null on error.
+ */
+async function fetchChatHistoryPage(before) {
+    const params = new URLSearchParams();
+    if (before) params.set('before', before);
+    try {
+        const response = await fetch(`/api/classrooms/${currentClassroom.id}/chat?${params.toString()}`);
+        if (!response.ok) {
+            throw new Error(`HTTP error! status: ${response.status}`);
+        }
+        return await response.json();
+    } catch (error) {
+        console.error('[Chat] Error fetching chat history:', error);
+        return null;
+    }
+}
+
+/**
+ * Loads the newest page of chat messages when entering a classroom.
+ */
+async function loadChatHistory() {
+    if (!currentClassroom || !currentClassroom.id || !chatMessages) return;
+    chatHistoryBefore = null;
+    chatHistoryHasMore = false;
+    chatHistoryLoading = true;
+    const page = await fetchChatHistoryPage(null);
+    chatHistoryLoading = false;
+    if (!page) return;
+    chatMessages.innerHTML = ''; // Clear messages of a previously visited classroom
+    page.messages.forEach(msg => renderMessage(msg));
+    chatHistoryBefore = page.before;
+    chatHistoryHasMore = page.has_more;
+    chatMessages.scrollTop = chatMessages.scrollHeight; // Start at the latest message
+}
+
+/**
+ * Loads the next page of older chat messages and inserts it above the visible ones,
+ * keeping the scroll position on the message the user was looking at.
+ */
+async function loadOlderChatMessages() {
+    if (!chatHistoryHasMore || chatHistoryLoading || !currentClassroom || !currentClassroom.id) return;
+    chatHistoryLoading = true;
+    const page = await fetchChatHistoryPage(chatHistoryBefore);
+    chatHistoryLoading = false;
+    if (!page) return;
+    const fragment = document.createDocumentFragment();
+    page.messages.forEach(msg => renderMessage(msg, fragment));
+    const previousHeight = chatMessages.scrollHeight;
+    chatMessages.insertBefore(fragment, chatMessages.firstChild);
+    chatMessages.scrollTop += chatMessages.scrollHeight - previousHeight;
+    chatHistoryBefore = page.before;
+    chatHistoryHasMore = page.has_more;
+}
+
+// Load older chat messages when the user scrolls to the top of the chat
+if (chatMessages) {
+    chatMessages.addEventListener('scroll', () => {
+        if (chatMessages.scrollTop === 0) {
+            loadOlderChatMessages();
+        }
+    });
+}
+
+/**
+ * Renders a chat message.
+ * @param {object} data - The chat message.
+ * @param {Node} [container=chatMessages] - Where to append the message; anything other than the chat list is not scrolled.
+ */
+function renderMessage(data, container = chatMessages) {
     const isCurrentUser = data.user_id === localStorage.getItem('user_id');
     const messageContainer = document.createElement('div');
     messageContainer.classList.add('chat-message-container');
@@ -2599,7 +2944,13 @@ function renderMessage(data) {
     if (data.type === 'file') {
         messageContent = `**File Shared:** <a href="${data.fileUrl}" target="_blank" rel="noopener noreferrer">${data.message.replace('**File shared:** ', '')}</a>`;
     } else if (data.type === 'whiteboard_snapshot') {
-        messageContent = `<div class="snapshot-container"><img src="${data.imageData}" alt="Whiteboard Snapshot" class="whiteboard-image"></div>`;
+        if (data.imageUrl) {
+            // Snapshots reference the blob store: show the thumbnail, link to the full image
+            messageContent = `<div class="snapshot-container"><a href="${data.imageUrl}" target="_blank" rel="noopener noreferrer"><img src="${data.thumbnailUrl || data.imageUrl}" alt="Whiteboard Snapshot" class="whiteboard-image" loading="lazy"></a></div>`;
+        } else {
+            // Older snapshots embedded the image itself
+            messageContent = `<div class="snapshot-container"><img src="${data.imageData}" alt="Whiteboard Snapshot" class="whiteboard-image"></div>`;
+        }
     }
 
     const contentDiv = document.createElement('div');
@@ -2632,8 +2983,10 @@ function renderMessage(data) {
         messageContainer.appendChild(messageBubble);
     }
 
-    chatMessages.appendChild(messageContainer);
-    chatMessages.scrollTop = chatMessages.scrollHeight;
+    container.appendChild(messageContainer);
+    if (container === chatMessages) {
+        chatMessages.scrollTop = chatMessages.scrollHeight;
+    }
 }
 
 // Functions for message editing and deletion
@@ -3403,7 +3756,20 @@ function startAssessmentTimer(scheduledAtUTCString, durationMinutes) {
             });
             const result = await response.json();
 
-            if (response.ok) {
+            if (response.status === 202) {
+                // Queued for grading: the score arrives with the 'submission_graded' event.
+                if (assessmentSubmissionMessage) {
+                    assessmentSubmissionMessage.textContent = 'Assessment submitted! Grading...';
+                    assessmentSubmissionMessage.classList.remove('error');
+                    assessmentSubmissionMessage.classList.add('success');
+                }
+                if (submitAnswersBtn) submitAnswersBtn.disabled = true; // Disable further submissions
+                if (takeAssessmentForm) {
+                    takeAssessmentForm.querySelectorAll('input, textarea, button').forEach(el => el.disabled = true); // Disable form
+                }
+                showNotification('Assessment submitted! Your score will appear shortly.');
+                console.log('[Assessment] Submission queued for grading:', result);
+            } else if (response.ok) {
                 if (assessmentSubmissionMessage) {
                     assessmentSubmissionMessage.textContent = `Assessment submitted! Your score: ${result.score}/${result.total_questions}`;
                     assessmentSubmissionMessage.classList.remove('error');
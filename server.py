@@ -8,7 +8,7 @@ gevent.monkey.patch_all()
 
 # --- Standard Imports ---
 # Flask for web framework functionalities like routing, requests, jsonify, sessions.
-from flask import Flask, request, jsonify, send_from_directory, session
+from flask import Flask, request, jsonify, send_from_directory, session, make_response
 # Flask-PyMongo for MongoDB integration.
 from flask_pymongo import PyMongo
 # Werkzeug for password hashing and checking, crucial for secure authentication.
@@ -21,6 +21,43 @@ import uuid
 from datetime import datetime, timedelta
 # ObjectId from BSON is typically used for MongoDB's default primary key, but we'll primarily use UUID strings.
 from bson.objectid import ObjectId
+# Binary and BSON encoding for the compact whiteboard stroke codec.
+from bson.binary import Binary
+import bson
+# Math and JSON helpers used when encoding strokes and measuring payload sizes.
+import math
+import json
+# Random synthetic strokes for the codec benchmark when no stored ones exist.
+import random
+# Click provides options for the Flask CLI maintenance commands.
+import click
+# NumPy for vectorized geometry (stroke simplification).
+import numpy as np
+# DuplicateKeyError signals that a concurrent writer (another greenlet or worker) already stored a document.
+from pymongo.errors import DuplicateKeyError, BulkWriteError, OperationFailure, PyMongoError
+# ReturnDocument lets atomic counter updates return the incremented value; UpdateOne builds bulk writes.
+from pymongo import ReturnDocument, UpdateOne
+# Gevent itself, used to spawn lightweight background greenlets (e.g., whiteboard compaction).
+import gevent
+# Gevent queues buffer documents for background (write-behind) persistence.
+import gevent.queue
+# Real OS threads for CPU-bound work (password hashing) that must not block the event loop.
+import gevent.threadpool
+# Time and atexit for batching deadlines and flushing buffers on shutdown.
+import time
+import atexit
+# OrderedDict provides the recency ordering for in-process LRU caches.
+from collections import OrderedDict
+# Hashing, base64 decoding and in-memory buffers for the content-addressed snapshot blob store.
+import hashlib
+import base64
+import binascii
+import io
+import re
+# HTML escaping of highlighted chat search snippets.
+import html
+# Pillow validates snapshot images, renders their thumbnails and rasterizes whiteboard pages.
+from PIL import Image, ImageDraw, ImageFont, ImageColor
 
 # Import Flask-SocketIO and SocketIO for real-time, bidirectional communication.
 from flask_socketio import SocketIO, emit, join_room, leave_room, rooms, disconnect
@@ -32,11 +69,14 @@ from flask_cors import CORS
 from apscheduler.schedulers.gevent import GeventScheduler
 # GeventExecutor ensures scheduled jobs run in a Gevent-compatible way.
 from apscheduler.executors.gevent import GeventExecutor
+from apscheduler.jobstores.base import JobLookupError
 
 # --- Flask-Caching for in-memory or Redis-based caching ---
 # New: File Upload API Endpoint
 from werkzeug.utils import secure_filename 
 from flask_caching import Cache
+# Direct Redis access for data structures Flask-Caching does not offer (lists).
+import redis
 
 # --- Flask App Initialization ---
 # Initialize Flask app, serving static files from the current directory.
@@ -62,7 +102,11 @@ if not os.path.exists(UPLOAD_FOLDER):
 CORS(app, resources={r"/*": {"origins": "*", "supports_credentials": True}}, supports_credentials=True)
 # Initialize SocketIO with CORS enabled for all origins, using gevent for async,
 # with logging enabled for debugging, and session management integrated.
-socketio = SocketIO(app, cors_allowed_origins="*", async_mode='gevent', logger=True, engineio_logger=True, manage_session=True)
+# Optional message queue (e.g. redis://...) shared by all workers, so emits to rooms and sids reach
+# clients connected to any worker or node. Without it every worker only reaches its own clients.
+SOCKETIO_MESSAGE_QUEUE = os.environ.get('SOCKETIO_MESSAGE_QUEUE')
+socketio = SocketIO(app, cors_allowed_origins="*", async_mode='gevent', logger=True, engineio_logger=True, manage_session=True,
+                    message_queue=SOCKETIO_MESSAGE_QUEUE)
 
 # --- Cache Configuration (using Redis for production, local for dev fallback) ---
 # Configures Flask-Caching to use Redis as the backend for caching.
@@ -71,14 +115,13 @@ app.config['CACHE_TYPE'] = 'RedisCache'
 app.config['CACHE_REDIS_URL'] = os.environ.get('REDIS_URL', 'redis://localhost:6379/0')
 # Initializes the cache manager.
 cache = Cache(app)
+# Raw client on the same Redis instance, for list-based caches such as the recent chat ring.
+redis_client = redis.Redis.from_url(app.config['CACHE_REDIS_URL'])
 
 # --- MongoDB Setup ---
 # Initializes Flask-PyMongo to connect to the MongoDB database configured in app.config.
 mongo = PyMongo(app)
 
-# Store user-to-socket mapping for direct communication
-user_to_socket_map = {}
-
 # --- MongoDB Collections Definitions ---
 # Defines references to various MongoDB collections for different data types.
 users_collection = mongo.db.users
@@ -90,6 +133,10 @@ assessment_submissions_collection = mongo.db.assessment_submissions
 # Collection to store whiteboard drawing commands, organized by page.
 whiteboard_collection = mongo.db.whiteboard_drawings_pages
 chat_messages_collection = mongo.db.chat_messages
+# Collection holding one materialized checkpoint (the reconstructed drawing commands) per whiteboard page.
+whiteboard_checkpoints_collection = mongo.db.whiteboard_page_checkpoints
+# Collection holding the per-classroom whiteboard action sequence counters.
+whiteboard_counters_collection = mongo.db.whiteboard_counters
 # Collection for persistent WebRTC signaling data.
 
 
@@ -157,6 +204,2389 @@ def get_user_data(user_id):
         return user
     return None
 
+def get_users_data(user_ids):
+    """
+    Bulk version of `get_user_data`: resolves many users with one cache round-trip (get_many),
+    reads only the cache misses from MongoDB in a single $in query, and caches them with set_many.
+
+    Args:
+        user_ids (iterable): UUID string IDs of the users; duplicates and empty values are ignored.
+
+    Returns:
+        dict: Maps each found user id to its user data (without 'password' and '_id').
+    """
+    user_ids = list(dict.fromkeys(user_id for user_id in user_ids if user_id))
+    if not user_ids:
+        return {}
+
+    cached = cache.get_many(*[f"user_{user_id}" for user_id in user_ids])
+    users = {user_id: user for user_id, user in zip(user_ids, cached) if user}
+    missing_ids = [user_id for user_id in user_ids if user_id not in users]
+    if missing_ids:
+        fetched = list(users_collection.find({"id": {"$in": missing_ids}}, {"password": 0, "_id": 0}))
+        if fetched:
+            cache.set_many({f"user_{user['id']}": user for user in fetched}, timeout=3600)
+        users.update((user['id'], user) for user in fetched)
+    print(f"Resolved {len(users)} of {len(user_ids)} users ({len(user_ids) - len(missing_ids)} from cache).")
+    return users
+
+def attach_chat_authors(chat_messages):
+    """Refreshes the username and role shown on chat messages from the (bulk-cached) user records."""
+    users = get_users_data(chat_message.get('user_id') for chat_message in chat_messages)
+    for chat_message in chat_messages:
+        user = users.get(chat_message.get('user_id'))
+        if user:
+            chat_message['username'] = user.get('username', chat_message.get('username'))
+            chat_message['role'] = user.get('role', chat_message.get('role'))
+    return chat_messages
+
+# --- Classroom Membership Cache ---
+# Authorization checks ("is this user a participant of this classroom?") are answered from a per-process
+# LRU whose entries live at most MEMBERSHIP_LOCAL_TTL seconds, backed by one Redis set of participant ids
+# per classroom. Membership changes drop the Redis set and this worker's entries immediately; other
+# workers see a change after at most MEMBERSHIP_LOCAL_TTL seconds, which is the staleness bound.
+
+# Seconds a membership answer is trusted by a worker without asking Redis again.
+MEMBERSHIP_LOCAL_TTL = float(os.environ.get('MEMBERSHIP_LOCAL_TTL', 5))
+# Maximum number of (classroom, user) answers kept per worker.
+MEMBERSHIP_LOCAL_MAX_ENTRIES = int(os.environ.get('MEMBERSHIP_LOCAL_MAX_ENTRIES', 50000))
+# Seconds a classroom's participant set stays in Redis.
+MEMBERSHIP_REDIS_TTL = int(os.environ.get('MEMBERSHIP_REDIS_TTL', 600))
+# Member stored in every loaded participant set, so a loaded set is never empty (and never missing).
+MEMBERSHIP_LOADED_MARKER = '__loaded__'
+
+class ClassroomMembershipCache:
+    """
+    Two-level cache of classroom participation. A miss in the local LRU reads the classroom's Redis set;
+    a missing set is rebuilt from MongoDB. Every invalidation increments a ':v' counter in Redis, so a
+    rebuild that read MongoDB before a concurrent change is discarded instead of caching stale members.
+    """
+
+    def __init__(self, client, local_ttl, max_entries, redis_ttl):
+        self.client = client
+        self.local_ttl = local_ttl
+        self.max_entries = max_entries
+        self.redis_ttl = redis_ttl
+        self.entries = OrderedDict() # (classroomId, userId) -> (is_member, expires_at)
+        self.stats = {"local_hits": 0, "redis_hits": 0, "loads": 0, "load_conflicts": 0,
+                      "invalidations": 0, "errors": 0}
+
+    def _key(self, classroom_id):
+        return f"classroom_members:{classroom_id}"
+
+    def _version_key(self, classroom_id):
+        return f"classroom_members:{classroom_id}:v"
+
+    def is_member(self, classroom_id, user_id):
+        """Returns whether `user_id` is a participant of `classroom_id`."""
+        key = (classroom_id, user_id)
+        entry = self.entries.get(key)
+        if entry is not None and entry[1] > time.monotonic():
+            self.entries.move_to_end(key)
+            self.stats["local_hits"] += 1
+            return entry[0]
+
+        is_member = self._lookup(classroom_id, user_id)
+        self.entries[key] = (is_member, time.monotonic() + self.local_ttl)
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.max_entries:
+            self.entries.popitem(last=False)
+        return is_member
+
+    def _lookup(self, classroom_id, user_id):
+        """Answers from the Redis set, loading it from MongoDB when it is missing."""
+        try:
+            pipe = self.client.pipeline(transaction=False)
+            pipe.sismember(self._key(classroom_id), MEMBERSHIP_LOADED_MARKER)
+            pipe.sismember(self._key(classroom_id), user_id)
+            loaded, is_member = pipe.execute()
+            if loaded:
+                self.stats["redis_hits"] += 1
+                return bool(is_member)
+            return user_id in self.load(classroom_id)
+        except redis.RedisError as e:
+            self.stats["errors"] += 1
+            print(f"Membership cache unavailable for classroom {classroom_id}: {e}")
+            return classrooms_collection.find_one({"id": classroom_id, "participants": user_id}, {"_id": 1}) is not None
+
+    def load(self, classroom_id):
+        """Reads a classroom's participants from MongoDB into its Redis set and returns them."""
+        version_key = self._version_key(classroom_id)
+        version = self.client.get(version_key)
+        classroom = classrooms_collection.find_one({"id": classroom_id}, {"_id": 0, "participants": 1})
+        participants = set(classroom.get('participants', [])) if classroom else set()
+        self.stats["loads"] += 1
+        try:
+            with self.client.pipeline() as pipe:
+                pipe.watch(version_key)
+                if pipe.get(version_key) != version:
+                    raise redis.WatchError()
+                pipe.multi()
+                pipe.delete(self._key(classroom_id))
+                pipe.sadd(self._key(classroom_id), MEMBERSHIP_LOADED_MARKER, *participants)
+                pipe.expire(self._key(classroom_id), self.redis_ttl)
+                pipe.execute()
+        except redis.WatchError:
+            self.stats["load_conflicts"] += 1
+        return participants
+
+    def invalidate(self, classroom_id):
+        """Drops the cached participants of a classroom, in Redis and in this worker."""
+        for key in [key for key in self.entries if key[0] == classroom_id]:
+            del self.entries[key]
+        self.stats["invalidations"] += 1
+        try:
+            pipe = self.client.pipeline()
+            pipe.delete(self._key(classroom_id))
+            pipe.incr(self._version_key(classroom_id))
+            pipe.expire(self._version_key(classroom_id), self.redis_ttl)
+            pipe.execute()
+        except redis.RedisError as e:
+            self.stats["errors"] += 1
+            print(f"Membership cache invalidation failed for classroom {classroom_id}: {e}")
+
+    def get_stats(self):
+        """Returns local/Redis hit counters, the overall hit rate and the local footprint."""
+        hits = self.stats["local_hits"] + self.stats["redis_hits"]
+        lookups = hits + self.stats["loads"]
+        return dict(self.stats, entries=len(self.entries), local_ttl=self.local_ttl,
+                    hit_rate=round(hits / lookups, 4) if lookups else 0.0)
+
+classroom_membership_cache = ClassroomMembershipCache(redis_client, MEMBERSHIP_LOCAL_TTL, MEMBERSHIP_LOCAL_MAX_ENTRIES, MEMBERSHIP_REDIS_TTL)
+
+def is_classroom_member(classroom_id, user_id):
+    """
+    Returns whether a user is a participant of a classroom, from the membership cache.
+    Answers may lag a membership change made by another worker by up to MEMBERSHIP_LOCAL_TTL seconds.
+    """
+    if not classroom_id or not user_id:
+        return False
+    return classroom_membership_cache.is_member(classroom_id, user_id)
+
+# --- Presence Registry ---
+# Who is connected, shared by all workers through Redis:
+#   presence:sid:<sid>          -> user id; expires unless refreshed by the owning worker's heartbeat.
+#   presence:user:<userId>      -> sorted set of the user's sids, scored by connection time.
+#   presence:classroom:<id>     -> sorted set of user ids online in the classroom, scored by expiry time.
+# Each worker remembers its own sockets and refreshes their keys every PRESENCE_HEARTBEAT_SECONDS, so
+# the sockets of a crashed worker disappear after PRESENCE_TTL seconds.
+
+# Seconds between presence heartbeats of a worker.
+PRESENCE_HEARTBEAT_SECONDS = int(os.environ.get('PRESENCE_HEARTBEAT_SECONDS', 30))
+# Seconds a socket stays online without a heartbeat.
+PRESENCE_TTL = int(os.environ.get('PRESENCE_TTL', 90))
+
+class PresenceRegistry:
+    """
+    Redis-backed registry of connected sockets per user and online users per classroom.
+    Redis errors are logged and counted; lookups then report nobody online.
+    """
+
+    def __init__(self, client, ttl):
+        self.client = client
+        self.ttl = ttl
+        self.local_sockets = {} # sid -> {"user_id": str, "classrooms": set} for sockets of this worker
+        self.stats = {"connects": 0, "disconnects": 0, "heartbeats": 0, "errors": 0}
+
+    def _sid_key(self, sid):
+        return f"presence:sid:{sid}"
+
+    def _user_key(self, user_id):
+        return f"presence:user:{user_id}"
+
+    def _classroom_key(self, classroom_id):
+        return f"presence:classroom:{classroom_id}"
+
+    def _execute(self, action, build):
+        """Runs the commands added by `build(pipe)` in one pipeline; returns the results or None on a Redis error."""
+        try:
+            pipe = self.client.pipeline()
+            build(pipe)
+            return pipe.execute()
+        except redis.RedisError as e:
+            self.stats["errors"] += 1
+            print(f"Presence registry {action} failed: {e}")
+            return None
+
+    def connect(self, sid, user_id):
+        """Registers a new socket of a user."""
+        self.local_sockets[sid] = {"user_id": user_id, "classrooms": set()}
+        self.stats["connects"] += 1
+
+        def build(pipe):
+            pipe.set(self._sid_key(sid), user_id, ex=self.ttl)
+            pipe.zadd(self._user_key(user_id), {sid: time.time()})
+            pipe.expire(self._user_key(user_id), self.ttl)
+        self._execute("connect", build)
+
+    def join(self, sid, user_id, classroom_id):
+        """Marks a socket's user online in a classroom (registering the socket first if needed)."""
+        if sid not in self.local_sockets:
+            self.connect(sid, user_id)
+        self.local_sockets[sid]["classrooms"].add(classroom_id)
+        self._execute("join", lambda pipe: self._mark_online(pipe, user_id, classroom_id))
+
+    def leave(self, sid, classroom_id):
+        """Marks a socket's user offline in a classroom, unless another of their sockets is still in it."""
+        entry = self.local_sockets.get(sid)
+        if not entry:
+            return
+        entry["classrooms"].discard(classroom_id)
+        if not self._still_in_classroom(entry["user_id"], classroom_id):
+            self._execute("leave", lambda pipe: pipe.zrem(self._classroom_key(classroom_id), entry["user_id"]))
+
+    def disconnect(self, sid):
+        """Unregisters a socket and takes its user offline in the classrooms it had joined."""
+        entry = self.local_sockets.pop(sid, None)
+        if not entry:
+            return
+        self.stats["disconnects"] += 1
+        user_id = entry["user_id"]
+        left = [classroom_id for classroom_id in entry["classrooms"] if not self._still_in_classroom(user_id, classroom_id)]
+
+        def build(pipe):
+            pipe.delete(self._sid_key(sid))
+            pipe.zrem(self._user_key(user_id), sid)
+            for classroom_id in left:
+                pipe.zrem(self._classroom_key(classroom_id), user_id)
+        self._execute("disconnect", build)
+
+    def _still_in_classroom(self, user_id, classroom_id):
+        """
+        Whether another socket of the user on this worker is in the classroom. Sockets of the same user
+        on other workers re-add the user with their next heartbeat.
+        """
+        return any(entry["user_id"] == user_id and classroom_id in entry["classrooms"]
+                   for entry in self.local_sockets.values())
+
+    def _mark_online(self, pipe, user_id, classroom_id):
+        now = time.time()
+        pipe.zadd(self._classroom_key(classroom_id), {user_id: now + self.ttl})
+        pipe.zremrangebyscore(self._classroom_key(classroom_id), '-inf', now)
+        pipe.expire(self._classroom_key(classroom_id), self.ttl)
+
+    def heartbeat(self):
+        """Refreshes the presence keys of every socket connected to this worker."""
+        if not self.local_sockets:
+            return
+
+        def build(pipe):
+            for sid, entry in list(self.local_sockets.items()):
+                pipe.set(self._sid_key(sid), entry["user_id"], ex=self.ttl)
+                # NX keeps the connection time; it re-adds a socket pruned while its key had lapsed.
+                pipe.zadd(self._user_key(entry["user_id"]), {sid: time.time()}, nx=True)
+                pipe.expire(self._user_key(entry["user_id"]), self.ttl)
+                for classroom_id in entry["classrooms"]:
+                    self._mark_online(pipe, entry["user_id"], classroom_id)
+        if self._execute("heartbeat", build) is not None:
+            self.stats["heartbeats"] += 1
+
+    def get_sid(self, user_id):
+        """Returns the most recently connected live socket of a user, or None if the user is offline."""
+        try:
+            sids = [sid.decode() for sid in self.client.zrevrange(self._user_key(user_id), 0, -1)]
+            if not sids:
+                return None
+            pipe = self.client.pipeline(transaction=False)
+            for sid in sids:
+                pipe.exists(self._sid_key(sid))
+            alive = pipe.execute()
+            dead = [sid for sid, is_alive in zip(sids, alive) if not is_alive]
+            if dead:
+                # Sockets of crashed workers: their sid keys expired without a disconnect.
+                self.client.zrem(self._user_key(user_id), *dead)
+            return next((sid for sid, is_alive in zip(sids, alive) if is_alive), None)
+        except redis.RedisError as e:
+            self.stats["errors"] += 1
+            print(f"Presence lookup for user {user_id} failed: {e}")
+            return None
+
+    def online_users(self, classroom_id):
+        """Returns the ids of the users online in a classroom."""
+        try:
+            return [user_id.decode() for user_id in self.client.zrangebyscore(self._classroom_key(classroom_id), time.time(), '+inf')]
+        except redis.RedisError as e:
+            self.stats["errors"] += 1
+            print(f"Presence lookup for classroom {classroom_id} failed: {e}")
+            return []
+
+    def get_stats(self):
+        """Returns the registry counters and the number of sockets on this worker."""
+        return dict(self.stats, local_sockets=len(self.local_sockets), ttl=self.ttl)
+
+presence_registry = PresenceRegistry(redis_client, PRESENCE_TTL)
+# Keeps this worker's sockets online.
+scheduler.add_job(presence_registry.heartbeat, 'interval', seconds=PRESENCE_HEARTBEAT_SECONDS)
+
+# --- Write-Behind Persistence ---
+class WriteBehindQueue:
+    """
+    Bounded in-process buffer that persists documents in batches from a background greenlet,
+    so request and socket handlers never wait on the database for high-frequency writes.
+
+    A batch is flushed once `max_batch` documents are buffered or `max_delay` seconds after its
+    first document arrived, whichever comes first. When the buffer is full new documents are
+    dropped (and counted) rather than blocking the caller. Failed batches are retried with
+    backoff up to `max_retries` times before being dropped.
+    """
+
+    def __init__(self, name, flush_fn, max_batch=100, max_delay=0.25, max_queue=10000, max_retries=3, on_drop=None):
+        """
+        Args:
+            name (str): Name used in logs and metrics.
+            flush_fn (callable): Persists a list of documents; must be idempotent, as retries resend the batch.
+            max_batch (int): Maximum number of documents per flush.
+            max_delay (float): Maximum seconds a document waits in the buffer before its batch is flushed.
+            max_queue (int): Maximum number of buffered documents.
+            max_retries (int): How many times a failed batch is retried before it is dropped.
+            on_drop (callable): Optional; called with a batch that is dropped after its last retry.
+        """
+        self.name = name
+        self.flush_fn = flush_fn
+        self.max_batch = max_batch
+        self.max_delay = max_delay
+        self.max_retries = max_retries
+        self.on_drop = on_drop
+        self.queue = gevent.queue.Queue(maxsize=max_queue)
+        self.in_flight = None # The batch currently being collected or flushed by the background greenlet.
+        self.greenlet = None
+        self.stats = {
+            "enqueued": 0,
+            "flushed": 0,
+            "batches": 0,
+            "retried_batches": 0,
+            "dropped_batches": 0,
+            "dropped_documents": 0,
+            "last_flush_ms": 0.0,
+            "max_flush_ms": 0.0,
+            "total_flush_ms": 0.0,
+            # Time from enqueueing the oldest document of a batch until the batch was persisted.
+            "last_latency_ms": 0.0,
+            "max_latency_ms": 0.0
+        }
+
+    def start(self):
+        """Starts the background flushing greenlet (once)."""
+        if self.greenlet is None or self.greenlet.dead:
+            self.greenlet = gevent.spawn(self._run)
+
+    def put(self, doc):
+        """
+        Buffers a document for persistence without blocking.
+
+        Returns:
+            bool: False if the buffer was full and the document was dropped.
+        """
+        try:
+            self.queue.put_nowait((time.monotonic(), doc))
+        except gevent.queue.Full:
+            self.stats["dropped_documents"] += 1
+            print(f"Write-behind '{self.name}': buffer full, dropped a document.")
+            return False
+        self.stats["enqueued"] += 1
+        return True
+
+    def get_stats(self):
+        """Returns the counters of this buffer, including its current depth and mean flush time."""
+        stats = dict(self.stats, depth=self.queue.qsize())
+        stats["avg_flush_ms"] = round(stats.pop("total_flush_ms") / stats["batches"], 2) if stats["batches"] else 0.0
+        return stats
+
+    def pending(self):
+        """Returns a snapshot of the documents not yet persisted, oldest first."""
+        return list(self.in_flight or []) + [doc for _, doc in list(self.queue.queue)]
+
+    def _collect_batch(self):
+        """
+        Blocks for the first document, then gathers more until the batch is full or its deadline passes.
+        Returns the documents and the time the oldest of them was enqueued. The batch is exposed as
+        `in_flight` while it is gathered, so pending() and flush_all() see the documents taken so far.
+        """
+        enqueued_at, doc = self.queue.get()
+        batch = [doc]
+        self.in_flight = batch
+        deadline = time.monotonic() + self.max_delay
+        while len(batch) < self.max_batch:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            try:
+                batch.append(self.queue.get(timeout=remaining)[1])
+            except gevent.queue.Empty:
+                break
+        return batch, enqueued_at
+
+    def _flush(self, batch):
+        """Persists one batch, retrying with backoff. Returns True on success."""
+        for attempt in range(self.max_retries + 1):
+            started = time.monotonic()
+            try:
+                self.flush_fn(batch)
+            except Exception as e:
+                if attempt < self.max_retries:
+                    self.stats["retried_batches"] += 1
+                    print(f"Write-behind '{self.name}': flush of {len(batch)} documents failed ({e}). Retrying.")
+                    gevent.sleep(0.1 * (2 ** attempt))
+                    continue
+                self.stats["dropped_batches"] += 1
+                self.stats["dropped_documents"] += len(batch)
+                print(f"Write-behind '{self.name}': dropped a batch of {len(batch)} documents after {self.max_retries} retries: {e}")
+                if self.on_drop:
+                    self.on_drop(batch)
+                return False
+            flush_ms = (time.monotonic() - started) * 1000
+            self.stats["flushed"] += len(batch)
+            self.stats["batches"] += 1
+            self.stats["last_flush_ms"] = round(flush_ms, 2)
+            self.stats["max_flush_ms"] = max(self.stats["max_flush_ms"], round(flush_ms, 2))
+            self.stats["total_flush_ms"] += flush_ms
+            return True
+        return False
+
+    def _run(self):
+        """Background loop: collect a batch, flush it, repeat."""
+        while True:
+            batch, enqueued_at = self._collect_batch()
+            try:
+                if self._flush(batch):
+                    latency_ms = round((time.monotonic() - enqueued_at) * 1000, 2)
+                    self.stats["last_latency_ms"] = latency_ms
+                    self.stats["max_latency_ms"] = max(self.stats["max_latency_ms"], latency_ms)
+            finally:
+                self.in_flight = None
+
+    def flush_all(self):
+        """
+        Synchronously persists everything still buffered, including a batch that was
+        mid-flush. Called on shutdown so a graceful stop loses no documents.
+        """
+        pending = list(self.in_flight or [])
+        while True:
+            try:
+                pending.append(self.queue.get_nowait()[1])
+            except gevent.queue.Empty:
+                break
+        for start in range(0, len(pending), self.max_batch):
+            self._flush(pending[start:start + self.max_batch])
+        if pending:
+            print(f"Write-behind '{self.name}': flushed {len(pending)} buffered documents on shutdown.")
+
+def insert_many_idempotent(collection, docs):
+    """
+    Inserts a batch of documents, treating duplicate-key errors as already written.
+    PyMongo assigns each document an '_id' on the first attempt, so a retried batch
+    is recognised instead of being stored twice.
+    """
+    try:
+        collection.insert_many(docs, ordered=False)
+    except BulkWriteError as e:
+        if e.details.get('writeConcernErrors') or any(err.get('code') != 11000 for err in e.details.get('writeErrors', [])):
+            raise
+
+# --- Whiteboard Stroke Codec ---
+# Optional compact storage format for pen/eraser strokes. Point coordinates (ratios of the
+# canvas size, 0-1) are quantized to an integer grid, delta-encoded and packed as zigzag
+# varints into a BSON binary 'points' field. Items are decoded transparently whenever
+# whiteboard history is served, so clients always receive plain point arrays.
+
+# Enables encoding of newly stored strokes.
+WHITEBOARD_STROKE_CODEC = os.environ.get('WHITEBOARD_STROKE_CODEC', 'false').lower() == 'true'
+# Grid resolution for coordinates: 10000 steps across the canvas is sub-pixel even on 4K displays.
+WHITEBOARD_STROKE_GRID = 10000
+# Pen widths are stored in hundredths.
+WHITEBOARD_WIDTH_SCALE = 100
+# Version marker stored next to encoded points.
+WHITEBOARD_STROKE_CODEC_VERSION = 1
+
+def _write_varint(buffer, value):
+    """Appends a zigzag-encoded signed integer to `buffer` as a base-128 varint."""
+    value = (value << 1) ^ (value >> 63)
+    while value > 0x7F:
+        buffer.append((value & 0x7F) | 0x80)
+        value >>= 7
+    buffer.append(value)
+
+def _read_varint(data, offset):
+    """Reads a zigzag varint from `data` at `offset`. Returns (value, next offset)."""
+    result = 0
+    shift = 0
+    while True:
+        byte = data[offset]
+        offset += 1
+        result |= (byte & 0x7F) << shift
+        if not byte & 0x80:
+            break
+        shift += 7
+    return (result >> 1) ^ -(result & 1), offset
+
+def encode_stroke_points(points):
+    """
+    Packs a list of {x, y[, width]} points into the compact binary format.
+
+    Args:
+        points (list): The stroke points as sent by the browser.
+
+    Returns:
+        bytes: The encoded points, or None if the points cannot be encoded losslessly
+               enough (unexpected keys, non-numeric values, mixed width presence).
+    """
+    if not isinstance(points, list) or not points:
+        return None
+    has_width = 'width' in points[0] if isinstance(points[0], dict) else False
+    buffer = bytearray()
+    _write_varint(buffer, len(points))
+    buffer.append(1 if has_width else 0)
+    previous = [0, 0, 0]
+    for point in points:
+        if not isinstance(point, dict) or ('width' in point) != has_width or set(point) - {'x', 'y', 'width'}:
+            return None
+        values = [point.get('x'), point.get('y')] + ([point.get('width')] if has_width else [])
+        if not all(isinstance(v, (int, float)) and not isinstance(v, bool) and math.isfinite(v) for v in values):
+            return None
+        quantized = [round(values[0] * WHITEBOARD_STROKE_GRID), round(values[1] * WHITEBOARD_STROKE_GRID)]
+        if has_width:
+            quantized.append(round(values[2] * WHITEBOARD_WIDTH_SCALE))
+        for i, value in enumerate(quantized):
+            _write_varint(buffer, value - previous[i])
+            previous[i] = value
+    return bytes(buffer)
+
+def decode_stroke_points(data):
+    """
+    Unpacks points produced by `encode_stroke_points`.
+
+    Args:
+        data (bytes): The encoded points.
+
+    Returns:
+        list: Points as {x, y[, width]} dicts with coordinates as canvas ratios.
+    """
+    count, offset = _read_varint(data, 0)
+    has_width = bool(data[offset])
+    offset += 1
+    points = []
+    current = [0, 0, 0]
+    for _ in range(count):
+        for i in range(3 if has_width else 2):
+            delta, offset = _read_varint(data, offset)
+            current[i] += delta
+        point = {"x": current[0] / WHITEBOARD_STROKE_GRID, "y": current[1] / WHITEBOARD_STROKE_GRID}
+        if has_width:
+            point["width"] = current[2] / WHITEBOARD_WIDTH_SCALE
+        points.append(point)
+    return points
+
+def encode_whiteboard_item(item):
+    """
+    Returns a copy of a drawing command with its stroke points in the compact format.
+    Items without encodable points (shapes, text, already-encoded strokes) are returned unchanged.
+    """
+    if not isinstance(item, dict) or item.get('pointsCodec') or not isinstance(item.get('points'), list):
+        return item
+    packed = encode_stroke_points(item['points'])
+    if packed is None:
+        return item
+    return dict(item, points=Binary(packed), pointsCodec=WHITEBOARD_STROKE_CODEC_VERSION)
+
+def decode_whiteboard_item(item):
+    """
+    Returns a drawing command in the format the browser sent it, decoding compact stroke points if needed.
+    """
+    if not isinstance(item, dict) or not item.get('pointsCodec'):
+        return item
+    decoded = {k: v for k, v in item.items() if k != 'pointsCodec'}
+    decoded['points'] = decode_stroke_points(bytes(item['points']))
+    return decoded
+
+# --- Whiteboard Stroke Simplification ---
+# Freehand strokes carry one point per mousemove. When enabled, strokes are simplified with the
+# Ramer-Douglas-Peucker algorithm before they are persisted and when pages are compacted:
+# points closer than the tolerance to the simplified polyline are dropped.
+
+# Enables simplification of stored strokes.
+WHITEBOARD_SIMPLIFY_STROKES = os.environ.get('WHITEBOARD_SIMPLIFY_STROKES', 'false').lower() == 'true'
+# Maximum deviation, as a ratio of the canvas size (0.0003 is about one pixel on a 4K-wide canvas).
+WHITEBOARD_SIMPLIFY_TOLERANCE = float(os.environ.get('WHITEBOARD_SIMPLIFY_TOLERANCE', 0.0003))
+
+# Point counts before and after simplification, reported by /api/metrics.
+whiteboard_simplify_stats = {"strokes": 0, "points_in": 0, "points_out": 0}
+
+def simplify_polyline(coords, tolerance):
+    """
+    Ramer-Douglas-Peucker simplification of a polyline, vectorized per segment with NumPy.
+
+    Args:
+        coords (numpy.ndarray): An (N, 2) array of point coordinates.
+        tolerance (float): Maximum allowed distance of a dropped point from the simplified line.
+
+    Returns:
+        numpy.ndarray: A boolean mask of the points to keep (the endpoints are always kept).
+    """
+    count = len(coords)
+    keep = np.zeros(count, dtype=bool)
+    keep[0] = keep[-1] = True
+    stack = [(0, count - 1)]
+    while stack:
+        start, end = stack.pop()
+        if end - start < 2:
+            continue
+        segment = coords[end] - coords[start]
+        offsets = coords[start + 1:end] - coords[start]
+        length = np.hypot(segment[0], segment[1])
+        if length == 0:
+            # Closed or degenerate segment: fall back to the distance from the start point.
+            distances = np.hypot(offsets[:, 0], offsets[:, 1])
+        else:
+            distances = np.abs(segment[0] * offsets[:, 1] - segment[1] * offsets[:, 0]) / length
+        farthest = int(np.argmax(distances))
+        if distances[farthest] > tolerance:
+            split = start + 1 + farthest
+            keep[split] = True
+            stack.append((start, split))
+            stack.append((split, end))
+    return keep
+
+def simplify_whiteboard_item(item, tolerance=None):
+    """
+    Returns a copy of a pen/eraser drawing command with redundant stroke points removed.
+    Other items, and strokes whose points are not plain numeric {x, y} dicts, are returned unchanged.
+    Strokes stored with the compact codec are decoded, simplified and encoded again.
+    """
+    if tolerance is None:
+        tolerance = WHITEBOARD_SIMPLIFY_TOLERANCE
+    if not isinstance(item, dict) or item.get('type') not in ('pen', 'eraser'):
+        return item
+    if item.get('pointsCodec'):
+        simplified = simplify_whiteboard_item(decode_whiteboard_item(item), tolerance)
+        return encode_whiteboard_item(simplified)
+
+    points = item.get('points')
+    if not isinstance(points, list) or len(points) <= 2:
+        return item
+    try:
+        coords = np.array([[point['x'], point['y']] for point in points], dtype=float)
+    except (KeyError, TypeError, ValueError):
+        return item
+    if not np.isfinite(coords).all():
+        return item
+
+    keep = simplify_polyline(coords, tolerance)
+    simplified_points = [point for point, kept in zip(points, keep) if kept]
+    whiteboard_simplify_stats["strokes"] += 1
+    whiteboard_simplify_stats["points_in"] += len(points)
+    whiteboard_simplify_stats["points_out"] += len(simplified_points)
+    return dict(item, points=simplified_points)
+
+def get_whiteboard_simplify_stats():
+    """Returns the simplification counters together with the achieved point-reduction ratio."""
+    points_in = whiteboard_simplify_stats["points_in"]
+    reduction = 1 - whiteboard_simplify_stats["points_out"] / points_in if points_in else 0.0
+    return dict(whiteboard_simplify_stats, enabled=WHITEBOARD_SIMPLIFY_STROKES,
+                tolerance=WHITEBOARD_SIMPLIFY_TOLERANCE, reduction_ratio=round(reduction, 4))
+
+# --- Whiteboard Checkpoints ---
+# Each whiteboard page keeps a materialized checkpoint (its reconstructed drawing commands)
+# in `whiteboard_checkpoints_collection`, together with the timestamp of the last action
+# folded into it ('through'). A history load then reads one checkpoint per page plus the
+# short tail of actions recorded after it, instead of replaying every stroke ever drawn.
+# Every action also carries a per-classroom sequence number ('seq'), so clients can ask
+# for just the actions newer than the cursor they already hold. Seqs are handed out by a Redis
+# counter when an action is broadcast but stored later by the write-behind buffer of whichever worker received
+# it, so a later seq can reach the database before an earlier one. Checkpoints ('through_seq')
+# and delta cursors therefore only advance up to the settled seq (see settled_whiteboard_seq).
+# Undo and redo are stored as small ops referencing a drawing command's 'actionId'; they
+# flag the command as undone (a tombstone) rather than removing it, so pages and
+# checkpoints keep undone commands and readers filter them out.
+
+# Number of uncheckpointed actions on a page after which a compaction is triggered.
+WHITEBOARD_CHECKPOINT_TAIL_LIMIT = int(os.environ.get('WHITEBOARD_CHECKPOINT_TAIL_LIMIT', 50))
+# A missing seq is given up as lost (e.g. its batch was dropped) once an action after it is this old.
+WHITEBOARD_SEQ_GAP_TIMEOUT_SECONDS = int(os.environ.get('WHITEBOARD_SEQ_GAP_TIMEOUT_SECONDS', 30))
+# Maximum number of actions returned by a delta sync before the client is told to reload in full.
+WHITEBOARD_DELTA_LIMIT = int(os.environ.get('WHITEBOARD_DELTA_LIMIT', 2000))
+# Write-behind batching of whiteboard actions: flush size, flush delay, buffer bound and retries.
+WHITEBOARD_WRITE_BATCH_SIZE = int(os.environ.get('WHITEBOARD_WRITE_BATCH_SIZE', 200))
+WHITEBOARD_WRITE_MAX_DELAY_MS = int(os.environ.get('WHITEBOARD_WRITE_MAX_DELAY_MS', 250))
+WHITEBOARD_WRITE_QUEUE_SIZE = int(os.environ.get('WHITEBOARD_WRITE_QUEUE_SIZE', 10000))
+WHITEBOARD_WRITE_MAX_RETRIES = int(os.environ.get('WHITEBOARD_WRITE_MAX_RETRIES', 3))
+
+# Whiteboard actions that reference an earlier 'draw' by its action id instead of carrying page state.
+WHITEBOARD_UNDO_OPS = ('undo', 'redo')
+# Highest number of pages a classroom whiteboard may have; actions on later page indexes are rejected.
+WHITEBOARD_MAX_PAGES = int(os.environ.get('WHITEBOARD_MAX_PAGES', 500))
+
+# Pages with actions that are not yet folded into their checkpoint, keyed by (classroomId, pageIndex).
+dirty_whiteboard_pages = set()
+# Per-page count of actions received by this worker since the last compaction trigger.
+pending_whiteboard_actions = {}
+
+# Redis key of a classroom's whiteboard seq counter. Redis hands out seqs on the broadcast path;
+# 'whiteboard_counters' only records the highest stored seq, so a lost key can be seeded again.
+WHITEBOARD_SEQ_KEY = 'whiteboard:seq:{}'
+# Increments a classroom's seq counter. With an empty floor it returns nil when the key is missing,
+# so the caller can read the floor from MongoDB; with a floor it first raises the counter to it.
+WHITEBOARD_SEQ_SCRIPT = """
+local current = redis.call('GET', KEYS[1])
+if ARGV[1] == '' then
+    if not current then return false end
+elseif not current or tonumber(current) < tonumber(ARGV[1]) then
+    redis.call('SET', KEYS[1], ARGV[1])
+end
+return redis.call('INCR', KEYS[1])
+"""
+whiteboard_seq_script = redis_client.register_script(WHITEBOARD_SEQ_SCRIPT)
+# Classrooms whose seqs came from the MongoDB fallback counter while Redis was unavailable.
+whiteboard_seq_fallback_classrooms = set()
+# Highest seq this worker handed out per classroom, the floor for the MongoDB fallback counter.
+whiteboard_seq_high = {}
+
+def whiteboard_seq_floor(classroom_id):
+    """
+    Returns the highest whiteboard seq of a classroom that is known to MongoDB: the recorded
+    counter or the newest stored action, whichever is higher.
+
+    Args:
+        classroom_id (str): The classroom to look up.
+
+    Returns:
+        int: The highest known seq (0 if the classroom has none).
+    """
+    counter = whiteboard_counters_collection.find_one({"classroomId": classroom_id}, {"_id": 0, "seq": 1})
+    newest = whiteboard_collection.find_one(
+        {"classroomId": classroom_id, "seq": {"$exists": True}}, {"_id": 0, "seq": 1}, sort=[("seq", -1)]
+    )
+    return max((counter or {}).get('seq', 0), (newest or {}).get('seq', 0), whiteboard_seq_high.get(classroom_id, 0))
+
+def allocate_whiteboard_seq(classroom_id):
+    """
+    Hands out the next whiteboard sequence number for a classroom with a Redis INCR, so seq
+    order matches broadcast order even when several workers serve the same room, without a
+    MongoDB round-trip per stroke. MongoDB is only read to seed a missing key (e.g. after a
+    Redis restart).
+
+    While Redis is unavailable the MongoDB counter is used instead, at the cost of one
+    find_one_and_update per action; Redis is raised to that counter once it is back. Seqs that
+    other workers still buffer when Redis fails can be handed out again in that window.
+
+    Args:
+        classroom_id (str): The classroom the action belongs to.
+
+    Returns:
+        int: The sequence number for the action.
+    """
+    key = WHITEBOARD_SEQ_KEY.format(classroom_id)
+    try:
+        floor = whiteboard_seq_floor(classroom_id) if classroom_id in whiteboard_seq_fallback_classrooms else ''
+        seq = whiteboard_seq_script(keys=[key], args=[floor])
+        if seq is None:
+            seq = whiteboard_seq_script(keys=[key], args=[whiteboard_seq_floor(classroom_id)])
+        whiteboard_seq_fallback_classrooms.discard(classroom_id)
+    except redis.RedisError as e:
+        print(f"Whiteboard seq counter unavailable for classroom {classroom_id}, using MongoDB: {e}")
+        whiteboard_seq_fallback_classrooms.add(classroom_id)
+        whiteboard_counters_collection.update_one(
+            {"classroomId": classroom_id}, {"$max": {"seq": whiteboard_seq_high.get(classroom_id, 0)}}, upsert=True
+        )
+        counter = whiteboard_counters_collection.find_one_and_update(
+            {"classroomId": classroom_id},
+            {"$inc": {"seq": 1}},
+            upsert=True,
+            return_document=ReturnDocument.AFTER
+        )
+        seq = counter['seq']
+    seq = int(seq)
+    whiteboard_seq_high[classroom_id] = max(whiteboard_seq_high.get(classroom_id, 0), seq)
+    return seq
+
+def record_whiteboard_seqs(batch):
+    """Raises each classroom's MongoDB counter to the highest seq in a stored batch of actions."""
+    highest = {}
+    for whiteboard_doc in batch:
+        highest[whiteboard_doc['classroomId']] = max(highest.get(whiteboard_doc['classroomId'], 0), whiteboard_doc['seq'])
+    if highest:
+        whiteboard_counters_collection.bulk_write([
+            UpdateOne({"classroomId": classroom_id}, {"$max": {"seq": seq}}, upsert=True)
+            for classroom_id, seq in highest.items()
+        ], ordered=False)
+
+def settled_whiteboard_seq(classroom_id, after, stored):
+    """
+    Returns the highest sequence number up to which a classroom's whiteboard actions are settled:
+    every seq in (after, result] is stored, or given up as lost. A gap in the stored seqs means an
+    earlier action is still in some worker's write-behind buffer; it holds the result back until
+    an action after it is WHITEBOARD_SEQ_GAP_TIMEOUT_SECONDS old, and for as long as this worker
+    still has the action queued.
+
+    Args:
+        classroom_id (str): The classroom whose actions are checked.
+        after (int): A seq known to be settled.
+        stored (list): Stored actions of the classroom with a seq above `after` ('seq', 'timestamp'), sorted by seq.
+
+    Returns:
+        int: The settled sequence number (at least `after`).
+    """
+    queued = [doc['seq'] for doc in whiteboard_write_behind.pending() if doc['classroomId'] == classroom_id and doc['seq'] > after]
+    limit = min(queued) - 1 if queued else None
+    cutoff = datetime.utcnow() - timedelta(seconds=WHITEBOARD_SEQ_GAP_TIMEOUT_SECONDS)
+    settled = after
+    for action_doc in stored:
+        if limit is not None and action_doc['seq'] > limit:
+            break
+        if action_doc['seq'] > settled + 1 and action_doc['timestamp'] > cutoff:
+            break
+        settled = action_doc['seq']
+    return settled
+
+def apply_whiteboard_action(page_items, action_doc):
+    """
+    Applies a single stored whiteboard action to a page's list of drawing commands.
+
+    Args:
+        page_items (list): The drawing commands of the page so far.
+        action_doc (dict): A whiteboard action document ('action', 'data', ...).
+
+    Returns:
+        list: The page's drawing commands after the action.
+    """
+    action_type = action_doc.get('action')
+    drawing_data = action_doc.get('data')
+
+    if action_type == 'draw' and drawing_data:
+        # For 'draw' actions, append the drawing data.
+        page_items.append(drawing_data)
+    elif action_type == 'clear':
+        # For 'clear' actions, clear all previous actions on that page.
+        page_items = []
+    elif action_type in WHITEBOARD_UNDO_OPS and drawing_data:
+        # Undo/redo ops toggle the tombstone of the drawing command they reference. The command stays
+        # on the page (hidden while undone), so a later redo can bring it back in its original place.
+        target_id = drawing_data.get('targetId')
+        for index in range(len(page_items) - 1, -1, -1):
+            item = page_items[index]
+            if isinstance(item, dict) and item.get('actionId') == target_id:
+                if action_type == 'undo':
+                    page_items[index] = dict(item, undone=True)
+                else:
+                    page_items[index] = {k: v for k, v in item.items() if k != 'undone'}
+                break
+    # Other actions (e.g., page_change itself) are not drawing commands, so not stored here.
+    return page_items
+
+def visible_whiteboard_items(page_items):
+    """Returns the drawing commands of a page that are not currently undone."""
+    return [item for item in page_items if not (isinstance(item, dict) and item.get('undone'))]
+
+def is_valid_whiteboard_action_id(action_id):
+    """Checks that a client-supplied whiteboard action id is a UUID string."""
+    if not isinstance(action_id, str):
+        return False
+    try:
+        uuid.UUID(action_id)
+    except ValueError:
+        return False
+    return True
+
+def is_valid_whiteboard_page_index(page_index):
+    """Checks that a client-supplied whiteboard page index is an int in [0, WHITEBOARD_MAX_PAGES)."""
+    return isinstance(page_index, int) and not isinstance(page_index, bool) and 0 <= page_index < WHITEBOARD_MAX_PAGES
+
+def write_whiteboard_checkpoint(classroom_id, page_index, items, through, through_seq, previous_through_seq):
+    """
+    Stores a page checkpoint, but only if nobody advanced it since it was read.
+
+    Args:
+        classroom_id (str): The classroom the page belongs to.
+        page_index (int): The whiteboard page index.
+        items (list): The materialized drawing commands of the page.
+        through (datetime): Timestamp of the newest action folded into `items`.
+        through_seq (int): Highest sequence number folded into `items` (0 for actions that predate sequencing).
+        previous_through_seq (int): The 'through_seq' value the caller based its work on (None if no checkpoint existed).
+
+    Returns:
+        bool: True if the checkpoint was written, False if a concurrent writer got there first.
+    """
+    # The unique (classroomId, pageIndex) index (see REQUIRED_INDEXES) guarantees that concurrent
+    # upserts from several workers cannot create two checkpoints for the same page.
+    try:
+        result = whiteboard_checkpoints_collection.update_one(
+            {"classroomId": classroom_id, "pageIndex": page_index, "through_seq": previous_through_seq},
+            {"$set": {"items": items, "through": through, "through_seq": through_seq, "updated_at": datetime.utcnow()}},
+            upsert=True
+        )
+    except DuplicateKeyError:
+        # The checkpoint exists with a different 'through_seq': another writer already advanced it.
+        return False
+    return result.matched_count > 0 or result.upserted_id is not None
+
+def compact_whiteboard_page(classroom_id, page_index):
+    """
+    Folds the settled tail of a page's actions into its checkpoint, in seq order.
+
+    Args:
+        classroom_id (str): The classroom the page belongs to.
+        page_index (int): The whiteboard page index.
+
+    Returns:
+        int: The number of actions folded into the checkpoint.
+    """
+    checkpoint = whiteboard_checkpoints_collection.find_one(
+        {"classroomId": classroom_id, "pageIndex": page_index},
+        {"_id": 0, "items": 1, "through": 1, "through_seq": 1}
+    )
+    items = checkpoint.get('items', []) if checkpoint else []
+    previous_through = checkpoint.get('through') if checkpoint else None
+    previous_through_seq = checkpoint.get('through_seq') if checkpoint else None
+    through_seq = previous_through_seq or 0
+
+    # Only fold up to the settled seq, so an earlier action still waiting to be stored is never skipped.
+    settled = settled_whiteboard_seq(classroom_id, through_seq, list(whiteboard_collection.find(
+        {"classroomId": classroom_id, "seq": {"$gt": through_seq}}, {"_id": 0, "seq": 1, "timestamp": 1}
+    ).sort("seq", 1)))
+    # Actions stored before sequencing have no seq; they are all older than the sequenced ones.
+    legacy_filter = {"seq": {"$exists": False}}
+    if previous_through is not None:
+        legacy_filter["timestamp"] = {"$gt": previous_through}
+
+    tail = list(whiteboard_collection.find(
+        {"classroomId": classroom_id, "pageIndex": page_index,
+         "$or": [{"seq": {"$gt": through_seq, "$lte": settled}}, legacy_filter]},
+        {"_id": 0, "action": 1, "data": 1, "timestamp": 1, "seq": 1}
+    ).sort([("seq", 1), ("timestamp", 1)]))
+    if not tail:
+        return 0
+
+    through = previous_through
+    for action_doc in tail:
+        if WHITEBOARD_SIMPLIFY_STROKES and action_doc.get('action') == 'draw':
+            action_doc['data'] = simplify_whiteboard_item(action_doc.get('data'))
+        items = apply_whiteboard_action(items, action_doc)
+        through_seq = max(through_seq, action_doc.get('seq', 0))
+        through = action_doc['timestamp'] if through is None else max(through, action_doc['timestamp'])
+
+    if not write_whiteboard_checkpoint(classroom_id, page_index, items, through, through_seq, previous_through_seq):
+        print(f"Whiteboard checkpoint for classroom {classroom_id}, page {page_index} was advanced concurrently. Skipping.")
+        return 0
+
+    print(f"Compacted {len(tail)} whiteboard actions into checkpoint for classroom {classroom_id}, page {page_index}.")
+    return len(tail)
+
+def record_whiteboard_action(classroom_id, page_index, action, timestamp, seq):
+    """
+    Keeps page checkpoints up to date after a whiteboard action has been stored.
+    A 'clear' resets the checkpoint right away; 'draw' actions accumulate in the tail
+    until it is long enough to be compacted.
+
+    Args:
+        classroom_id (str): The classroom the page belongs to.
+        page_index (int): The whiteboard page index.
+        action (str): The action type ('draw', 'clear', ...).
+        timestamp (datetime): The timestamp the action was stored with.
+        seq (int): The sequence number the action was stored with.
+    """
+    page_key = (classroom_id, page_index)
+
+    if action == 'clear':
+        # Nothing before a clear can ever be visible again, so the checkpoint can jump straight to it.
+        checkpoint = whiteboard_checkpoints_collection.find_one(
+            {"classroomId": classroom_id, "pageIndex": page_index},
+            {"_id": 0, "through_seq": 1}
+        )
+        previous_through_seq = checkpoint.get('through_seq') if checkpoint else None
+        if previous_through_seq is None or previous_through_seq < seq:
+            write_whiteboard_checkpoint(classroom_id, page_index, [], timestamp, seq, previous_through_seq)
+        pending_whiteboard_actions.pop(page_key, None)
+        return
+
+    dirty_whiteboard_pages.add(page_key)
+    pending_whiteboard_actions[page_key] = pending_whiteboard_actions.get(page_key, 0) + 1
+    if pending_whiteboard_actions[page_key] >= WHITEBOARD_CHECKPOINT_TAIL_LIMIT:
+        pending_whiteboard_actions[page_key] = 0
+        gevent.spawn(compact_whiteboard_page, classroom_id, page_index)
+
+def load_whiteboard_pages(classroom_id, queued_actions=()):
+    """
+    Reconstructs every whiteboard page of a classroom from the page checkpoints plus
+    the actions recorded after each checkpoint. Pages whose tail has grown long
+    (e.g. classrooms that predate checkpoints) are queued for background compaction.
+
+    Args:
+        classroom_id (str): The classroom whose whiteboard should be reconstructed.
+        queued_actions (iterable): Action documents from the write-behind buffer, snapshotted before this
+            call. Those not found in a checkpoint or the stored tail are merged in by seq, so a batch
+            flushed while the database is being read is neither lost nor applied twice.
+
+    Returns:
+        tuple: (list of pages, each page being an array of drawing commands including
+                undone ones flagged with 'undone',
+                int cursor: the highest sequence number reflected in the pages,
+                int settled: the cursor clamped to the settled seq, see settled_whiteboard_seq,
+                set: the sequence numbers above `settled` reflected in the pages).
+    """
+    checkpoints = list(whiteboard_checkpoints_collection.find(
+        {"classroomId": classroom_id},
+        {"_id": 0, "pageIndex": 1, "items": 1, "through": 1, "through_seq": 1}
+    ))
+
+    pages_data = {} # Dictionary to hold drawing commands for each page index.
+    cursor = 0
+    tail_filters = []
+    checkpointed_seqs = {} # Highest seq folded into each page's checkpoint.
+    for checkpoint in checkpoints:
+        pages_data[checkpoint['pageIndex']] = checkpoint.get('items', [])
+        checkpointed_seqs[checkpoint['pageIndex']] = checkpoint.get('through_seq', 0)
+        cursor = max(cursor, checkpoint.get('through_seq', 0))
+        tail_filters.append({"pageIndex": checkpoint['pageIndex'], "$or": [
+            {"seq": {"$gt": checkpoint.get('through_seq', 0)}},
+            {"seq": {"$exists": False}, "timestamp": {"$gt": checkpoint['through']}} # Actions that predate sequencing.
+        ]})
+    # Pages without a checkpoint are replayed from their full action log.
+    tail_filters.append({"pageIndex": {"$nin": list(pages_data.keys())}})
+
+    # Fetch the uncheckpointed actions in seq order (unsequenced, older actions first, by timestamp).
+    tail_actions = list(whiteboard_collection.find(
+        {"classroomId": classroom_id, "$or": tail_filters},
+        {"_id": 0, "action": 1, "data": 1, "pageIndex": 1, "timestamp": 1, "seq": 1} # Project only necessary fields.
+    ).sort([("seq", 1), ("timestamp", 1)]))
+
+    stored_seqs = {action_doc.get('seq') for action_doc in tail_actions}
+    # Every checkpoint only reaches a settled seq, and the tail holds every stored seq above the highest one.
+    settled_base = max(checkpointed_seqs.values(), default=0)
+    settled_stored = [action_doc for action_doc in tail_actions if (action_doc.get('seq') or 0) > settled_base]
+    queued = [
+        whiteboard_doc for whiteboard_doc in queued_actions
+        if whiteboard_doc['classroomId'] == classroom_id and whiteboard_doc['seq'] not in stored_seqs
+        and whiteboard_doc['seq'] > checkpointed_seqs.get(whiteboard_doc['pageIndex'], 0)
+    ]
+    if queued:
+        # Unsequenced (legacy) actions sort first by timestamp, then everything by seq.
+        tail_actions = sorted(tail_actions + queued, key=lambda action_doc: (
+            action_doc.get('seq') is not None, action_doc.get('seq') or 0, action_doc['timestamp']))
+
+    max_page_index = max(pages_data.keys(), default=0)
+    tail_lengths = {}
+    for action_doc in tail_actions:
+        page_index = action_doc.get('pageIndex', 0) # Default to page 0 if not specified.
+        max_page_index = max(max_page_index, page_index) # Keep track of highest page index.
+        pages_data[page_index] = apply_whiteboard_action(pages_data.get(page_index, []), action_doc)
+        tail_lengths[page_index] = tail_lengths.get(page_index, 0) + 1
+        cursor = max(cursor, action_doc.get('seq', 0))
+
+    for page_index, tail_length in tail_lengths.items():
+        if tail_length >= WHITEBOARD_CHECKPOINT_TAIL_LIMIT:
+            dirty_whiteboard_pages.add((classroom_id, page_index))
+
+    # Ensure all pages up to max_page_index are included, even if empty.
+    # Stroke points stored in the compact codec are decoded here, so callers always see plain items.
+    pages = [[decode_whiteboard_item(item) for item in pages_data.get(i, [])] for i in range(max_page_index + 1)]
+    settled = min(cursor, settled_whiteboard_seq(classroom_id, settled_base, settled_stored))
+    seqs = {action_doc['seq'] for action_doc in tail_actions if (action_doc.get('seq') or 0) > settled}
+    return pages, cursor, settled, seqs
+
+def load_whiteboard_delta(classroom_id, since, page_index=None):
+    """
+    Collects the whiteboard actions recorded after a client's cursor, grouped by page.
+    When a 'clear' is among them, everything before it is dropped and the page is
+    flagged with a reset marker, so the client replaces the page instead of appending.
+    Undo/redo ops are passed through by id; a redo also carries the drawing command it
+    restores, since a client that loaded the page while it was undone never received it.
+
+    Args:
+        classroom_id (str): The classroom whose whiteboard is being synced.
+        since (int): The last sequence number the client has applied.
+        page_index (int, optional): Restrict the delta to a single page.
+
+    Returns:
+        dict: {"cursor", "pages": [{"pageIndex", "reset", "actions"}]}, or {"cursor", "full": True}
+              when the delta is too large and the client should reload the full history instead.
+              The cursor stops at the settled seq, so actions past it may be sent again by the next
+              delta (clients skip seqs they already applied).
+    """
+    query = {"classroomId": classroom_id, "seq": {"$gt": since}}
+    if page_index is not None:
+        query["pageIndex"] = page_index
+
+    actions = list(whiteboard_collection.find(
+        query,
+        {"_id": 0, "action": 1, "data": 1, "pageIndex": 1, "seq": 1, "timestamp": 1}
+    ).sort("seq", 1).limit(WHITEBOARD_DELTA_LIMIT + 1))
+
+    if len(actions) > WHITEBOARD_DELTA_LIMIT:
+        return {"cursor": since, "full": True}
+
+    # Settling needs every page's seqs; a single-page delta looks them up separately.
+    stored = actions if page_index is None else list(whiteboard_collection.find(
+        {"classroomId": classroom_id, "seq": {"$gt": since}}, {"_id": 0, "seq": 1, "timestamp": 1}
+    ).sort("seq", 1))
+    cursor = settled_whiteboard_seq(classroom_id, since, stored)
+
+    pages = {}
+    for action_doc in actions:
+        page = pages.setdefault(action_doc.get('pageIndex', 0), {"reset": False, "actions": []})
+        if action_doc.get('action') == 'clear':
+            # A clear makes everything before it irrelevant: tell the client to start the page over.
+            page["reset"] = True
+            page["actions"] = []
+        elif action_doc.get('action') == 'draw' and action_doc.get('data'):
+            page["actions"].append({"action": "draw", "data": decode_whiteboard_item(action_doc['data']), "seq": action_doc['seq']})
+        elif action_doc.get('action') in WHITEBOARD_UNDO_OPS and action_doc.get('data'):
+            page["actions"].append({"action": action_doc['action'], "data": dict(action_doc['data']), "seq": action_doc['seq']})
+
+    # Attach the restored drawing commands to redo ops in a single lookup (draw documents use the action id as 'id').
+    redos = [entry for page in pages.values() for entry in page["actions"] if entry["action"] == 'redo']
+    if redos:
+        restored = {
+            whiteboard_doc['id']: decode_whiteboard_item(whiteboard_doc['data'])
+            for whiteboard_doc in whiteboard_collection.find(
+                {"classroomId": classroom_id, "action": "draw", "id": {"$in": [entry["data"].get('targetId') for entry in redos]}},
+                {"_id": 0, "id": 1, "data": 1}
+            )
+        }
+        for entry in redos:
+            if entry["data"].get('targetId') in restored:
+                entry["data"]["item"] = restored[entry["data"]['targetId']]
+
+    return {
+        "cursor": cursor,
+        "pages": [dict(pageIndex=index, **page) for index, page in sorted(pages.items())]
+    }
+
+def compact_whiteboard_checkpoints():
+    """
+    Scheduled job that folds the tails of all dirty whiteboard pages into their checkpoints.
+    """
+    pages = list(dirty_whiteboard_pages)
+    dirty_whiteboard_pages.clear()
+    compacted = 0
+    for classroom_id, page_index in pages:
+        try:
+            compacted += compact_whiteboard_page(classroom_id, page_index)
+        except Exception as e:
+            # Keep the page dirty so the next run retries it.
+            dirty_whiteboard_pages.add((classroom_id, page_index))
+            print(f"Error compacting whiteboard page {page_index} of classroom {classroom_id}: {e}")
+    if pages:
+        print(f"[{datetime.utcnow()}] Whiteboard compaction folded {compacted} actions across {len(pages)} pages.")
+
+# Compacts dirty whiteboard pages every 30 seconds.
+scheduler.add_job(compact_whiteboard_checkpoints, 'interval', seconds=30)
+
+def persist_whiteboard_actions(batch):
+    """
+    Flush function of the whiteboard write-behind buffer: stores a batch of whiteboard
+    action documents with a single insert_many and then updates the page checkpoints.
+    Strokes are simplified and packed with the compact codec first when
+    WHITEBOARD_SIMPLIFY_STROKES / WHITEBOARD_STROKE_CODEC are enabled.
+    """
+    for whiteboard_doc in batch:
+        if whiteboard_doc['action'] != 'draw':
+            continue
+        if WHITEBOARD_SIMPLIFY_STROKES and not whiteboard_doc.get('simplified'):
+            whiteboard_doc['data'] = simplify_whiteboard_item(whiteboard_doc['data'])
+            whiteboard_doc['simplified'] = True # Retried batches must not be counted twice.
+        if WHITEBOARD_STROKE_CODEC:
+            whiteboard_doc['data'] = encode_whiteboard_item(whiteboard_doc['data'])
+    insert_many_idempotent(whiteboard_collection, batch)
+    record_whiteboard_seqs(batch)
+    for whiteboard_doc in batch:
+        record_whiteboard_action(whiteboard_doc['classroomId'], whiteboard_doc['pageIndex'],
+                                 whiteboard_doc['action'], whiteboard_doc['timestamp'], whiteboard_doc['seq'])
+
+# Write-behind buffer for whiteboard actions: handlers broadcast first and persistence happens in batches.
+whiteboard_write_behind = WriteBehindQueue(
+    'whiteboard_actions',
+    persist_whiteboard_actions,
+    max_batch=WHITEBOARD_WRITE_BATCH_SIZE,
+    max_delay=WHITEBOARD_WRITE_MAX_DELAY_MS / 1000.0,
+    max_queue=WHITEBOARD_WRITE_QUEUE_SIZE,
+    max_retries=WHITEBOARD_WRITE_MAX_RETRIES
+)
+whiteboard_write_behind.start()
+# Persist whatever is still buffered when the worker shuts down gracefully.
+atexit.register(whiteboard_write_behind.flush_all)
+
+# --- Whiteboard Page Cache ---
+# Maximum approximate memory used by cached whiteboard pages, in bytes.
+WHITEBOARD_PAGE_CACHE_MAX_BYTES = int(os.environ.get('WHITEBOARD_PAGE_CACHE_MAX_BYTES', 64 * 1024 * 1024))
+# Seconds after which a cached classroom is reloaded from the database (bounds staleness across workers).
+WHITEBOARD_PAGE_CACHE_TTL = int(os.environ.get('WHITEBOARD_PAGE_CACHE_TTL', 300))
+
+class WhiteboardPageCache:
+    """
+    Per-process cache of reconstructed whiteboard pages keyed by (classroomId, pageIndex).
+
+    A classroom is served from the cache only when all of its pages are present. The socket
+    handlers apply new actions to cached pages in place, so the cache stays authoritative for
+    this worker (including actions still waiting in the write-behind buffer). Pages are evicted
+    in least-recently-used order once the approximate memory bound is exceeded; evicting one
+    page drops the rest of its classroom, which has to be reloaded as a whole.
+    """
+
+    def __init__(self, max_bytes, ttl):
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.pages = OrderedDict() # (classroomId, pageIndex) -> {"items": [...], "bytes": int, "version": int}
+        # classroomId -> {"page_count": int, "cursor": int, "settled": int, "seqs": set of seqs above 'settled', "loaded_at": float}
+        self.classrooms = {}
+        self.bytes = 0
+        self.stats = {"hits": 0, "misses": 0, "evictions": 0, "expirations": 0}
+
+    @staticmethod
+    def _item_size(item):
+        """Approximates the memory held by one drawing command by its JSON size."""
+        return len(json.dumps(item, default=str))
+
+    def _fresh_meta(self, classroom_id):
+        """Returns the metadata of a cached classroom, dropping it first if it outlived the TTL."""
+        meta = self.classrooms.get(classroom_id)
+        if meta and time.monotonic() - meta["loaded_at"] > self.ttl:
+            self.stats["expirations"] += 1
+            self.invalidate_classroom(classroom_id)
+            meta = None
+        return meta
+
+    def get_page(self, classroom_id, page_index):
+        """
+        Returns (items, version) for one page of a fully cached classroom, or None on a miss.
+        The version is the sequence number of the last action applied to the page (or the
+        classroom cursor at load time), so it changes whenever the page does.
+        """
+        meta = self._fresh_meta(classroom_id)
+        if not meta or page_index >= meta["page_count"]:
+            self.stats["misses"] += 1
+            return None
+        key = (classroom_id, page_index)
+        self.pages.move_to_end(key)
+        self.stats["hits"] += 1
+        return list(self.pages[key]["items"]), self.pages[key]["version"]
+
+    def get_classroom(self, classroom_id):
+        """
+        Returns (pages, cursor, settled, seqs) for a fully cached classroom, or None on a miss.
+        The returned pages are copies, so callers may serialize them freely.
+        """
+        meta = self._fresh_meta(classroom_id)
+        if not meta:
+            self.stats["misses"] += 1
+            return None
+        pages = []
+        for page_index in range(meta["page_count"]):
+            key = (classroom_id, page_index)
+            self.pages.move_to_end(key)
+            pages.append(list(self.pages[key]["items"]))
+        self.stats["hits"] += 1
+        return pages, meta["cursor"], meta["settled"], meta["seqs"]
+
+    def put_classroom(self, classroom_id, pages, cursor, settled, seqs):
+        """Stores all pages of a classroom, replacing whatever was cached for it."""
+        self.invalidate_classroom(classroom_id)
+        self.classrooms[classroom_id] = {"page_count": len(pages), "cursor": cursor, "settled": settled, "seqs": set(seqs),
+                                         "loaded_at": time.monotonic()}
+        for page_index, items in enumerate(pages):
+            size = sum(self._item_size(item) for item in items)
+            self.pages[(classroom_id, page_index)] = {"items": list(items), "bytes": size, "version": cursor}
+            self.bytes += size
+        self._evict()
+
+    def apply_action(self, classroom_id, page_index, action, drawing_data, seq):
+        """
+        Applies a live whiteboard action to a cached classroom. Classrooms that are not
+        cached are left alone; they are loaded from the database on their next read.
+        """
+        meta = self.classrooms.get(classroom_id)
+        if not meta:
+            return
+        # Any action on a page beyond the known ones creates the pages up to it, like history reconstruction does.
+        while meta["page_count"] <= page_index:
+            self.pages[(classroom_id, meta["page_count"])] = {"items": [], "bytes": 0, "version": seq or 0}
+            meta["page_count"] += 1
+        page = self.pages[(classroom_id, page_index)]
+        if action == 'draw' and drawing_data:
+            size = self._item_size(drawing_data)
+            page["items"].append(drawing_data)
+            page["bytes"] += size
+            self.bytes += size
+        elif action == 'clear':
+            self.bytes -= page["bytes"]
+            page["items"] = []
+            page["bytes"] = 0
+        elif action in WHITEBOARD_UNDO_OPS:
+            # Tombstones only flip a flag on an existing item, so the page size is left as is.
+            apply_whiteboard_action(page["items"], {"action": action, "data": drawing_data})
+        page["version"] = max(page["version"], seq or 0)
+        self.pages.move_to_end((classroom_id, page_index))
+        meta["cursor"] = max(meta["cursor"], seq or 0)
+        if seq and seq > meta["settled"]:
+            meta["seqs"].add(seq)
+        self._evict()
+
+    def set_settled(self, classroom_id, settled):
+        """Records a newer settled seq for a cached classroom, the starting point of its next settling."""
+        meta = self.classrooms.get(classroom_id)
+        if meta and settled > meta["settled"]:
+            meta["settled"] = settled
+            meta["seqs"] = {seq for seq in meta["seqs"] if seq > settled}
+
+    def find_item(self, classroom_id, page_index, action_id):
+        """
+        Returns the cached drawing command with the given action id (undone or not), or None.
+        Returns None as well when the classroom is not cached.
+        """
+        page = self.pages.get((classroom_id, page_index))
+        if not page:
+            return None
+        for item in reversed(page["items"]):
+            if isinstance(item, dict) and item.get('actionId') == action_id:
+                return {k: v for k, v in item.items() if k != 'undone'}
+        return None
+
+    def invalidate_classroom(self, classroom_id):
+        """Drops every cached page of a classroom. Returns the number of pages dropped."""
+        meta = self.classrooms.pop(classroom_id, None)
+        if not meta:
+            return 0
+        dropped = 0
+        for page_index in range(meta["page_count"]):
+            page = self.pages.pop((classroom_id, page_index), None)
+            if page:
+                self.bytes -= page["bytes"]
+                dropped += 1
+        return dropped
+
+    def _evict(self):
+        """Evicts least recently used pages (with the rest of their classroom) until under the memory bound."""
+        while self.bytes > self.max_bytes and self.pages:
+            (classroom_id, _), page = self.pages.popitem(last=False)
+            self.bytes -= page["bytes"]
+            self.stats["evictions"] += 1
+            # The classroom is incomplete now; drop its remaining pages as well.
+            self.stats["evictions"] += self.invalidate_classroom(classroom_id)
+
+    def get_stats(self):
+        """Returns hit/miss/eviction counters and the current footprint of the cache."""
+        lookups = self.stats["hits"] + self.stats["misses"]
+        return dict(self.stats, pages=len(self.pages), classrooms=len(self.classrooms), bytes=self.bytes,
+                    max_bytes=self.max_bytes, hit_rate=round(self.stats["hits"] / lookups, 4) if lookups else 0.0)
+
+whiteboard_page_cache = WhiteboardPageCache(WHITEBOARD_PAGE_CACHE_MAX_BYTES, WHITEBOARD_PAGE_CACHE_TTL)
+
+def get_whiteboard_pages(classroom_id):
+    """
+    Returns (pages, cursor, settled) for a classroom's whiteboard, served from the page cache when possible.
+    On a miss the pages are reconstructed from checkpoints, completed with the actions still waiting
+    in the write-behind buffer, and cached. Undone drawing commands are left out of the returned pages.
+    `cursor` is the highest seq in the pages (their version); `settled` is the cursor to give clients,
+    which stays below actions that another worker has not stored yet or this worker's cache missed.
+    """
+    cached = whiteboard_page_cache.get_classroom(classroom_id)
+    if cached:
+        pages, cursor, settled, seqs = cached
+        # Live actions moved the cached cursor on; settle it again against what is stored by now.
+        stored = list(whiteboard_collection.find(
+            {"classroomId": classroom_id, "seq": {"$gt": settled, "$lte": cursor}}, {"_id": 0, "seq": 1, "timestamp": 1}
+        ).sort("seq", 1)) if cursor > settled else []
+        if all(action_doc['seq'] in seqs for action_doc in stored):
+            settled = min(cursor, settled_whiteboard_seq(classroom_id, settled, stored))
+            whiteboard_page_cache.set_settled(classroom_id, settled)
+            return [visible_whiteboard_items(items) for items in pages], cursor, settled
+        # Another worker stored an action below the cursor that the cached pages lack: load them again.
+        whiteboard_page_cache.invalidate_classroom(classroom_id)
+
+    # Snapshot the buffer before reading the database: a batch flushed during the read is then still
+    # in the snapshot, and load_whiteboard_pages skips whatever the read did pick up.
+    queued_actions = whiteboard_write_behind.pending()
+    pages, cursor, settled, seqs = load_whiteboard_pages(classroom_id, queued_actions)
+
+    whiteboard_page_cache.put_classroom(classroom_id, pages, cursor, settled, seqs)
+    return [visible_whiteboard_items(items) for items in pages], cursor, settled
+
+# --- Whiteboard Broadcast Batching ---
+# Milliseconds over which whiteboard events are coalesced into one frame per client (0 sends every event immediately).
+WHITEBOARD_BROADCAST_TICK_MS = int(os.environ.get('WHITEBOARD_BROADCAST_TICK_MS', 25))
+
+def whiteboard_batched_room(classroom_id):
+    """Socket.IO room of the classroom's clients that accept 'whiteboard_batch' frames."""
+    return f"{classroom_id}:whiteboard-batched"
+
+def whiteboard_legacy_room(classroom_id):
+    """Socket.IO room of the classroom's clients that expect one event per whiteboard update."""
+    return f"{classroom_id}:whiteboard-legacy"
+
+class WhiteboardBroadcaster:
+    """
+    Per-room outbound batcher for whiteboard events.
+
+    Clients that announced batching support on 'join' receive the events of a room as a single
+    'whiteboard_batch' frame per tick, in the order they were published. Older clients keep
+    receiving every event immediately under its original name. Events that must not be echoed to
+    their sender carry the sender's SID in the frame, and the client skips them.
+    """
+
+    def __init__(self, tick):
+        self.tick = tick
+        self.pending = {} # classroomId -> list of {"event", "data", "skipSid"} waiting for the next tick
+        self.stats = {"events": 0, "frames": 0, "frames_saved": 0, "immediate_events": 0}
+
+    @staticmethod
+    def _recipient_count(room):
+        """Number of clients currently in a room on this worker."""
+        return sum(1 for _ in socketio.server.manager.get_participants('/', room))
+
+    def publish(self, classroom_id, event, data, skip_sid=None):
+        """
+        Sends a whiteboard event to a classroom.
+
+        Args:
+            classroom_id (str): Classroom whose participants receive the event.
+            event (str): Original event name, e.g. 'whiteboard_data'.
+            data (dict): Event payload.
+            skip_sid (str, optional): SID of the sender when it must not receive its own event.
+        """
+        # Clients without batching support are served straight away, exactly as before.
+        socketio.emit(event, data, room=whiteboard_legacy_room(classroom_id), skip_sid=skip_sid)
+
+        if self.tick <= 0:
+            self.stats["immediate_events"] += 1
+            socketio.emit(event, data, room=whiteboard_batched_room(classroom_id), skip_sid=skip_sid)
+            return
+
+        self.stats["events"] += 1
+        entries = self.pending.get(classroom_id)
+        if entries is None:
+            # First event of this tick for the room: schedule the frame that will carry it.
+            entries = self.pending[classroom_id] = []
+            gevent.spawn_later(self.tick, self._flush_room, classroom_id)
+        entries.append({"event": event, "data": data, "skipSid": skip_sid})
+
+    def _flush_room(self, classroom_id):
+        """Sends the events collected for a room during the last tick as one frame."""
+        entries = self.pending.pop(classroom_id, None)
+        if not entries:
+            return
+        room = whiteboard_batched_room(classroom_id)
+        try:
+            recipients = self._recipient_count(room)
+            socketio.emit('whiteboard_batch', {'classroomId': classroom_id, 'events': entries}, room=room)
+        except Exception as e:
+            print(f"Whiteboard broadcaster: failed to send batch of {len(entries)} events to room {classroom_id}: {e}")
+            return
+        self.stats["frames"] += 1
+        # Every recipient got one write instead of one per event.
+        self.stats["frames_saved"] += (len(entries) - 1) * recipients
+
+    def get_stats(self):
+        """Returns the broadcaster counters together with the number of rooms waiting for a tick."""
+        stats = dict(self.stats)
+        stats["tick_ms"] = int(self.tick * 1000)
+        stats["pending_rooms"] = len(self.pending)
+        return stats
+
+whiteboard_broadcaster = WhiteboardBroadcaster(WHITEBOARD_BROADCAST_TICK_MS / 1000.0)
+
+# --- Image Processing Pool ---
+# Rendering, decoding and encoding images with Pillow is CPU-bound and can take hundreds of
+# milliseconds for large pages. It runs on a small pool of real threads (Pillow releases the GIL in
+# its resampling and codec code), so the event loop keeps serving sockets meanwhile. The number of
+# queued jobs is bounded and callers answer 503 when the pool is saturated.
+
+# Number of threads processing images concurrently.
+IMAGE_PROCESSING_THREADS = int(os.environ.get('IMAGE_PROCESSING_THREADS', 2))
+# Maximum number of image jobs queued or running before new ones are turned away.
+IMAGE_PROCESSING_MAX_PENDING = int(os.environ.get('IMAGE_PROCESSING_MAX_PENDING', 16))
+
+image_processing_pool = gevent.threadpool.ThreadPool(IMAGE_PROCESSING_THREADS)
+image_processing_stats = {"calls": 0, "rejected": 0, "pending": 0, "max_ms": 0.0, "total_ms": 0.0}
+
+class ImageProcessingBusy(Exception):
+    """Raised when too many image jobs are already waiting for the image processing pool."""
+
+def run_image_job(fn, *args):
+    """
+    Runs an image processing function on the image pool and waits (cooperatively) for its result.
+
+    Args:
+        fn (callable): The function to run.
+        *args: Arguments passed to `fn`.
+
+    Returns:
+        The return value of `fn`.
+
+    Raises:
+        ImageProcessingBusy: If IMAGE_PROCESSING_MAX_PENDING jobs are already queued or running.
+    """
+    if image_processing_stats["pending"] >= IMAGE_PROCESSING_MAX_PENDING:
+        image_processing_stats["rejected"] += 1
+        raise ImageProcessingBusy()
+    started = time.monotonic()
+    image_processing_stats["pending"] += 1
+    try:
+        return image_processing_pool.spawn(fn, *args).get()
+    finally:
+        elapsed_ms = (time.monotonic() - started) * 1000
+        image_processing_stats["pending"] -= 1
+        image_processing_stats["calls"] += 1
+        image_processing_stats["total_ms"] += elapsed_ms
+        image_processing_stats["max_ms"] = max(image_processing_stats["max_ms"], round(elapsed_ms, 2))
+
+def get_image_processing_stats():
+    """Returns the image pool counters with the mean time per job (queue wait included)."""
+    stats = dict(image_processing_stats, threads=IMAGE_PROCESSING_THREADS, max_pending=IMAGE_PROCESSING_MAX_PENDING)
+    stats["avg_ms"] = round(stats.pop("total_ms") / stats["calls"], 2) if stats["calls"] else 0.0
+    return stats
+
+# --- Snapshot Blob Store ---
+# Whiteboard snapshot images are stored as files named after the SHA-256 of their content,
+# sharded by the first two hex digits. Identical images are stored once, and since a blob's
+# URL never changes, browsers may cache it indefinitely. Chat messages only reference them.
+# Resolved to an absolute path, since send_from_directory would otherwise resolve it against the app root.
+BLOB_STORE_FOLDER = os.path.abspath(os.environ.get('BLOB_STORE_FOLDER', os.path.join(UPLOAD_FOLDER, 'blobs')))
+# Largest decoded snapshot accepted, in bytes.
+SNAPSHOT_MAX_BYTES = int(os.environ.get('SNAPSHOT_MAX_BYTES', 10 * 1024 * 1024))
+# Largest snapshot accepted, in pixels (width x height), checked from the image header before decoding.
+SNAPSHOT_MAX_PIXELS = int(os.environ.get('SNAPSHOT_MAX_PIXELS', 16 * 1024 * 1024))
+# Bounding box (in pixels) of snapshot thumbnails shown in the chat.
+SNAPSHOT_THUMBNAIL_SIZE = int(os.environ.get('SNAPSHOT_THUMBNAIL_SIZE', 320))
+# Image formats accepted as snapshots, mapped to the file extension they are stored with.
+SNAPSHOT_FORMATS = {'PNG': 'png', 'JPEG': 'jpg', 'WEBP': 'webp'}
+# Names of files that may be served from the blob store: '<sha256>.<ext>' or '<sha256>.thumb.png'.
+BLOB_NAME_PATTERN = re.compile(r'^[0-9a-f]{64}\.(png|jpg|webp|thumb\.png)$')
+
+snapshot_blob_stats = {"stored": 0, "deduplicated": 0, "rejected": 0, "bytes_written": 0}
+
+def blob_path(name):
+    """Returns the on-disk path of a blob store file, e.g. 'blobs/ab/ab12....png'."""
+    return os.path.join(BLOB_STORE_FOLDER, name[:2], name)
+
+def write_blob_file(name, content):
+    """
+    Writes a blob store file unless it already exists. The content is written to a temporary
+    file first and renamed into place, so readers never see a partially written blob.
+
+    Returns:
+        bool: True if the file was written, False if it was already present.
+    """
+    path = blob_path(name)
+    if os.path.exists(path):
+        return False
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    temp_path = f"{path}.{uuid.uuid4().hex}.tmp"
+    with open(temp_path, 'wb') as f:
+        f.write(content)
+    os.replace(temp_path, path)
+    snapshot_blob_stats["bytes_written"] += len(content)
+    return True
+
+def make_snapshot_thumbnail(raw):
+    """Verifies a snapshot image and returns its PNG thumbnail (runs on the image processing pool)."""
+    with Image.open(io.BytesIO(raw)) as image:
+        image.verify()
+    with Image.open(io.BytesIO(raw)) as image:
+        image.thumbnail((SNAPSHOT_THUMBNAIL_SIZE, SNAPSHOT_THUMBNAIL_SIZE))
+        thumbnail_buffer = io.BytesIO()
+        image.save(thumbnail_buffer, 'PNG', optimize=True)
+    return thumbnail_buffer.getvalue()
+
+def store_snapshot_blob(image_data):
+    """
+    Decodes a base64 snapshot (optionally a 'data:' URL) into the blob store and creates its thumbnail.
+
+    Args:
+        image_data (str): The snapshot image as sent by the browser, e.g. 'data:image/png;base64,...'.
+
+    Returns:
+        dict: {"blobId", "imageUrl", "thumbnailUrl", "width", "height", "size"}.
+
+    Raises:
+        ValueError: If the data is not a valid image of an accepted format and size.
+    """
+    if not isinstance(image_data, str):
+        raise ValueError("Snapshot image data must be a string.")
+    encoded = image_data.split(',', 1)[1] if image_data.startswith('data:') else image_data
+    # Reject oversized payloads before decoding them (base64 inflates by 4/3).
+    if len(encoded) > SNAPSHOT_MAX_BYTES * 4 // 3 + 4:
+        raise ValueError("Snapshot image is too large.")
+    try:
+        raw = base64.b64decode(encoded, validate=True)
+    except (binascii.Error, ValueError):
+        raise ValueError("Snapshot image data is not valid base64.")
+
+    # Image.open only parses the header, so format and dimensions are checked before any pixel is decoded.
+    try:
+        with Image.open(io.BytesIO(raw)) as image:
+            image_format = image.format
+            width, height = image.size
+    except Exception as e:
+        raise ValueError(f"Snapshot image could not be read: {e}")
+    if image_format not in SNAPSHOT_FORMATS:
+        raise ValueError(f"Snapshot image format {image_format} is not supported.")
+    if width * height > SNAPSHOT_MAX_PIXELS:
+        raise ValueError(f"Snapshot image is too large ({width}x{height} pixels).")
+
+    try:
+        thumbnail = run_image_job(make_snapshot_thumbnail, raw)
+    except ImageProcessingBusy:
+        raise ValueError("Server is busy processing images, please try again.")
+    except Exception as e:
+        raise ValueError(f"Snapshot image could not be read: {e}")
+
+    digest = hashlib.sha256(raw).hexdigest()
+    image_name = f"{digest}.{SNAPSHOT_FORMATS[image_format]}"
+    thumbnail_name = f"{digest}.thumb.png"
+    if write_blob_file(image_name, raw):
+        snapshot_blob_stats["stored"] += 1
+    else:
+        snapshot_blob_stats["deduplicated"] += 1
+    write_blob_file(thumbnail_name, thumbnail)
+
+    return {
+        "blobId": digest,
+        "imageUrl": f"/blobs/{image_name}",
+        "thumbnailUrl": f"/blobs/{thumbnail_name}",
+        "width": width,
+        "height": height,
+        "size": len(raw)
+    }
+
+# --- Whiteboard Page Rendering ---
+# Whiteboard pages can be rasterized on the server, so late joiners and low-end devices can show
+# a page immediately instead of replaying every stroke first. Drawing follows `drawWhiteboardItem`
+# in app.js: coordinates are fractions of the canvas size, line widths are `size` thousandths of
+# the shorter side, and the board is 16:9 on a black background.
+
+# Widths a page can be rendered at; requested widths are rounded up to the next one, which bounds the render cache.
+WHITEBOARD_RENDER_WIDTHS = sorted(int(w) for w in os.environ.get('WHITEBOARD_RENDER_WIDTHS', '320,640,960,1280,1920').split(','))
+# Pages are drawn at this multiple of the output size and downscaled, which anti-aliases the strokes.
+WHITEBOARD_RENDER_SUPERSAMPLE = int(os.environ.get('WHITEBOARD_RENDER_SUPERSAMPLE', 2))
+# Maximum memory used by cached renders, in bytes.
+WHITEBOARD_RENDER_CACHE_MAX_BYTES = int(os.environ.get('WHITEBOARD_RENDER_CACHE_MAX_BYTES', 32 * 1024 * 1024))
+# Output formats: Pillow format name and content type.
+WHITEBOARD_RENDER_FORMATS = {'png': ('PNG', 'image/png'), 'webp': ('WEBP', 'image/webp')}
+WHITEBOARD_ASPECT_RATIO = 16 / 9
+
+def parse_whiteboard_color(color, default=(255, 255, 255)):
+    """Converts a CSS color string from a drawing command into an RGB tuple."""
+    try:
+        return ImageColor.getrgb(color)[:3]
+    except (ValueError, AttributeError, TypeError):
+        return default
+
+def draw_whiteboard_stroke(draw, points, color, default_width, width, height):
+    """
+    Draws a pen/eraser stroke as round-jointed segments, honouring per-point widths.
+
+    Args:
+        draw (ImageDraw.ImageDraw): The drawing context.
+        points (list): The stroke's points ({"x", "y", "width"} in canvas fractions).
+        color (tuple): RGB stroke color.
+        default_width (float): The stroke's `size`, used for points without their own width.
+        width (int): Canvas width in pixels.
+        height (int): Canvas height in pixels.
+    """
+    if not points:
+        return
+    unit = min(width, height) / 1000.0
+    coords = np.array([[p.get('x', 0), p.get('y', 0)] for p in points], dtype=np.float64) * (width, height)
+    widths = np.array([p.get('width') or default_width for p in points], dtype=np.float64) * unit
+    widths = np.maximum(widths, 1.0)
+    for index in range(len(coords)):
+        x, y = coords[index]
+        radius = widths[index] / 2
+        draw.ellipse((x - radius, y - radius, x + radius, y + radius), fill=color)
+        if index + 1 < len(coords):
+            x2, y2 = coords[index + 1]
+            draw.line((x, y, x2, y2), fill=color, width=max(1, int(round(widths[index]))))
+
+def encode_whiteboard_page_image(items, width, pil_format):
+    """Renders a page and encodes it (runs on the image processing pool). Returns the image bytes."""
+    image = render_whiteboard_page(items, width)
+    buffer = io.BytesIO()
+    image.save(buffer, pil_format)
+    return buffer.getvalue()
+
+def render_whiteboard_page(items, width):
+    """
+    Rasterizes the drawing commands of a whiteboard page.
+
+    Args:
+        items (list): The page's visible drawing commands.
+        width (int): Output width in pixels; the height follows the 16:9 board.
+
+    Returns:
+        PIL.Image.Image: The rendered page (RGB).
+    """
+    scale = max(1, WHITEBOARD_RENDER_SUPERSAMPLE)
+    output_size = (width, max(1, int(round(width / WHITEBOARD_ASPECT_RATIO))))
+    canvas_width, canvas_height = output_size[0] * scale, output_size[1] * scale
+    image = Image.new('RGB', (canvas_width, canvas_height), (0, 0, 0))
+    draw = ImageDraw.Draw(image)
+    unit = min(canvas_width, canvas_height) / 1000.0
+
+    for item in items:
+        if not isinstance(item, dict):
+            continue
+        item_type = item.get('type')
+        size = item.get('size') or 5
+        # The eraser paints the board's background back.
+        color = (0, 0, 0) if item_type == 'eraser' else parse_whiteboard_color(item.get('color'))
+        line_width = max(1, int(round(size * unit)))
+        try:
+            if item_type in ('pen', 'eraser'):
+                draw_whiteboard_stroke(draw, item.get('points') or [], color, size, canvas_width, canvas_height)
+            elif item_type == 'line':
+                # Straight lines are drawn like a two-point stroke, which gives them round caps.
+                draw_whiteboard_stroke(draw, [{"x": item['startX'], "y": item['startY']}, {"x": item['endX'], "y": item['endY']}],
+                                       color, size, canvas_width, canvas_height)
+            elif item_type == 'rectangle':
+                x0, y0 = item['startX'] * canvas_width, item['startY'] * canvas_height
+                x1, y1 = x0 + item['width'] * canvas_width, y0 + item['height'] * canvas_height
+                draw.rectangle((min(x0, x1), min(y0, y1), max(x0, x1), max(y0, y1)), outline=color, width=line_width)
+            elif item_type == 'circle':
+                cx, cy = item['centerX'] * canvas_width, item['centerY'] * canvas_height
+                radius = abs(item['radius']) * canvas_width
+                draw.ellipse((cx - radius, cy - radius, cx + radius, cy + radius), outline=color, width=line_width)
+            elif item_type == 'text' and item.get('text'):
+                font_size = max(1, int(round(size * canvas_height)))
+                font = ImageFont.load_default(font_size)
+                for line_index, line in enumerate(str(item['text']).split('\n')):
+                    # Like canvas fillText, 'y' is the baseline of the first line.
+                    position = (item.get('x', 0) * canvas_width, item.get('y', 0) * canvas_height + line_index * font_size * 1.2)
+                    draw.text(position, line, fill=color, font=font, anchor='ls')
+        except (KeyError, TypeError, ValueError) as e:
+            # A malformed command is skipped rather than failing the whole page.
+            print(f"Skipping malformed whiteboard item of type {item_type} while rendering: {e}")
+
+    if scale > 1:
+        image = image.resize(output_size, Image.LANCZOS)
+    return image
+
+class WhiteboardRenderCache:
+    """
+    Per-process LRU cache of rendered whiteboard pages, keyed by (classroomId, pageIndex, width, format)
+    and tagged with the page version they were rendered from. Entries of a page are dropped as soon
+    as a new action reaches it; a version mismatch is treated as a miss as well.
+    """
+
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.entries = OrderedDict() # (classroomId, pageIndex, width, format) -> {"version": int, "body": bytes}
+        self.page_keys = {} # (classroomId, pageIndex) -> set of entry keys
+        self.bytes = 0
+        self.stats = {"hits": 0, "misses": 0, "renders": 0, "render_ms": 0.0, "evictions": 0, "invalidations": 0}
+
+    def get(self, key, version):
+        """Returns the cached render for a key if it was made from `version`, otherwise None."""
+        entry = self.entries.get(key)
+        if entry is None or entry["version"] != version:
+            self.stats["misses"] += 1
+            return None
+        self.entries.move_to_end(key)
+        self.stats["hits"] += 1
+        return entry["body"]
+
+    def put(self, key, version, body):
+        """Stores a render, replacing any older render for the same key."""
+        self._drop(key)
+        self.entries[key] = {"version": version, "body": body}
+        self.page_keys.setdefault(key[:2], set()).add(key)
+        self.bytes += len(body)
+        while self.bytes > self.max_bytes and self.entries:
+            self._drop(next(iter(self.entries)))
+            self.stats["evictions"] += 1
+
+    def _drop(self, key):
+        entry = self.entries.pop(key, None)
+        if entry is None:
+            return
+        self.bytes -= len(entry["body"])
+        keys = self.page_keys.get(key[:2])
+        if keys is not None:
+            keys.discard(key)
+            if not keys:
+                del self.page_keys[key[:2]]
+
+    def invalidate_page(self, classroom_id, page_index):
+        """Drops every cached render of a page."""
+        for key in list(self.page_keys.get((classroom_id, page_index), ())):
+            self._drop(key)
+            self.stats["invalidations"] += 1
+
+    def invalidate_classroom(self, classroom_id):
+        """Drops every cached render of a classroom."""
+        for page_key in [page_key for page_key in self.page_keys if page_key[0] == classroom_id]:
+            self.invalidate_page(*page_key)
+
+    def get_stats(self):
+        """Returns hit/miss/render counters and the current footprint of the cache."""
+        lookups = self.stats["hits"] + self.stats["misses"]
+        return dict(self.stats, entries=len(self.entries), bytes=self.bytes, max_bytes=self.max_bytes,
+                    render_ms=round(self.stats["render_ms"], 1),
+                    hit_rate=round(self.stats["hits"] / lookups, 4) if lookups else 0.0)
+
+whiteboard_render_cache = WhiteboardRenderCache(WHITEBOARD_RENDER_CACHE_MAX_BYTES)
+
+# --- Chat History ---
+# Chat history is read newest-first in pages over the (classroomId, timestamp, id) index. A page
+# boundary is a message id (or an ISO timestamp); messages sharing a timestamp are ordered by id,
+# so consecutive pages neither skip nor repeat messages.
+
+# Default and maximum number of messages per chat history page.
+CHAT_HISTORY_PAGE_SIZE = int(os.environ.get('CHAT_HISTORY_PAGE_SIZE', 50))
+CHAT_HISTORY_MAX_PAGE_SIZE = int(os.environ.get('CHAT_HISTORY_MAX_PAGE_SIZE', 200))
+
+def resolve_chat_cursor(classroom_id, cursor):
+    """
+    Turns a chat history cursor into a (timestamp, id) position.
+
+    Args:
+        classroom_id (str): The classroom whose history is being paged.
+        cursor (str): A message id, or an ISO 8601 timestamp.
+
+    Returns:
+        tuple: (datetime timestamp, str message id or None), or None if the cursor is not valid.
+    """
+    chat_message = chat_messages_collection.find_one({"classroomId": classroom_id, "id": cursor}, {"_id": 0, "timestamp": 1, "id": 1})
+    if not chat_message:
+        # The cursor may point at a message still waiting in the write-behind buffer.
+        chat_message = next((pending for pending in list(pending_chat_messages.values())
+                             if pending['id'] == cursor and pending['classroomId'] == classroom_id), None)
+    if chat_message and isinstance(chat_message.get('timestamp'), datetime):
+        return chat_message['timestamp'], chat_message['id']
+    try:
+        timestamp = datetime.fromisoformat(cursor.replace('Z', '+00:00'))
+    except ValueError:
+        return None
+    if timestamp.tzinfo is not None:
+        # Stored timestamps are naive UTC.
+        timestamp = timestamp.astimezone(pytz.utc).replace(tzinfo=None)
+    return timestamp, None
+
+def chat_cursor_filter(position, direction):
+    """
+    Builds the query condition selecting messages strictly before ('$lt') or after ('$gt') a (timestamp, id) position.
+    """
+    timestamp, message_id = position
+    if message_id is None:
+        return {"timestamp": {direction: timestamp}}
+    return {"$or": [
+        {"timestamp": {direction: timestamp}},
+        {"timestamp": timestamp, "id": {direction: message_id}}
+    ]}
+
+def chat_message_cursor(chat_message):
+    """Returns the cursor pointing at a serialized chat message: its id, or its timestamp for messages without one."""
+    return chat_message.get('id') or chat_message.get('timestamp')
+
+def serialize_chat_message(chat_message):
+    """Formats a chat message document for JSON responses ('_id' as a string, ISO timestamp)."""
+    if '_id' in chat_message:
+        chat_message['_id'] = str(chat_message['_id'])
+    if isinstance(chat_message.get('timestamp'), datetime):
+        chat_message['timestamp'] = chat_message['timestamp'].isoformat()
+    return chat_message
+
+def chat_message_sort_key(chat_message):
+    """Sort key matching the (timestamp, id) order of the chat history index."""
+    return chat_message['timestamp'], chat_message.get('id') or ''
+
+# --- Chat Write-Behind ---
+# Chat messages are broadcast as soon as they arrive, with a server-assigned '_id' and 'id', and are
+# persisted by a write-behind buffer in insert_many batches. Until a message is flushed it is kept in
+# 'pending_chat_messages', so edits and deletions of it are applied to the buffered document and
+# history requests still include it.
+
+# Write-behind batching of chat messages: flush size, flush delay, buffer bound and retries.
+CHAT_WRITE_BATCH_SIZE = int(os.environ.get('CHAT_WRITE_BATCH_SIZE', 100))
+CHAT_WRITE_MAX_DELAY_MS = int(os.environ.get('CHAT_WRITE_MAX_DELAY_MS', 200))
+CHAT_WRITE_QUEUE_SIZE = int(os.environ.get('CHAT_WRITE_QUEUE_SIZE', 5000))
+CHAT_WRITE_MAX_RETRIES = int(os.environ.get('CHAT_WRITE_MAX_RETRIES', 3))
+
+# Buffered chat messages not yet persisted, keyed by the string form of their '_id'.
+pending_chat_messages = {}
+
+def persist_chat_messages(batch):
+    """
+    Flush function of the chat write-behind buffer: stores a batch of chat messages with a single
+    insert_many. Messages deleted while buffered are skipped, and edits or deletions that arrive
+    while the batch is being written are re-applied once it is stored.
+    """
+    # Insert copies so the stored state can be compared with the buffered documents afterwards.
+    stored = [(chat_message, dict(chat_message)) for chat_message in batch if not chat_message.get('deleted')]
+    if stored:
+        insert_many_idempotent(chat_messages_collection, [copy for _, copy in stored])
+    for chat_message, copy in stored:
+        if chat_message.get('deleted'):
+            chat_messages_collection.delete_one({"_id": chat_message['_id']})
+        elif chat_message['message'] != copy['message']:
+            chat_messages_collection.update_one({"_id": chat_message['_id']}, {"$set": {"message": chat_message['message']}})
+    forget_pending_chat_messages(batch)
+
+def forget_pending_chat_messages(batch):
+    """Removes a persisted (or dropped) batch from the buffered chat messages."""
+    for chat_message in batch:
+        pending_chat_messages.pop(str(chat_message['_id']), None)
+
+def pending_chat_messages_for(classroom_id, positions=None):
+    """
+    Returns copies of the buffered (not yet persisted) messages of a classroom.
+
+    Args:
+        classroom_id (str): The classroom whose messages are requested.
+        positions (dict): Optional 'before'/'after' (timestamp, id) positions the messages must fall between.
+
+    Returns:
+        list: Message documents, in no particular order.
+    """
+    chat_messages = []
+    for chat_message in list(pending_chat_messages.values()):
+        if chat_message['classroomId'] != classroom_id or chat_message.get('deleted'):
+            continue
+        key = chat_message_sort_key(chat_message)
+        in_range = True
+        for name, position in (positions or {}).items():
+            bound = position if position[1] is not None else (position[0],)
+            in_range = in_range and (key < bound if name == 'before' else key > bound)
+        if in_range:
+            chat_messages.append(dict(chat_message))
+    return chat_messages
+
+# Write-behind buffer for chat messages.
+chat_write_behind = WriteBehindQueue(
+    'chat_messages',
+    persist_chat_messages,
+    max_batch=CHAT_WRITE_BATCH_SIZE,
+    max_delay=CHAT_WRITE_MAX_DELAY_MS / 1000.0,
+    max_queue=CHAT_WRITE_QUEUE_SIZE,
+    max_retries=CHAT_WRITE_MAX_RETRIES,
+    on_drop=forget_pending_chat_messages
+)
+chat_write_behind.start()
+# Persist whatever is still buffered when the worker shuts down gracefully.
+atexit.register(chat_write_behind.flush_all)
+
+# --- Recent Chat Cache ---
+# The newest CHAT_RECENT_SIZE messages of every active classroom are kept in a capped Redis list
+# (newest first), so opening a classroom does not sort chat_messages in MongoDB. A list is only
+# trusted while its ':warm' marker exists; the marker is set when the list is rebuilt from MongoDB
+# and the keys expire after CHAT_RECENT_TTL seconds without new messages. Every push increments a
+# ':seq' counter, so a rebuild that raced with a new message is detected and discarded.
+
+# Number of messages kept per classroom.
+CHAT_RECENT_SIZE = int(os.environ.get('CHAT_RECENT_SIZE', 100))
+# Seconds a classroom's recent chat stays cached after its last message or warm-up.
+CHAT_RECENT_TTL = int(os.environ.get('CHAT_RECENT_TTL', 3600))
+# Attempts at an optimistic (WATCH) update before the list is dropped instead.
+CHAT_RECENT_MAX_ATTEMPTS = 3
+
+class RecentChatCache:
+    """
+    Redis ring buffer of the most recent chat messages per classroom. Messages are stored as
+    serialized JSON (string '_id', ISO timestamp). Redis errors never reach callers: reads fall
+    back to MongoDB and failed updates drop the list so it is rebuilt on the next read.
+    """
+
+    def __init__(self, client, size, ttl):
+        self.client = client
+        self.size = size
+        self.ttl = ttl
+        self.stats = {"hits": 0, "misses": 0, "warmups": 0, "warmup_conflicts": 0, "pushes": 0,
+                      "edits": 0, "invalidations": 0, "errors": 0}
+
+    def _key(self, classroom_id):
+        return f"chat_recent:{classroom_id}"
+
+    def _warm_key(self, classroom_id):
+        return f"chat_recent:{classroom_id}:warm"
+
+    def _seq_key(self, classroom_id):
+        return f"chat_recent:{classroom_id}:seq"
+
+    def sequence(self, classroom_id):
+        """
+        Returns the push counter of a classroom, to be read before loading the messages passed to warm().
+        Returns False if Redis is unavailable.
+        """
+        try:
+            return self.client.get(self._seq_key(classroom_id))
+        except redis.RedisError as e:
+            self.stats["errors"] += 1
+            print(f"Recent chat cache read failed for classroom {classroom_id}: {e}")
+            return False
+
+    def get(self, classroom_id):
+        """Returns the cached messages of a classroom in chronological order, or None on a miss."""
+        try:
+            pipe = self.client.pipeline(transaction=False)
+            pipe.exists(self._warm_key(classroom_id))
+            pipe.lrange(self._key(classroom_id), 0, self.size - 1)
+            warm, raw_messages = pipe.execute()
+        except redis.RedisError as e:
+            self.stats["errors"] += 1
+            print(f"Recent chat cache read failed for classroom {classroom_id}: {e}")
+            return None
+        if not warm:
+            self.stats["misses"] += 1
+            return None
+        self.stats["hits"] += 1
+        return [json.loads(raw_message) for raw_message in reversed(raw_messages)]
+
+    def warm(self, classroom_id, chat_messages, sequence):
+        """
+        Replaces the cached list with serialized messages in chronological order and marks it warm.
+        `sequence` is the push counter read before the messages were loaded; if a message was pushed
+        since, the rebuild is skipped and the next read simply warms again.
+        """
+        key = self._key(classroom_id)
+        seq_key = self._seq_key(classroom_id)
+        try:
+            with self.client.pipeline() as pipe:
+                pipe.watch(seq_key)
+                if pipe.get(seq_key) != sequence:
+                    raise redis.WatchError()
+                pipe.multi()
+                pipe.delete(key)
+                if chat_messages:
+                    pipe.lpush(key, *[json.dumps(chat_message) for chat_message in chat_messages[-self.size:]])
+                    pipe.expire(key, self.ttl)
+                pipe.set(self._warm_key(classroom_id), 1, ex=self.ttl)
+                pipe.execute()
+            self.stats["warmups"] += 1
+        except redis.WatchError:
+            self.stats["warmup_conflicts"] += 1
+        except redis.RedisError as e:
+            self.stats["errors"] += 1
+            print(f"Recent chat cache warm-up failed for classroom {classroom_id}: {e}")
+
+    def push(self, classroom_id, chat_message):
+        """Adds a new serialized message to the head of the list and trims it to the cap."""
+        key = self._key(classroom_id)
+        try:
+            pipe = self.client.pipeline()
+            pipe.incr(self._seq_key(classroom_id))
+            pipe.expire(self._seq_key(classroom_id), self.ttl)
+            pipe.lpush(key, json.dumps(chat_message))
+            pipe.ltrim(key, 0, self.size - 1)
+            pipe.expire(key, self.ttl)
+            pipe.expire(self._warm_key(classroom_id), self.ttl)
+            pipe.execute()
+            self.stats["pushes"] += 1
+        except redis.RedisError as e:
+            self.stats["errors"] += 1
+            print(f"Recent chat cache push failed for classroom {classroom_id}: {e}")
+            self.invalidate(classroom_id)
+
+    def edit(self, classroom_id, message_id, new_text):
+        """Updates the text of a cached message (matched by '_id') in place, if it is cached."""
+        key = self._key(classroom_id)
+        try:
+            for _ in range(CHAT_RECENT_MAX_ATTEMPTS):
+                try:
+                    with self.client.pipeline() as pipe:
+                        pipe.watch(key)
+                        raw_messages = pipe.lrange(key, 0, -1)
+                        for index, raw_message in enumerate(raw_messages):
+                            chat_message = json.loads(raw_message)
+                            if chat_message.get('_id') != message_id:
+                                continue
+                            chat_message['message'] = new_text
+                            pipe.multi()
+                            pipe.lset(key, index, json.dumps(chat_message))
+                            pipe.incr(self._seq_key(classroom_id))
+                            pipe.execute()
+                            self.stats["edits"] += 1
+                            break
+                        return
+                except redis.WatchError:
+                    continue
+        except redis.RedisError as e:
+            self.stats["errors"] += 1
+            print(f"Recent chat cache edit failed for classroom {classroom_id}: {e}")
+        self.invalidate(classroom_id)
+
+    def invalidate(self, classroom_id):
+        """
+        Drops the cached list of a classroom. Used for deletions too: removing an entry would leave
+        the list short of the cap while older messages exist in MongoDB.
+        """
+        try:
+            pipe = self.client.pipeline()
+            pipe.delete(self._warm_key(classroom_id), self._key(classroom_id))
+            pipe.incr(self._seq_key(classroom_id))
+            pipe.expire(self._seq_key(classroom_id), self.ttl)
+            pipe.execute()
+            self.stats["invalidations"] += 1
+        except redis.RedisError as e:
+            self.stats["errors"] += 1
+            print(f"Recent chat cache invalidation failed for classroom {classroom_id}: {e}")
+
+    def get_stats(self):
+        """Returns hit/miss/warm-up counters and the hit rate."""
+        lookups = self.stats["hits"] + self.stats["misses"]
+        return dict(self.stats, size=self.size, ttl=self.ttl,
+                    hit_rate=round(self.stats["hits"] / lookups, 4) if lookups else 0.0)
+
+recent_chat_cache = RecentChatCache(redis_client, CHAT_RECENT_SIZE, CHAT_RECENT_TTL)
+
+def load_recent_chat_messages(classroom_id):
+    """
+    Returns the newest CHAT_RECENT_SIZE messages of a classroom, serialized and in chronological order.
+    Served from the recent chat cache; on a miss they are read from MongoDB (plus messages still in the
+    write-behind buffer) and the cache is warmed with them.
+    """
+    chat_messages = recent_chat_cache.get(classroom_id)
+    if chat_messages is not None:
+        return chat_messages
+
+    sequence = recent_chat_cache.sequence(classroom_id)
+    chat_messages = list(chat_messages_collection.find({"classroomId": classroom_id}).sort([("timestamp", -1), ("id", -1)]).limit(CHAT_RECENT_SIZE))
+    # Include messages still waiting in the write-behind buffer.
+    stored_ids = {chat_message.get('id') for chat_message in chat_messages}
+    pending_messages = [chat_message for chat_message in pending_chat_messages_for(classroom_id) if chat_message['id'] not in stored_ids]
+    if pending_messages:
+        chat_messages = sorted(chat_messages + pending_messages, key=chat_message_sort_key, reverse=True)[:CHAT_RECENT_SIZE]
+    chat_messages = [serialize_chat_message(chat_message) for chat_message in reversed(chat_messages)]
+    if sequence is not False:
+        recent_chat_cache.warm(classroom_id, chat_messages, sequence)
+    return chat_messages
+
+# --- Chat Search ---
+# Chat search uses a compound text index {classroomId: 1, message: "text"}: the equality prefix on
+# classroomId means a search only scans the index entries of one classroom, and results are ranked
+# by MongoDB's text score. Snippets are highlighted here with <mark> around the matched words.
+
+# Default and maximum number of results per search page.
+CHAT_SEARCH_PAGE_SIZE = int(os.environ.get('CHAT_SEARCH_PAGE_SIZE', 20))
+CHAT_SEARCH_MAX_PAGE_SIZE = int(os.environ.get('CHAT_SEARCH_MAX_PAGE_SIZE', 100))
+# Maximum length of a search query, in characters.
+CHAT_SEARCH_MAX_QUERY_LENGTH = 200
+# Approximate length of a highlighted snippet, in characters.
+CHAT_SEARCH_SNIPPET_LENGTH = int(os.environ.get('CHAT_SEARCH_SNIPPET_LENGTH', 160))
+# Language used for stemming and stop words. Changing it requires dropping the existing text index.
+CHAT_SEARCH_LANGUAGE = os.environ.get('CHAT_SEARCH_LANGUAGE', 'english')
+
+def chat_search_terms(query):
+    """
+    Extracts the words to highlight from a search query.
+    Negated terms ('-word') are left out; quoted phrases contribute their individual words.
+    """
+    terms = []
+    for token in re.findall(r'-?"[^"]*"|\S+', query):
+        if token.startswith('-'):
+            continue
+        terms.extend(word.lower() for word in re.findall(r'\w+', token))
+    # Longest first, so the regex alternation prefers the longest match.
+    return sorted(set(terms), key=len, reverse=True)
+
+def highlight_chat_snippet(text, terms, length=CHAT_SEARCH_SNIPPET_LENGTH):
+    """
+    Builds an HTML-escaped snippet of a message centred on its first matching word, with every
+    matching word wrapped in <mark>. Words match when they start with a search term, which
+    approximates the stemming done by the text index ('draw' highlights 'drawing').
+
+    Args:
+        text (str): The message text.
+        terms (list): Lowercase search terms, as returned by chat_search_terms().
+        length (int): Approximate snippet length in characters.
+
+    Returns:
+        str: The snippet, safe to insert as HTML.
+    """
+    text = text or ''
+    pattern = re.compile(r'\b(?:' + '|'.join(re.escape(term) for term in terms) + r')\w*', re.IGNORECASE) if terms else None
+    first_match = pattern.search(text) if pattern else None
+
+    start = 0
+    if first_match and len(text) > length:
+        start = max(0, first_match.start() - length // 3)
+    end = min(len(text), start + length)
+    if end - start < length:
+        start = max(0, end - length)
+    # Extend to word boundaries so the snippet does not cut words in half.
+    while start > 0 and not text[start - 1].isspace():
+        start -= 1
+    while end < len(text) and not text[end].isspace():
+        end += 1
+
+    window = text[start:end]
+    parts = []
+    position = 0
+    for match in (pattern.finditer(window) if pattern else []):
+        parts.append(html.escape(window[position:match.start()]))
+        parts.append(f"<mark>{html.escape(match.group(0))}</mark>")
+        position = match.end()
+    parts.append(html.escape(window[position:]))
+    snippet = ''.join(parts)
+    if start > 0:
+        snippet = '…' + snippet
+    if end < len(text):
+        snippet += '…'
+    return snippet
+
+# --- Index Management ---
+# Every index the queries in this file rely on, declared in one place per collection. They are created
+# idempotently in the background at boot (unless ENSURE_INDEXES_ON_BOOT=false) or by `flask ensure-indexes`.
+# Unique indexes can fail on existing duplicate data; such failures are reported, the rest still build,
+# and the boot-time build is retried every INDEX_RETRY_SECONDS until every index exists.
+
+# Creates the required indexes in a background greenlet when the app starts.
+ENSURE_INDEXES_ON_BOOT = os.environ.get('ENSURE_INDEXES_ON_BOOT', 'true').lower() == 'true'
+# Seconds between retries of a boot-time index build that left some indexes missing.
+INDEX_RETRY_SECONDS = int(os.environ.get('INDEX_RETRY_SECONDS', 300))
+# Runs the explain() diagnostics after the boot-time index build and logs every collection scan found.
+INDEX_DIAGNOSTICS = os.environ.get('INDEX_DIAGNOSTICS', 'false').lower() == 'true'
+
+# collection name -> list of (keys, options) passed to create_index.
+REQUIRED_INDEXES = {
+    "users": [
+        ([("id", 1)], {"unique": True}),
+        # Partial so that user documents without an email never collide on null.
+        ([("email", 1)], {"unique": True, "partialFilterExpression": {"email": {"$type": "string"}}}),
+    ],
+    "classrooms": [
+        ([("id", 1)], {"unique": True}),
+        ([("participants", 1)], {}),
+    ],
+    "library_files": [
+        ([("id", 1)], {"unique": True}),
+        ([("classroomId", 1)], {}),
+    ],
+    "assessments": [
+        ([("id", 1)], {"unique": True}),
+        ([("classroomId", 1)], {}),
+        ([("lifecycle_state", 1)], {}),
+    ],
+    "assessment_questions": [
+        ([("id", 1)], {"unique": True}),
+        ([("assessmentId", 1)], {}),
+        ([("classroomId", 1)], {}),
+    ],
+    "assessment_submissions": [
+        ([("id", 1)], {"unique": True}),
+        # One submission per student and assessment.
+        ([("assessmentId", 1), ("student_id", 1)], {"unique": True}),
+        ([("classroomId", 1)], {}),
+    ],
+    "chat_messages": [
+        # Chat history pages and the recent chat cache read over (classroomId, timestamp, id).
+        ([("classroomId", 1), ("timestamp", 1), ("id", 1)], {}),
+        # History cursors are resolved by message id.
+        ([("classroomId", 1), ("id", 1)], {}),
+        # Chat search: the classroomId prefix scopes every $text query to one classroom.
+        ([("classroomId", 1), ("message", "text")], {"name": "classroomId_1_message_text", "default_language": CHAT_SEARCH_LANGUAGE}),
+    ],
+    "whiteboard_drawings_pages": [
+        # History and checkpoint tails, per page and across pages.
+        ([("classroomId", 1), ("pageIndex", 1), ("timestamp", 1)], {}),
+        ([("classroomId", 1), ("timestamp", 1)], {}),
+        # Delta sync by sequence number.
+        ([("classroomId", 1), ("seq", 1)], {}),
+        # Redo looks up the original 'draw' by its action id.
+        ([("classroomId", 1), ("id", 1)], {}),
+    ],
+    "whiteboard_page_checkpoints": [
+        # Concurrent upserts from several workers must not create two checkpoints for a page.
+        ([("classroomId", 1), ("pageIndex", 1)], {"unique": True}),
+    ],
+    "whiteboard_counters": [
+        ([("classroomId", 1)], {"unique": True}),
+    ],
+}
+
+# Representative queries checked by the explain() diagnostics: (collection name, filter, sort).
+INDEX_DIAGNOSTIC_QUERIES = [
+    ("users", {"id": "diagnostic"}, None),
+    ("users", {"email": "diagnostic@example.com"}, None),
+    ("classrooms", {"id": "diagnostic"}, None),
+    ("classrooms", {"id": "diagnostic", "participants": "diagnostic"}, None),
+    ("classrooms", {"participants": "diagnostic"}, None),
+    ("library_files", {"classroomId": "diagnostic"}, None),
+    ("assessments", {"classroomId": "diagnostic"}, None),
+    ("assessment_questions", {"assessmentId": "diagnostic"}, None),
+    ("assessment_submissions", {"assessmentId": "diagnostic", "student_id": "diagnostic"}, None),
+    ("assessment_submissions", {"assessmentId": "diagnostic"}, [("submitted_at", -1)]),
+    ("chat_messages", {"classroomId": "diagnostic"}, [("timestamp", -1), ("id", -1)]),
+    ("chat_messages", {"classroomId": "diagnostic", "id": "diagnostic"}, None),
+    ("whiteboard_drawings_pages", {"classroomId": "diagnostic", "pageIndex": 0}, [("timestamp", 1)]),
+    ("whiteboard_drawings_pages", {"classroomId": "diagnostic", "seq": {"$gt": 0}}, [("seq", 1)]),
+    ("whiteboard_page_checkpoints", {"classroomId": "diagnostic", "pageIndex": 0}, None),
+    ("whiteboard_counters", {"classroomId": "diagnostic"}, None),
+]
+
+# Collections whose indexes have been ensured by this worker.
+# Collections whose required indexes all exist; they are not checked again by this worker.
+ensured_index_collections = set()
+
+def ensure_collection_indexes(collection):
+    """
+    Creates the REQUIRED_INDEXES of a collection (create_index is a no-op for existing indexes).
+    A collection is only skipped afterwards once every one of its indexes was created.
+
+    Returns:
+        list: (index name, error message) for indexes that could not be created.
+    """
+    if collection.name in ensured_index_collections:
+        return []
+    failures = []
+    for keys, options in REQUIRED_INDEXES.get(collection.name, []):
+        try:
+            collection.create_index(keys, **options)
+        except PyMongoError as e:
+            # Typically duplicate data under a unique index, an existing index with other options, or a network error.
+            name = options.get("name") or "_".join(f"{field}_{direction}" for field, direction in keys)
+            failures.append((name, str(e)))
+            print(f"Index {collection.name}.{name} could not be created: {e}")
+    if not failures:
+        ensured_index_collections.add(collection.name)
+    return failures
+
+def ensure_all_indexes():
+    """Creates the required indexes of every collection. Returns {collection name: failures}."""
+    return {name: ensure_collection_indexes(mongo.db[name]) for name in REQUIRED_INDEXES}
+
+def find_collection_scans(plan):
+    """Returns True if an explain() plan tree contains a COLLSCAN stage."""
+    if isinstance(plan, dict):
+        return plan.get("stage") == "COLLSCAN" or any(find_collection_scans(value) for value in plan.values())
+    if isinstance(plan, list):
+        return any(find_collection_scans(value) for value in plan)
+    return False
+
+def diagnose_index_usage():
+    """
+    Runs explain() on INDEX_DIAGNOSTIC_QUERIES and reports the ones whose winning plan scans the collection.
+
+    Returns:
+        list: Dicts with collection, filter and sort of every query that does a collection scan.
+    """
+    scans = []
+    for collection_name, query_filter, sort in INDEX_DIAGNOSTIC_QUERIES:
+        cursor = mongo.db[collection_name].find(query_filter)
+        if sort:
+            cursor = cursor.sort(sort)
+        winning_plan = cursor.explain().get("queryPlanner", {}).get("winningPlan", {})
+        if find_collection_scans(winning_plan):
+            scans.append({"collection": collection_name, "filter": query_filter, "sort": sort})
+            print(f"Index diagnostics: COLLSCAN on {collection_name} for filter {query_filter} sort {sort}.")
+    return scans
+
+def bootstrap_indexes(diagnose=INDEX_DIAGNOSTICS):
+    """
+    Boot-time hook: builds the required indexes and, in diagnostics mode, reports collection scans.
+    While some indexes are missing, it runs again after INDEX_RETRY_SECONDS.
+    """
+    try:
+        failures = {name: failed for name, failed in ensure_all_indexes().items() if failed}
+        print(f"Index bootstrap finished ({len(REQUIRED_INDEXES)} collections, {sum(len(failed) for failed in failures.values())} failures).")
+        if diagnose:
+            diagnose_index_usage()
+    except Exception as e:
+        # The app keeps serving; queries just run without the missing indexes.
+        print(f"Index bootstrap failed: {e}")
+    if len(ensured_index_collections) < len(REQUIRED_INDEXES):
+        print(f"Retrying the index bootstrap in {INDEX_RETRY_SECONDS} seconds.")
+        gevent.spawn_later(INDEX_RETRY_SECONDS, bootstrap_indexes, False)
+
+if ENSURE_INDEXES_ON_BOOT:
+    gevent.spawn(bootstrap_indexes)
+
 # --- API Endpoints ---
 # Routes for serving static files required by the frontend.
 
@@ -220,6 +2650,91 @@ def serve_uploaded_file(filename):
     print(f"Serving uploaded file: {filename}")
     return send_from_directory(app.config['UPLOAD_FOLDER'], filename)
 
+@app.route('/blobs/<name>')
+def serve_blob(name):
+    """
+    Serves a file from the content-addressed blob store (whiteboard snapshots and thumbnails).
+    Blob contents never change, so responses may be cached for a year.
+    """
+    if not BLOB_NAME_PATTERN.match(name):
+        return jsonify({"error": "Blob not found"}), 404
+    return send_from_directory(os.path.join(BLOB_STORE_FOLDER, name[:2]), name, max_age=31536000)
+
+# --- Password Hashing Pool ---
+# Password hashing (scrypt/PBKDF2) is CPU-bound. Running it inline would block every greenlet of the
+# worker for tens of milliseconds per call; instead it runs on a small pool of real threads (hashlib
+# releases the GIL while hashing), and the calling greenlet just waits for the result. The number of
+# queued hashes is bounded so a login burst is answered with 503 instead of an unbounded backlog.
+
+# Number of threads hashing passwords concurrently.
+PASSWORD_HASH_THREADS = int(os.environ.get('PASSWORD_HASH_THREADS', 4))
+# Maximum number of hashes waiting for a thread before new requests are turned away.
+PASSWORD_HASH_MAX_PENDING = int(os.environ.get('PASSWORD_HASH_MAX_PENDING', 256))
+
+password_hash_pool = gevent.threadpool.ThreadPool(PASSWORD_HASH_THREADS)
+password_hash_stats = {
+    "calls": 0,
+    "rejected": 0,
+    "pending": 0,
+    "queue_wait_ms_total": 0.0,
+    "max_queue_wait_ms": 0.0,
+    "hash_ms_total": 0.0,
+    "max_hash_ms": 0.0
+}
+
+class PasswordHashingBusy(Exception):
+    """Raised when too many password hashes are already waiting for the hashing pool."""
+
+def run_password_hash(fn, *args):
+    """
+    Runs a password hashing function on the hashing pool and waits (cooperatively) for its result.
+
+    Args:
+        fn (callable): generate_password_hash or check_password_hash.
+        *args: Arguments passed to `fn`.
+
+    Returns:
+        The return value of `fn`.
+
+    Raises:
+        PasswordHashingBusy: If PASSWORD_HASH_MAX_PENDING hashes are already queued or running.
+    """
+    if password_hash_stats["pending"] >= PASSWORD_HASH_MAX_PENDING:
+        password_hash_stats["rejected"] += 1
+        raise PasswordHashingBusy()
+    submitted = time.monotonic()
+    timings = {}
+
+    def timed():
+        # Runs on a pool thread: only record timings here, the shared counters are updated by the greenlet.
+        timings["started"] = time.monotonic()
+        try:
+            return fn(*args)
+        finally:
+            timings["finished"] = time.monotonic()
+
+    password_hash_stats["pending"] += 1
+    try:
+        return password_hash_pool.spawn(timed).get()
+    finally:
+        password_hash_stats["pending"] -= 1
+        password_hash_stats["calls"] += 1
+        if "finished" in timings:
+            queue_wait_ms = (timings["started"] - submitted) * 1000
+            hash_ms = (timings["finished"] - timings["started"]) * 1000
+            password_hash_stats["queue_wait_ms_total"] += queue_wait_ms
+            password_hash_stats["max_queue_wait_ms"] = max(password_hash_stats["max_queue_wait_ms"], round(queue_wait_ms, 2))
+            password_hash_stats["hash_ms_total"] += hash_ms
+            password_hash_stats["max_hash_ms"] = max(password_hash_stats["max_hash_ms"], round(hash_ms, 2))
+
+def get_password_hash_stats():
+    """Returns the hashing pool counters with mean queue wait and hashing time."""
+    stats = dict(password_hash_stats, threads=PASSWORD_HASH_THREADS, max_pending=PASSWORD_HASH_MAX_PENDING)
+    calls = stats["calls"]
+    stats["avg_queue_wait_ms"] = round(stats.pop("queue_wait_ms_total") / calls, 2) if calls else 0.0
+    stats["avg_hash_ms"] = round(stats.pop("hash_ms_total") / calls, 2) if calls else 0.0
+    return stats
+
 # --- User Authentication & Management ---
 
 @app.route('/api/register', methods=['POST'])
@@ -245,19 +2760,28 @@ def register():
         print(f"Registration failed: Email '{email}' already registered.")
         return jsonify({"error": "Email already registered"}), 409
 
-    # Hash the password for security before storing it.
-    hashed_password = generate_password_hash(password)
+    # Hash the password for security before storing it, off the event loop.
+    try:
+        hashed_password = run_password_hash(generate_password_hash, password)
+    except PasswordHashingBusy:
+        print(f"Registration for '{email}' deferred: password hashing pool is full.")
+        return jsonify({"error": "Server busy, please try again"}), 503, {"Retry-After": "1"}
     user_id = str(uuid.uuid4())  # Generate a unique UUID for the new user.
 
     # Insert new user document into the 'users' collection.
-    users_collection.insert_one({
-        "id": user_id,
-        "username": username,
-        "email": email,
-        "password": hashed_password,
-        "role": role,
-        "created_at": datetime.utcnow()
-    })
+    try:
+        users_collection.insert_one({
+            "id": user_id,
+            "username": username,
+            "email": email,
+            "password": hashed_password,
+            "role": role,
+            "created_at": datetime.utcnow()
+        })
+    except DuplicateKeyError:
+        # A concurrent registration with the same email won the race past the check above (unique email index).
+        print(f"Registration failed: Email '{email}' already registered.")
+        return jsonify({"error": "Email already registered"}), 409
     print(f"User '{username}' ({role}) registered successfully with ID: {user_id}")
     # Return limited user data for the frontend to store in session/local storage.
     return jsonify({"message": "User registered successfully", "user": {"id": user_id, "username": username, "email": email, "role": role}}), 201
@@ -280,8 +2804,13 @@ def login():
 
     # Find user by email.
     user = users_collection.find_one({"email": email})
-    # Verify if user exists and password is correct.
-    if not user or not check_password_hash(user['password'], password):
+    # Verify if user exists and password is correct (hashing runs off the event loop).
+    try:
+        password_ok = bool(user) and run_password_hash(check_password_hash, user['password'], password)
+    except PasswordHashingBusy:
+        print(f"Login for '{email}' deferred: password hashing pool is full.")
+        return jsonify({"error": "Server busy, please try again"}), 503, {"Retry-After": "1"}
+    if not password_ok:
         print(f"Login failed: Invalid email '{email}' or password.")
         return jsonify({"error": "Invalid email or password"}), 401
 
@@ -373,10 +2902,15 @@ def update_profile():
     update_fields["updated_at"] = datetime.utcnow() # Add an update timestamp
 
     # Perform the update operation in MongoDB.
-    result = users_collection.update_one(
-        {"id": user_id},
-        {"$set": update_fields}
-    )
+    try:
+        result = users_collection.update_one(
+            {"id": user_id},
+            {"$set": update_fields}
+        )
+    except DuplicateKeyError:
+        # Another user took the email between the check above and this update (unique email index).
+        print(f"UPDATE /api/update-profile: Email '{new_email}' already registered by another user.")
+        return jsonify({"error": "Email already registered by another user"}), 409
 
     if result.matched_count == 0:
         print(f"UPDATE /api/update-profile: User ID {user_id} not found for update.")
@@ -469,8 +3003,7 @@ def get_library_files(classroomId):
         return jsonify({"error": "Unauthorized"}), 401
 
     # Check if user is a participant of the classroom
-    classroom = classrooms_collection.find_one({"id": classroomId, "participants": user_id})
-    if not classroom:
+    if not is_classroom_member(classroomId, user_id):
         print(f"GET /api/library-files: Classroom {classroomId} not found or user {user_id} not a participant.")
         return jsonify({"error": "Classroom not found or access denied"}), 404
 
@@ -595,7 +3128,8 @@ def create_assessment():
         "creator_id": user_id,
         "creator_username": username,
         "creator_role": user_role,
-        "created_at": datetime.utcnow()
+        "created_at": datetime.utcnow(),
+        "lifecycle_state": 'scheduled'
     })
 
     inserted_question_ids = []
@@ -622,6 +3156,14 @@ def create_assessment():
         'message': f"Admin {session.get('username')} created a new assessment: '{title}' with {len(questions_data)} questions."
     }, room=class_room_id)
 
+    # Start, end and finalize are pushed by the scheduler.
+    schedule_assessment_lifecycle({
+        "id": assessment_id,
+        "scheduled_at": scheduled_at,
+        "duration_minutes": duration_minutes,
+        "lifecycle_state": 'scheduled'
+    })
+
     print(f"Assessment '{title}' created by {username} in classroom {class_room_id} with {len(questions_data)} questions. Question IDs: {inserted_question_ids}.")
     return jsonify({"message": "Assessment created successfully", "id": assessment_id}), 201
 
@@ -672,6 +3214,8 @@ def add_questions_to_assessment(assessmentId):
 
         assessment_questions_collection.insert_one(question_doc)
         inserted_question_ids.append(question_id)
+    invalidate_answer_key(assessmentId)
+    invalidate_assessment_analytics(assessmentId)
 
     socketio.emit('admin_action_update', {
         'classroomId': assessment.get('classroomId'),
@@ -693,13 +3237,14 @@ def get_assessments(classroomId):
         return jsonify({"error": "Unauthorized"}), 401
     
     # Check if user is a participant of the classroom
-    classroom = classrooms_collection.find_one({"id": classroomId, "participants": user_id})
-    if not classroom:
+    if not is_classroom_member(classroomId, user_id):
         print(f"GET /api/assessments/<classroomId>: Classroom {classroomId} not found or user {user_id} not a participant.")
         return jsonify({"error": "Classroom not found or access denied"}), 404
 
 
     assessments = list(assessments_collection.find({"classroomId": classroomId}, {"_id": 0}))
+    # Which of these assessments the current user has submitted, in one query.
+    submitted_ids = submitted_assessment_ids(user_id, [assessment['id'] for assessment in assessments])
     
     # Convert datetime objects to ISO format strings.
     for assessment in assessments:
@@ -708,21 +3253,57 @@ def get_assessments(classroomId):
         if 'created_at' in assessment and isinstance(assessment['created_at'], datetime):
             assessment['created_at'] = assessment['created_at'].isoformat()
         # Add a field to indicate if the current user has already submitted
-        submission = assessment_submissions_collection.find_one({
-            "assessmentId": assessment['id'],
-            "student_id": user_id
-        })
-        assessment['has_submitted'] = bool(submission)
+        assessment['has_submitted'] = assessment['id'] in submitted_ids
 
     print(f"Fetched {len(assessments)} assessments (list view) for classroom {classroomId} for user {user_id}.")
     return jsonify(assessments), 200
 
+def submitted_assessment_ids(user_id, assessment_ids, collection=None):
+    """
+    Returns the subset of `assessment_ids` that a student has submitted, using a single $in query
+    over the unique (assessmentId, student_id) index.
+
+    Args:
+        user_id (str): The student's user id.
+        assessment_ids (list): Assessment ids to check.
+        collection: Submissions collection to query (defaults to assessment_submissions_collection).
+
+    Returns:
+        set: The submitted assessment ids.
+    """
+    if not assessment_ids:
+        return set()
+    collection = collection if collection is not None else assessment_submissions_collection
+    return {submission['assessmentId'] for submission in collection.find(
+        {"assessmentId": {"$in": list(assessment_ids)}, "student_id": user_id},
+        {"_id": 0, "assessmentId": 1}
+    )}
+
+class QueryCountingCollection:
+    """
+    Wraps a collection and counts the find/find_one queries sent through it, so
+    `flask assessment-list-benchmark` can check how many queries a code path issues.
+    """
+
+    def __init__(self, collection):
+        self.collection = collection
+        self.queries = 0
+
+    def find(self, *args, **kwargs):
+        """Counts and forwards a find()."""
+        self.queries += 1
+        return self.collection.find(*args, **kwargs)
+
+    def find_one(self, *args, **kwargs):
+        """Counts and forwards a find_one()."""
+        self.queries += 1
+        return self.collection.find_one(*args, **kwargs)
+
 @app.route('/api/assessments/<assessmentId>', methods=['GET'])
 def get_assessment_details(assessmentId):
     """
     Retrieves detailed information for a specific assessment, including its questions.
-    Checks assessment status (active, upcoming, ended) and emits 'assessment_started'
-    event if a new student is viewing an active assessment.
+    'assessment_started' and 'assessment_ended' are pushed to the classroom by the lifecycle scheduler.
     """
     user_id = session.get('user_id')
     if not user_id:
@@ -735,15 +3316,13 @@ def get_assessment_details(assessmentId):
         return jsonify({"error": "Assessment not found"}), 404
     
     # Ensure user is a participant of the classroom where the assessment belongs
-    classroom = classrooms_collection.find_one({"id": assessment['classroomId'], "participants": user_id})
-    if not classroom:
+    if not is_classroom_member(assessment['classroomId'], user_id):
         print(f"GET /api/assessments/<assessmentId>: User {user_id} not a participant of classroom {assessment['classroomId']}.")
         return jsonify({"error": "Access denied to assessment's classroom"}), 403
 
 
     print(f"Raw assessment details from DB for {assessmentId}: scheduled_at={assessment.get('scheduled_at')}, duration_minutes={assessment.get('duration_minutes')}")
 
-    now = datetime.utcnow()
     scheduled_at = assessment.get('scheduled_at')
     duration_minutes = assessment.get('duration_minutes')
 
@@ -752,25 +3331,6 @@ def get_assessment_details(assessmentId):
         print(f"GET /api/assessments/<assessmentId>: Invalid scheduled_at ({scheduled_at}) or duration_minutes ({duration_minutes}) for assessment {assessmentId}. Cannot calculate end time.")
         return jsonify({"error": "Assessment scheduling data is invalid. Please contact an administrator."}), 500
 
-    end_time = scheduled_at + timedelta(minutes=duration_minutes)
-
-    # If the assessment is currently active and the user hasn't submitted,
-    # emit an 'assessment_started' event to them to kick off their client-side timer.
-    if scheduled_at <= now < end_time:
-        existing_submission = assessment_submissions_collection.find_one({
-            "assessmentId": assessmentId,
-            "student_id": user_id
-        })
-        # Only emit if no existing submission for this user, and they are viewing it for the first time
-        if not existing_submission:
-            socketio.emit('assessment_started', {
-                'classroomId': assessment['classroomId'],
-                'assessmentId': assessmentId,
-                'title': assessment['title'],
-                'endTime': end_time.isoformat()
-            }, room=request.sid) # Emit only to the requesting client's Socket.IO SID.
-            print(f"Emitted 'assessment_started' to {request.sid} for assessment {assessmentId}.")
-
     # Fetch all questions for this assessment, excluding '_id'.
     assessment['questions'] = list(assessment_questions_collection.find({"assessmentId": assessmentId}, {"_id": 0}))
     
@@ -783,72 +3343,83 @@ def get_assessment_details(assessmentId):
     print(f"Fetched details for assessment {assessmentId} including {len(assessment['questions'])} questions for user {user_id}.")
     return jsonify(assessment), 200
 
-@app.route('/api/assessments/<assessmentId>/submit', methods=['POST'])
-def submit_assessment():
-    """
-    Handles student submission of an assessment.
-    Calculates score for MCQ questions and stores the submission.
-    Prevents multiple submissions and late submissions (unless auto-submitted).
+# Seconds an assessment's answer key stays cached (it is also dropped whenever its questions change).
+ANSWER_KEY_CACHE_TIMEOUT = int(os.environ.get('ANSWER_KEY_CACHE_TIMEOUT', 3600))
+
+def load_answer_key(assessment_id, refresh=False):
     """
-    user_id = session.get('user_id')
-    username = session.get('username')
-    user_role = session.get('role')
-    if not user_id:
-        print("SUBMIT /api/assessments/<assessmentId>/submit: Unauthorized - No user_id in session.")
-        return jsonify({"error": "Unauthorized"}), 401
+    Returns the answer key of an assessment, read with one query and cached (Flask-Caching/Redis)
+    so that grading a submission needs no per-question lookups.
 
-    data = request.json
-    assessment_id = data.get('assessmentId')
-    class_room_id = data.get('classroomId')
-    answers = data.get('answers')
-    is_auto_submit = data.get('is_auto_submit', False) # Flag for automatic submission.
+    Args:
+        assessment_id (str): The assessment whose questions are loaded.
+        refresh (bool): Bypass the cache and reload from the database.
 
-    # Validate required fields.
-    if not all([assessment_id, class_room_id, answers is not None]):
-        print(f"SUBMIT /api/assessments/<assessmentId>/submit: Missing required fields for assessmentId={assessment_id}, classroomId={class_room_id}, answers={answers is not None}.")
-        return jsonify({"error": "Missing required fields: assessmentId, classroomId, or answers"}), 400
-    
-    if not isinstance(answers, list):
-        print("SUBMIT /api/assessments/<assessmentId>/submit: Answers must be a list.")
-        return jsonify({"error": "Answers must be a list"}), 400
+    Returns:
+        dict: Maps question id to {"question_type", "correct_answer"}.
+    """
+    cache_key = f"answer_key_{assessment_id}"
+    if not refresh:
+        answer_key = cache.get(cache_key)
+        if answer_key is not None:
+            return answer_key
+    answer_key = {
+        question['id']: {"question_type": question.get('question_type'), "correct_answer": question.get('correct_answer')}
+        for question in assessment_questions_collection.find(
+            {"assessmentId": assessment_id}, {"_id": 0, "id": 1, "question_type": 1, "correct_answer": 1}
+        )
+    }
+    cache.set(cache_key, answer_key, timeout=ANSWER_KEY_CACHE_TIMEOUT)
+    print(f"Loaded answer key for assessment {assessment_id} ({len(answer_key)} questions) into cache.")
+    return answer_key
 
-    assessment_details = assessments_collection.find_one({"id": assessment_id})
-    if not assessment_details:
-        print(f"SUBMIT /api/assessments/<assessmentId>/submit: Assessment {assessment_id} not found.")
-        return jsonify({"error": "Assessment not found"}), 404
+def invalidate_answer_key(assessment_id):
+    """Drops the cached answer key of an assessment after its questions changed."""
+    cache.delete(f"answer_key_{assessment_id}")
 
-    now = datetime.utcnow()
-    scheduled_at = assessment_details['scheduled_at']
-    duration_minutes = assessment_details['duration_minutes']
-    end_time = scheduled_at + timedelta(minutes=duration_minutes)
+# Seconds an assessment's item analysis stays cached (it is also dropped whenever a submission is stored or marked).
+ASSESSMENT_ANALYTICS_CACHE_TIMEOUT = int(os.environ.get('ASSESSMENT_ANALYTICS_CACHE_TIMEOUT', 600))
+# Share of students in each of the upper and lower groups used for the discrimination index.
+ASSESSMENT_ANALYTICS_GROUP_FRACTION = 0.27
 
-    # Prevent manual submission if time has passed. Auto-submissions are allowed.
-    if not is_auto_submit and now > end_time:
-        print(f"SUBMIT /api/assessments/<assessmentId>/submit: Manual submission for assessment {assessment_id} failed, time has passed.")
-        return jsonify({"error": "Assessment submission time has passed. Your answers might have been auto-submitted."}), 403
+def invalidate_assessment_analytics(assessment_id):
+    """Drops the cached item analysis of an assessment after its submissions or questions changed."""
+    cache.delete(f"assessment_analytics_{assessment_id}")
 
-    # Prevent multiple submissions.
-    existing_submission = assessment_submissions_collection.find_one({
-        "assessmentId": assessment_id,
-        "student_id": user_id
-    })
-    if existing_submission:
-        print(f"SUBMIT /api/assessments/<assessmentId>/submit: User {user_id} has already submitted assessment {assessment_id}.")
-        return jsonify({"error": "You have already submitted this assessment."}), 409
+def grade_submission(assessment_id, answers, answer_key=None):
+    """
+    Grades submitted answers in memory against an assessment's answer key.
+    Only MCQ answers are graded automatically; text answers are left for manual review.
 
-    submission_id = str(uuid.uuid4()) # Generate unique ID for the submission.
-    
+    Args:
+        assessment_id (str): The assessment being submitted.
+        answers (list): The submitted answers ({"question_id", "user_answer", "question_text"}).
+        answer_key (dict): Optional already loaded answer key (see load_answer_key).
+
+    Returns:
+        tuple: (graded answers, score, number of graded questions).
+    """
     score = 0
     total_questions = 0
     graded_answers = [] # Stores user's answers along with grading info.
 
+    # A question missing from a cached key may have been added since it was cached,
+    # so the key is reloaded once before such an answer is skipped.
+    if answer_key is None:
+        answer_key = load_answer_key(assessment_id)
+    submitted_ids = {answer.get('question_id') for answer in answers if isinstance(answer, dict) and answer.get('question_id')}
+    if not submitted_ids.issubset(answer_key):
+        answer_key = load_answer_key(assessment_id, refresh=True)
+
     for submitted_answer in answers:
+        if not isinstance(submitted_answer, dict):
+            continue
         question_id = submitted_answer.get('question_id')
         user_answer = submitted_answer.get('user_answer')
         question_text = submitted_answer.get('question_text') # From frontend payload
         
         if question_id:
-            question = assessment_questions_collection.find_one({"id": question_id})
+            question = answer_key.get(question_id)
             if question:
                 total_questions += 1
                 is_correct = False
@@ -870,10 +3441,371 @@ def submit_assessment():
                     "admin_feedback": None # Initialized as None, to be filled by admin.
                 })
             else:
-                print(f"SUBMIT /api/assessments/<assessmentId>/submit: Question ID {question_id} not found in DB for assessment {assessment_id}.")
+                print(f"Grading: Question ID {question_id} not part of assessment {assessment_id}.")
+
+    return graded_answers, score, total_questions
+
+# --- Submission Ingestion ---
+# At a deadline a whole class submits (or is auto-submitted) within seconds. In 'queued' mode a
+# submission is validated and acknowledged with 202 right away, then graded and stored in batches
+# by a write-behind buffer: one answer key lookup per assessment and one insert_many per batch.
+# The student receives the result as 'submission_graded' in their user room. The unique
+# (assessmentId, student_id) index keeps retries and concurrent workers from storing it twice.
+# 'sync' grades and stores the submission within the request, as before.
+SUBMISSION_INGESTION_MODE = os.environ.get('SUBMISSION_INGESTION_MODE', 'queued').lower()
+
+# Write-behind batching of submissions: flush size, flush delay, buffer bound and retries.
+SUBMISSION_WRITE_BATCH_SIZE = int(os.environ.get('SUBMISSION_WRITE_BATCH_SIZE', 200))
+SUBMISSION_WRITE_MAX_DELAY_MS = int(os.environ.get('SUBMISSION_WRITE_MAX_DELAY_MS', 250))
+SUBMISSION_WRITE_QUEUE_SIZE = int(os.environ.get('SUBMISSION_WRITE_QUEUE_SIZE', 10000))
+SUBMISSION_WRITE_MAX_RETRIES = int(os.environ.get('SUBMISSION_WRITE_MAX_RETRIES', 5))
+
+# Queued submissions not yet stored, keyed by (assessmentId, student_id), mapped to their submission id.
+pending_submissions = {}
+
+def persist_submissions(batch):
+    """
+    Flush function of the submission buffer: grades a batch of submissions against answer keys loaded
+    once per assessment, stores them with a single insert_many and notifies each student.
+    Submissions rejected by the unique (assessmentId, student_id) index were already stored (by a
+    retried batch or another request); their students are sent the stored result instead.
+    """
+    answer_keys = {}
+    graded = []
+    for submission in batch:
+        assessment_id = submission['assessmentId']
+        if assessment_id not in answer_keys:
+            answer_keys[assessment_id] = load_answer_key(assessment_id)
+        try:
+            graded_answers, score, total_questions = grade_submission(assessment_id, submission['answers'], answer_keys[assessment_id])
+        except Exception as e:
+            # A malformed submission is reported failed on its own instead of failing the whole batch.
+            print(f"Grading of queued submission {submission['id']} for assessment {assessment_id} failed: {e}")
+            fail_pending_submissions([submission])
+            continue
+        # Grade a copy so a retried batch is graded again from the submitted answers.
+        graded.append(dict(submission, answers=graded_answers, score=score, total_questions=total_questions))
+    if not graded:
+        return
+
+    duplicate_indexes = set()
+    try:
+        assessment_submissions_collection.insert_many(graded, ordered=False)
+    except BulkWriteError as e:
+        if e.details.get('writeConcernErrors') or any(err.get('code') != 11000 for err in e.details.get('writeErrors', [])):
+            raise
+        duplicate_indexes = {err['index'] for err in e.details.get('writeErrors', [])}
+
+    stored = {}
+    replaced = 0
+    if duplicate_indexes:
+        duplicates = [graded[i] for i in duplicate_indexes]
+        for existing in assessment_submissions_collection.find(
+            {"$or": [{"assessmentId": d['assessmentId'], "student_id": d['student_id']} for d in duplicates]},
+            {"_id": 0, "id": 1, "assessmentId": 1, "student_id": 1, "score": 1, "total_questions": 1, "auto_finalized": 1}
+        ):
+            stored[(existing['assessmentId'], existing['student_id'])] = existing
+        # An empty submission recorded by finalize_assessment gives way to the real one arriving late.
+        for index in duplicate_indexes:
+            submission = graded[index]
+            key = (submission['assessmentId'], submission['student_id'])
+            if stored.get(key, {}).get('auto_finalized') and replace_finalized_submission(stored[key]['id'], submission):
+                stored[key] = submission
+                replaced += 1
+
+    submitted_by_assessment = {}
+    for index, submission in enumerate(graded):
+        key = (submission['assessmentId'], submission['student_id'])
+        result = stored.get(key, submission) if index in duplicate_indexes else submission
+        socketio.emit('submission_graded', {
+            'submissionId': result['id'],
+            'assessmentId': submission['assessmentId'],
+            'score': result.get('score'),
+            'total_questions': result.get('total_questions'),
+            # 'duplicate' when another submission of this student was stored first.
+            'status': 'graded' if result['id'] == submission['id'] else 'duplicate'
+        }, room=submission['student_id'])
+        if result['id'] == submission['id']:
+            submitted_by_assessment.setdefault((submission['assessmentId'], submission['classroomId']), []).append(submission['student_username'])
+
+    # One admin update per assessment and batch rather than one per student.
+    for (assessment_id, classroom_id), usernames in submitted_by_assessment.items():
+        invalidate_assessment_analytics(assessment_id)
+        socketio.emit('admin_action_update', {
+            'classroomId': classroom_id,
+            'message': f"{len(usernames)} submission(s) received for assessment {assessment_id}: {', '.join(usernames)}."
+        }, room=classroom_id)
+    print(f"Stored {len(graded) - len(duplicate_indexes) + replaced} queued submissions ({len(duplicate_indexes) - replaced} already stored).")
+    forget_pending_submissions(batch)
+
+def replace_finalized_submission(finalized_id, submission):
+    """
+    Replaces an empty auto-submission stored by finalize_assessment with the student's real submission.
+    Returns True if the finalized row was still there and has been replaced.
+    """
+    replacement = {k: v for k, v in submission.items() if k != '_id'}
+    result = assessment_submissions_collection.replace_one({"id": finalized_id, "auto_finalized": True}, replacement)
+    if result.matched_count:
+        print(f"Replaced finalized placeholder {finalized_id} with submission {submission['id']} of {submission['student_id']}.")
+    return result.matched_count > 0
+
+def forget_pending_submissions(batch):
+    """Removes a stored batch from the queued submissions."""
+    for submission in batch:
+        pending_submissions.pop((submission['assessmentId'], submission['student_id']), None)
+
+def fail_pending_submissions(batch):
+    """Tells the students of a dropped batch that their submission was not stored, so they can submit again."""
+    for submission in batch:
+        socketio.emit('submission_graded', {
+            'submissionId': submission['id'],
+            'assessmentId': submission['assessmentId'],
+            'status': 'failed'
+        }, room=submission['student_id'])
+    forget_pending_submissions(batch)
+
+# Write-behind buffer for assessment submissions.
+submission_write_behind = WriteBehindQueue(
+    'assessment_submissions',
+    persist_submissions,
+    max_batch=SUBMISSION_WRITE_BATCH_SIZE,
+    max_delay=SUBMISSION_WRITE_MAX_DELAY_MS / 1000.0,
+    max_queue=SUBMISSION_WRITE_QUEUE_SIZE,
+    max_retries=SUBMISSION_WRITE_MAX_RETRIES,
+    on_drop=fail_pending_submissions
+)
+submission_write_behind.start()
+# Store whatever is still queued when the worker shuts down gracefully.
+atexit.register(submission_write_behind.flush_all)
+
+# --- Assessment Lifecycle ---
+# The scheduler owns each assessment's lifecycle. Jobs registered when it is created push
+# 'assessment_started' and 'assessment_ended' to the classroom room at its start and end time, and a
+# finalize job stores an empty auto-submission for every student still without one once in-flight
+# auto-submissions have had time to arrive. Every step is a compare-and-set on the assessment's
+# 'lifecycle_state' (scheduled -> started -> ended -> finalized), so although every worker
+# rehydrates the jobs from MongoDB at boot, each event is pushed once.
+ASSESSMENT_LIFECYCLE_STATES = ('scheduled', 'started', 'ended', 'finalized')
+
+# Seconds after an assessment's end before missing submissions are finalized.
+ASSESSMENT_FINALIZE_GRACE_SECONDS = int(os.environ.get('ASSESSMENT_FINALIZE_GRACE_SECONDS', 60))
+
+def as_utc(value):
+    """Returns a datetime as timezone-aware UTC (MongoDB returns naive UTC datetimes)."""
+    return pytz.utc.localize(value) if value.tzinfo is None else value.astimezone(pytz.utc)
+
+def advance_assessment_lifecycle(assessment_id, from_states, to_state):
+    """
+    Moves an assessment to `to_state` if it is currently in one of `from_states`.
+
+    Returns:
+        dict: The assessment (as it was before the transition) if this call made it, else None.
+    """
+    return assessments_collection.find_one_and_update(
+        {"id": assessment_id, "lifecycle_state": {"$in": list(from_states)}},
+        {"$set": {"lifecycle_state": to_state, f"{to_state}_at": datetime.utcnow()}},
+        projection={"_id": 0}
+    )
+
+def start_assessment(assessment_id):
+    """Scheduled at an assessment's start: tells its classroom that it has started."""
+    assessment = advance_assessment_lifecycle(assessment_id, ('scheduled',), 'started')
+    if not assessment:
+        return
+    end_time = as_utc(assessment['scheduled_at']) + timedelta(minutes=assessment['duration_minutes'])
+    socketio.emit('assessment_started', {
+        'classroomId': assessment['classroomId'],
+        'assessmentId': assessment_id,
+        'title': assessment.get('title'),
+        'endTime': end_time.isoformat()
+    }, room=assessment['classroomId'])
+    print(f"Assessment {assessment_id} started; notified classroom {assessment['classroomId']}.")
+
+def end_assessment(assessment_id):
+    """Scheduled at an assessment's end: tells its classroom that it has ended so clients auto-submit."""
+    assessment = advance_assessment_lifecycle(assessment_id, ('scheduled', 'started'), 'ended')
+    if not assessment:
+        return
+    socketio.emit('assessment_ended', {
+        'classroomId': assessment['classroomId'],
+        'assessmentId': assessment_id,
+        'title': assessment.get('title')
+    }, room=assessment['classroomId'])
+    print(f"Assessment {assessment_id} ended; notified classroom {assessment['classroomId']}.")
+
+def finalize_assessment(assessment_id):
+    """
+    Scheduled shortly after an assessment's end: stores an empty, zero-score auto-submission for
+    every student of the classroom who has not submitted. Inserts go through the unique
+    (assessmentId, student_id) index, so several workers finalizing at once store each one once.
+    A real submission that arrives later (still queued elsewhere or delayed by retries) replaces the placeholder.
+    A job that runs before 'end' (e.g. catching up at boot) finalizes without pushing 'assessment_ended'.
+    """
+    assessment = assessments_collection.find_one(
+        {"id": assessment_id, "lifecycle_state": {"$in": list(ASSESSMENT_LIFECYCLE_STATES[:-1])}}, {"_id": 0}
+    )
+    if not assessment:
+        return
+    classroom_id = assessment['classroomId']
+    classroom = classrooms_collection.find_one({"id": classroom_id}, {"_id": 0, "participants": 1}) or {}
+    participants = classroom.get('participants', [])
+    users = get_users_data(participants)
+    students = [user_id for user_id in participants if user_id in users and users[user_id].get('role') != 'admin']
+    submitted = {submission['student_id'] for submission in assessment_submissions_collection.find(
+        {"assessmentId": assessment_id, "student_id": {"$in": students}}, {"_id": 0, "student_id": 1}
+    )}
+    # Submissions still queued on this worker will be stored by the submission buffer.
+    missing = [user_id for user_id in students if user_id not in submitted and (assessment_id, user_id) not in pending_submissions]
+
+    if missing:
+        total_questions = len(load_answer_key(assessment_id))
+        now = datetime.utcnow()
+        insert_many_idempotent(assessment_submissions_collection, [{
+            "id": str(uuid.uuid4()),
+            "assessmentId": assessment_id,
+            "classroomId": classroom_id,
+            "student_id": user_id,
+            "student_username": users[user_id].get('username'),
+            "student_role": users[user_id].get('role'),
+            "submitted_at": now,
+            "answers": [],
+            "score": 0,
+            "total_questions": total_questions,
+            "is_auto_submit": True,
+            "auto_finalized": True, # Stored by the server; the student never submitted.
+            "marked_by": None,
+            "marked_at": None
+        } for user_id in missing])
+        invalidate_assessment_analytics(assessment_id)
+
+    if advance_assessment_lifecycle(assessment_id, ASSESSMENT_LIFECYCLE_STATES[:-1], 'finalized'):
+        socketio.emit('admin_action_update', {
+            'classroomId': classroom_id,
+            'message': f"Assessment '{assessment.get('title')}' finalized: {len(missing)} missing submission(s) recorded."
+        }, room=classroom_id)
+        print(f"Assessment {assessment_id} finalized with {len(missing)} auto-submissions.")
+
+def schedule_assessment_lifecycle(assessment):
+    """
+    Registers the start, end and finalize jobs of an assessment that are still ahead of its
+    lifecycle state. Jobs whose time has passed run immediately.
+
+    Args:
+        assessment (dict): The assessment document (needs id, scheduled_at, duration_minutes, lifecycle_state).
+    """
+    start_time = as_utc(assessment['scheduled_at'])
+    end_time = start_time + timedelta(minutes=assessment['duration_minutes'])
+    steps = (
+        ('start', start_assessment, start_time),
+        ('end', end_assessment, end_time),
+        ('finalize', finalize_assessment, end_time + timedelta(seconds=ASSESSMENT_FINALIZE_GRACE_SECONDS))
+    )
+    reached = ASSESSMENT_LIFECYCLE_STATES.index(assessment.get('lifecycle_state', 'scheduled'))
+    for index, (step, job_fn, run_at) in enumerate(steps):
+        if index < reached:
+            continue
+        scheduler.add_job(
+            job_fn, 'date', run_date=run_at, args=[assessment['id']],
+            id=f"assessment_{step}_{assessment['id']}", replace_existing=True, misfire_grace_time=None
+        )
+
+def unschedule_assessment_lifecycle(assessment_id):
+    """Removes the lifecycle jobs of a deleted assessment from this worker's scheduler."""
+    for step in ('start', 'end', 'finalize'):
+        try:
+            scheduler.remove_job(f"assessment_{step}_{assessment_id}")
+        except JobLookupError:
+            pass
+
+def rehydrate_assessment_lifecycle():
+    """Boot-time hook: re-registers the lifecycle jobs of every assessment that is not finalized yet."""
+    try:
+        # Assessments created before lifecycle tracking: ended ones count as finalized, the others as scheduled.
+        now = datetime.utcnow()
+        for legacy in assessments_collection.find(
+            {"lifecycle_state": {"$exists": False}}, {"_id": 0, "id": 1, "scheduled_at": 1, "duration_minutes": 1}
+        ):
+            ended = legacy['scheduled_at'] + timedelta(minutes=legacy['duration_minutes']) <= now
+            assessments_collection.update_one(
+                {"id": legacy['id'], "lifecycle_state": {"$exists": False}},
+                {"$set": {"lifecycle_state": 'finalized' if ended else 'scheduled'}}
+            )
+
+        assessments = list(assessments_collection.find(
+            {"lifecycle_state": {"$in": list(ASSESSMENT_LIFECYCLE_STATES[:-1])}},
+            {"_id": 0, "id": 1, "scheduled_at": 1, "duration_minutes": 1, "lifecycle_state": 1}
+        ))
+        for assessment in assessments:
+            schedule_assessment_lifecycle(assessment)
+        print(f"Rehydrated lifecycle jobs for {len(assessments)} assessments.")
+    except Exception as e:
+        print(f"Assessment lifecycle rehydration failed: {e}")
+
+gevent.spawn(rehydrate_assessment_lifecycle)
+
+@app.route('/api/assessments/<assessmentId>/submit', methods=['POST'])
+def submit_assessment(assessmentId):
+    """
+    Handles student submission of an assessment.
+    Calculates score for MCQ questions from the cached answer key and stores the submission, or in
+    'queued' ingestion mode acknowledges it with 202 and leaves grading to the submission buffer.
+    Prevents multiple submissions and late submissions (unless auto-submitted).
+    """
+    user_id = session.get('user_id')
+    username = session.get('username')
+    user_role = session.get('role')
+    if not user_id:
+        print("SUBMIT /api/assessments/<assessmentId>/submit: Unauthorized - No user_id in session.")
+        return jsonify({"error": "Unauthorized"}), 401
+
+    data = request.json
+    assessment_id = assessmentId # The assessment in the URL is the one being submitted.
+    class_room_id = data.get('classroomId')
+    answers = data.get('answers')
+    is_auto_submit = data.get('is_auto_submit', False) # Flag for automatic submission.
+
+    # Validate required fields.
+    if not all([assessment_id, class_room_id, answers is not None]):
+        print(f"SUBMIT /api/assessments/<assessmentId>/submit: Missing required fields for assessmentId={assessment_id}, classroomId={class_room_id}, answers={answers is not None}.")
+        return jsonify({"error": "Missing required fields: assessmentId, classroomId, or answers"}), 400
+    
+    if not isinstance(answers, list):
+        print("SUBMIT /api/assessments/<assessmentId>/submit: Answers must be a list.")
+        return jsonify({"error": "Answers must be a list"}), 400
+
+    # Reject malformed answers up front; a queued submission could otherwise only fail at grading time.
+    if not all(isinstance(answer, dict) and isinstance(answer.get('question_id'), str) for answer in answers):
+        print("SUBMIT /api/assessments/<assessmentId>/submit: Each answer must be an object with a string question_id.")
+        return jsonify({"error": "Each answer must be an object with a string question_id"}), 400
+
+    assessment_details = assessments_collection.find_one({"id": assessment_id})
+    if not assessment_details:
+        print(f"SUBMIT /api/assessments/<assessmentId>/submit: Assessment {assessment_id} not found.")
+        return jsonify({"error": "Assessment not found"}), 404
+
+    now = datetime.utcnow()
+    scheduled_at = assessment_details['scheduled_at']
+    duration_minutes = assessment_details['duration_minutes']
+    end_time = scheduled_at + timedelta(minutes=duration_minutes)
+
+    # Prevent manual submission if time has passed. Auto-submissions are allowed.
+    if not is_auto_submit and now > end_time:
+        print(f"SUBMIT /api/assessments/<assessmentId>/submit: Manual submission for assessment {assessment_id} failed, time has passed.")
+        return jsonify({"error": "Assessment submission time has passed. Your answers might have been auto-submitted."}), 403
+
+    # Prevent multiple submissions. An empty placeholder recorded when the assessment was
+    # finalized does not count: a late auto-submission replaces it.
+    existing_submission = assessment_submissions_collection.find_one({
+        "assessmentId": assessment_id,
+        "student_id": user_id,
+        "auto_finalized": {"$ne": True}
+    })
+    if existing_submission:
+        print(f"SUBMIT /api/assessments/<assessmentId>/submit: User {user_id} has already submitted assessment {assessment_id}.")
+        return jsonify({"error": "You have already submitted this assessment."}), 409
 
-    # Insert the new submission document.
-    assessment_submissions_collection.insert_one({
+    submission_id = str(uuid.uuid4()) # Generate unique ID for the submission.
+    submission = {
         "id": submission_id,
         "assessmentId": assessment_id,
         "classroomId": class_room_id,
@@ -881,13 +3813,40 @@ def submit_assessment():
         "student_username": username,
         "student_role": user_role,
         "submitted_at": datetime.utcnow(),
-        "answers": graded_answers,
-        "score": score,
-        "total_questions": total_questions,
+        "answers": answers,
         "is_auto_submit": is_auto_submit,
         "marked_by": None,
         "marked_at": None
-    })
+    }
+
+    if SUBMISSION_INGESTION_MODE == 'queued':
+        # Acknowledge now; the submission is graded and stored with the next batch and the student
+        # receives 'submission_graded'. A retry while it is still queued gets the same submission id.
+        pending_id = pending_submissions.get((assessment_id, user_id))
+        if pending_id:
+            return jsonify({"message": "Submission received", "status": "queued", "submission_id": pending_id}), 202
+        if not submission_write_behind.put(submission):
+            print(f"SUBMIT /api/assessments/<assessmentId>/submit: Ingestion queue full, submission of {user_id} for {assessment_id} rejected.")
+            return jsonify({"error": "Server busy, please try again"}), 503, {"Retry-After": "1"}
+        pending_submissions[(assessment_id, user_id)] = submission_id
+        print(f"Assessment {assessment_id} submission by {username} queued. Auto-submit: {is_auto_submit}.")
+        return jsonify({"message": "Submission received", "status": "queued", "submission_id": submission_id}), 202
+
+    graded_answers, score, total_questions = grade_submission(assessment_id, answers)
+    submission.update({"answers": graded_answers, "score": score, "total_questions": total_questions})
+
+    # Insert the new submission document. The unique (assessmentId, student_id) index rejects
+    # a concurrent second submission that passed the check above.
+    try:
+        assessment_submissions_collection.insert_one(submission)
+    except DuplicateKeyError:
+        finalized = assessment_submissions_collection.find_one(
+            {"assessmentId": assessment_id, "student_id": user_id, "auto_finalized": True}, {"_id": 0, "id": 1}
+        )
+        if not finalized or not replace_finalized_submission(finalized['id'], submission):
+            print(f"SUBMIT /api/assessments/<assessmentId>/submit: User {user_id} has already submitted assessment {assessment_id}.")
+            return jsonify({"error": "You have already submitted this assessment."}), 409
+    invalidate_assessment_analytics(assessment_id)
 
     # Emit an admin action update to the classroom.
     socketio.emit('admin_action_update', {
@@ -917,8 +3876,7 @@ def get_assessment_submissions(assessmentId):
         return jsonify({"error": "Assessment not found"}), 404
     
     # Check if user is a participant of the classroom
-    classroom = classrooms_collection.find_one({"id": assessment['classroomId'], "participants": user_id})
-    if not classroom:
+    if not is_classroom_member(assessment['classroomId'], user_id):
         print(f"GET /api/assessments/<assessmentId>/submissions: User {user_id} not a participant of classroom {assessment['classroomId']}.")
         return jsonify({"error": "Access denied to assessment's classroom"}), 403
 
@@ -934,10 +3892,15 @@ def get_assessment_submissions(assessmentId):
 
 
     submissions = list(assessment_submissions_collection.find(query, {"_id": 0}).sort("submitted_at", -1))
-    
-    # Add assessment title to each submission for easier frontend display.
+    students = get_users_data(submission.get('student_id') for submission in submissions)
+
+    # Add assessment title and the student's current name and role to each submission for easier frontend display.
     for submission in submissions:
         submission['assessment_title'] = assessment.get('title')
+        student = students.get(submission.get('student_id'))
+        if student:
+            submission['student_username'] = student.get('username', submission.get('student_username'))
+            submission['student_role'] = student.get('role')
         # Format datetime objects
         if 'submitted_at' in submission and isinstance(submission['submitted_at'], datetime):
             submission['submitted_at'] = submission['submitted_at'].isoformat()
@@ -1062,6 +4025,7 @@ def mark_submission(assessmentId, submissionId):
     )
 
     if result.modified_count > 0:
+        invalidate_assessment_analytics(assessmentId)
         # Emit 'submission_marked' event to the student who made the submission.
         socketio.emit('submission_marked', {
             'assessmentId': assessmentId,
@@ -1084,6 +4048,277 @@ def mark_submission(assessmentId, submissionId):
     print(f"No changes were made to submission {submissionId} during marking process.")
     return jsonify({"message": "No changes made to submission"}), 200
 
+def regrade_submissions(submissions, answer_key):
+    """
+    Regrades the MCQ answers of many submissions at once. Normalised answers are laid out as a
+    (students x MCQ questions) array and compared with the key in one vectorized step; answers
+    to other question types keep the correctness an administrator assigned when marking.
+
+    Args:
+        submissions (list): Submission documents (need 'id', 'answers' and 'score').
+        answer_key (dict): The assessment's answer key (see load_answer_key).
+
+    Returns:
+        list: (submission, regraded answers, new score) for every submission whose grading changed.
+    """
+    mcq_ids = [question_id for question_id, question in answer_key.items() if question.get('question_type') == 'mcq']
+    columns = {question_id: column for column, question_id in enumerate(mcq_ids)}
+    if not submissions:
+        return []
+
+    # '' marks an unanswered question, and a key without a correct answer matches nothing.
+    correct = np.array([str(answer_key[question_id].get('correct_answer') or '').strip().lower() for question_id in mcq_ids], dtype=object)
+    given = np.full((len(submissions), len(mcq_ids)), '', dtype=object)
+    other_correct = np.zeros(len(submissions), dtype=int)
+    for row, submission in enumerate(submissions):
+        for answer in submission.get('answers') or []:
+            column = columns.get(answer.get('question_id'))
+            if column is not None:
+                if answer.get('user_answer') is not None:
+                    given[row, column] = str(answer['user_answer']).strip().lower()
+            elif answer.get('is_correct'):
+                other_correct[row] += 1
+
+    is_correct = (given == correct) & (given != '') & (correct != '')
+    scores = is_correct.sum(axis=1) + other_correct
+
+    changes = []
+    for row, submission in enumerate(submissions):
+        answers = [dict(answer) for answer in submission.get('answers') or []]
+        changed = int(scores[row]) != submission.get('score')
+        for answer in answers:
+            column = columns.get(answer.get('question_id'))
+            if column is None:
+                continue
+            question = answer_key[mcq_ids[column]]
+            new_correct = bool(is_correct[row, column])
+            if answer.get('is_correct') != new_correct or answer.get('correct_answer') != question.get('correct_answer'):
+                answer['is_correct'] = new_correct
+                answer['correct_answer'] = question.get('correct_answer')
+                changed = True
+        if changed:
+            changes.append((submission, answers, int(scores[row])))
+    return changes
+
+# How many times a regrade re-reads and rewrites submissions that were marked while it ran.
+REGRADE_MAX_ATTEMPTS = int(os.environ.get('REGRADE_MAX_ATTEMPTS', 3))
+
+@app.route('/api/assessments/<assessmentId>/regrade', methods=['POST'])
+def regrade_assessment(assessmentId):
+    """
+    Regrades every submission of an assessment against its current answer key, optionally after
+    correcting answers in the key ({"corrections": [{"question_id", "correct_answer"}]}).
+    Changed submissions are written back with a single bulk_write and one 'submissions_regraded'
+    summary is emitted to the classroom. Requires admin role and that the admin created the assessment.
+    """
+    user_id = session.get('user_id')
+    user_role = session.get('role')
+
+    if not user_id or user_role != 'admin':
+        print("REGRADE /api/assessments/<assessmentId>/regrade: Unauthorized - Only administrators can regrade submissions.")
+        return jsonify({"error": "Unauthorized: Only administrators can regrade submissions."}), 401
+
+    assessment = assessments_collection.find_one({"id": assessmentId})
+    if not assessment or assessment['creator_id'] != user_id:
+        print(f"REGRADE /api/assessments/<assessmentId>/regrade: Forbidden - Admin {user_id} is not the creator of assessment {assessmentId}.")
+        return jsonify({"error": "Forbidden: You are not the creator of this assessment."}), 403
+
+    data = request.get_json(silent=True) or {}
+    corrections = data.get('corrections') or []
+    if not isinstance(corrections, list) or not all(isinstance(c, dict) and c.get('question_id') and 'correct_answer' in c for c in corrections):
+        print("REGRADE /api/assessments/<assessmentId>/regrade: 'corrections' must be a list of {question_id, correct_answer}.")
+        return jsonify({"error": "'corrections' must be a list of {question_id, correct_answer}"}), 400
+
+    started = time.monotonic()
+    if corrections:
+        assessment_questions_collection.bulk_write([
+            UpdateOne({"id": c['question_id'], "assessmentId": assessmentId}, {"$set": {"correct_answer": c['correct_answer']}})
+            for c in corrections
+        ], ordered=False)
+    answer_key = load_answer_key(assessmentId, refresh=True)
+
+    projection = {"_id": 0, "id": 1, "answers": 1, "score": 1, "marked_at": 1, "regrade_id": 1}
+    submissions = list(assessment_submissions_collection.find({"assessmentId": assessmentId}, projection))
+    changes = regrade_submissions(submissions, answer_key)
+    regrade_id = str(uuid.uuid4())
+    regraded_at = datetime.utcnow()
+    changed = 0
+    for _ in range(REGRADE_MAX_ATTEMPTS):
+        if not changes:
+            break
+        # Each update only applies if the submission was not marked or regraded since it was read,
+        # so feedback and correctness saved by mark_submission meanwhile are never overwritten.
+        result = assessment_submissions_collection.bulk_write([
+            UpdateOne(
+                {"id": submission['id'], "score": submission.get('score'), "marked_at": submission.get('marked_at'),
+                 "regrade_id": submission.get('regrade_id')},
+                {"$set": {"answers": answers, "score": score, "regraded_at": regraded_at, "regrade_id": regrade_id}}
+            )
+            for submission, answers, score in changes
+        ], ordered=False)
+        changed += result.matched_count
+        if result.matched_count == len(changes):
+            break
+        # Re-read the submissions that changed underneath and regrade them from their current state.
+        conflicted = list(assessment_submissions_collection.find(
+            {"id": {"$in": [submission['id'] for submission, _, _ in changes]}, "regrade_id": {"$ne": regrade_id}}, projection
+        ))
+        print(f"{len(conflicted)} submissions for assessment {assessmentId} changed during regrade; retrying.")
+        changes = regrade_submissions(conflicted, answer_key)
+    # Dropped only after the write, so a concurrent analytics request cannot re-cache the old scores.
+    invalidate_assessment_analytics(assessmentId)
+    elapsed_ms = round((time.monotonic() - started) * 1000, 2)
+
+    socketio.emit('submissions_regraded', {
+        'classroomId': assessment.get('classroomId'),
+        'assessmentId': assessmentId,
+        'assessmentTitle': assessment.get('title'),
+        'regraded': len(submissions),
+        'changed': changed
+    }, room=assessment.get('classroomId'))
+
+    print(f"Regraded {len(submissions)} submissions for assessment {assessmentId} ({changed} changed) in {elapsed_ms} ms.")
+    return jsonify({
+        "message": "Submissions regraded successfully",
+        "regraded": len(submissions),
+        "changed": changed,
+        "elapsed_ms": elapsed_ms
+    }), 200
+
+def compute_assessment_analytics(assessment_id):
+    """
+    Computes the item analysis of an assessment. Two aggregation pipelines reduce the submissions
+    to per-student correctness rows and per-question option counts; NumPy turns those into:
+      - difficulty: share of graded answers to a question that are correct,
+      - discrimination: difficulty in the top minus the bottom ASSESSMENT_ANALYTICS_GROUP_FRACTION
+        of students by score,
+      - a histogram and summary of the scores.
+
+    Args:
+        assessment_id (str): The assessment to analyse.
+
+    Returns:
+        dict: The analysis, ready to be serialized.
+    """
+    questions = list(assessment_questions_collection.find(
+        {"assessmentId": assessment_id}, {"_id": 0, "id": 1, "question_text": 1, "question_type": 1, "options": 1}
+    ))
+    columns = {question['id']: column for column, question in enumerate(questions)}
+
+    rows = list(assessment_submissions_collection.aggregate([
+        {"$match": {"assessmentId": assessment_id}},
+        {"$project": {"_id": 0, "score": 1, "answers": {"$map": {
+            "input": "$answers", "as": "answer", "in": {"question_id": "$$answer.question_id", "is_correct": "$$answer.is_correct"}
+        }}}}
+    ]))
+    option_counts = {}
+    for group in assessment_submissions_collection.aggregate([
+        {"$match": {"assessmentId": assessment_id}},
+        {"$unwind": "$answers"},
+        {"$match": {"answers.question_type": "mcq"}},
+        {"$group": {"_id": {"question_id": "$answers.question_id", "answer": "$answers.user_answer"}, "count": {"$sum": 1}}}
+    ]):
+        question_id, answer = group['_id'].get('question_id'), group['_id'].get('answer')
+        if not isinstance(question_id, str):
+            continue # Malformed answers cannot belong to any question.
+        if isinstance(answer, (list, dict)):
+            # Multi-select or malformed payloads never match an option; they count as other answers.
+            answer = json.dumps(answer, sort_keys=True)
+        counts = option_counts.setdefault(question_id, {})
+        counts[answer] = counts.get(answer, 0) + group['count']
+
+    # Correctness matrix (students x questions): 1 correct, 0 incorrect or unanswered, NaN not yet marked.
+    correctness = np.zeros((len(rows), len(questions)))
+    for row, submission in enumerate(rows):
+        for answer in submission.get('answers') or []:
+            question_id = answer.get('question_id') if isinstance(answer, dict) else None
+            column = columns.get(question_id) if isinstance(question_id, str) else None
+            if column is not None:
+                is_correct = answer.get('is_correct')
+                correctness[row, column] = np.nan if is_correct is None else float(bool(is_correct))
+    scores = np.array([submission.get('score') or 0 for submission in rows], dtype=int)
+
+    graded = (~np.isnan(correctness)).sum(axis=0)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        difficulty = np.where(graded > 0, np.nansum(correctness, axis=0) / graded, np.nan)
+    discrimination = np.full(len(questions), np.nan)
+    group_size = int(round(len(rows) * ASSESSMENT_ANALYTICS_GROUP_FRACTION))
+    if group_size > 0 and len(rows) >= 2 * group_size:
+        order = np.argsort(scores, kind='stable')
+        upper, lower = correctness[order[-group_size:]], correctness[order[:group_size]]
+        # A group without any marked answer to a question leaves its discrimination undefined.
+        defined = (~np.isnan(upper)).any(axis=0) & (~np.isnan(lower)).any(axis=0)
+        with np.errstate(invalid='ignore'):
+            discrimination[defined] = np.nanmean(upper[:, defined], axis=0) - np.nanmean(lower[:, defined], axis=0)
+
+    def stat(value):
+        return None if np.isnan(value) else round(float(value), 4)
+
+    question_stats = []
+    for column, question in enumerate(questions):
+        entry = {
+            "question_id": question['id'],
+            "question_text": question.get('question_text'),
+            "question_type": question.get('question_type'),
+            "graded": int(graded[column]),
+            "difficulty": stat(difficulty[column]),
+            "discrimination": stat(discrimination[column])
+        }
+        if question.get('question_type') == 'mcq':
+            counts = dict(option_counts.get(question['id'], {}))
+            entry["option_counts"] = {option: counts.pop(option, 0) for option in question.get('options') or []}
+            # Blank answers and values that are not among the options.
+            entry["other_answers"] = sum(counts.values())
+        question_stats.append(entry)
+
+    histogram = np.bincount(scores.clip(min=0), minlength=len(questions) + 1) if len(rows) else np.zeros(len(questions) + 1, dtype=int)
+    return {
+        "assessmentId": assessment_id,
+        "submissions": len(rows),
+        "score_summary": {
+            "mean": round(float(scores.mean()), 4) if len(rows) else None,
+            "median": float(np.median(scores)) if len(rows) else None,
+            "std": round(float(scores.std()), 4) if len(rows) else None,
+            "min": int(scores.min()) if len(rows) else None,
+            "max": int(scores.max()) if len(rows) else None,
+            "max_possible": len(questions)
+        },
+        "score_histogram": [{"score": score, "count": int(count)} for score, count in enumerate(histogram)],
+        "questions": question_stats,
+        "generated_at": datetime.utcnow().isoformat()
+    }
+
+@app.route('/api/assessments/<assessmentId>/analytics', methods=['GET'])
+def get_assessment_analytics(assessmentId):
+    """
+    Returns the item analysis of an assessment (difficulty, discrimination, option frequencies and
+    score histogram), cached per assessment until a submission is stored, marked or regraded.
+    Requires admin role and membership of the assessment's classroom.
+    """
+    user_id = session.get('user_id')
+    user_role = session.get('role')
+
+    if not user_id or user_role != 'admin':
+        print("GET /api/assessments/<assessmentId>/analytics: Unauthorized - Only administrators can view assessment analytics.")
+        return jsonify({"error": "Unauthorized: Only administrators can view assessment analytics."}), 401
+
+    assessment = assessments_collection.find_one({"id": assessmentId}, {"_id": 0, "classroomId": 1})
+    if not assessment:
+        print(f"GET /api/assessments/<assessmentId>/analytics: Assessment {assessmentId} not found.")
+        return jsonify({"error": "Assessment not found"}), 404
+
+    if not is_classroom_member(assessment['classroomId'], user_id):
+        print(f"GET /api/assessments/<assessmentId>/analytics: User {user_id} not a participant of classroom {assessment['classroomId']}.")
+        return jsonify({"error": "Access denied to assessment's classroom"}), 403
+
+    cache_key = f"assessment_analytics_{assessmentId}"
+    analytics = cache.get(cache_key)
+    if analytics is None:
+        analytics = compute_assessment_analytics(assessmentId)
+        cache.set(cache_key, analytics, timeout=ASSESSMENT_ANALYTICS_CACHE_TIMEOUT)
+        print(f"Computed analytics for assessment {assessmentId} from {analytics['submissions']} submissions.")
+    return jsonify(analytics), 200
+
 @app.route('/api/assessments/<assessmentId>', methods=['DELETE'])
 def delete_assessment(assessmentId):
     """
@@ -1109,8 +4344,11 @@ def delete_assessment(assessmentId):
 
     # Delete associated questions and submissions first.
     assessment_questions_collection.delete_many({"assessmentId": assessmentId})
+    invalidate_answer_key(assessmentId)
+    invalidate_assessment_analytics(assessmentId)
     assessment_submissions_collection.delete_many({"assessmentId": assessmentId})
     result = assessments_collection.delete_one({"id": assessmentId}) # Then delete the assessment itself.
+    unschedule_assessment_lifecycle(assessmentId)
 
     if result.deleted_count > 0:
         # Emit admin action update to the classroom.
@@ -1223,12 +4461,10 @@ def get_classroom_details(classroomId):
         print(f"GET /api/classrooms/<classroomId>: Classroom {classroomId} not found or user {user_id} not a participant.")
         return jsonify({"error": "Classroom not found or access denied"}), 404
 
-    # Fetch recent chat messages, sorted by timestamp.
-    chat_messages = list(chat_messages_collection.find({"classroomId": classroomId}, {"_id": 0}).sort("timestamp", 1).limit(100))
-    # Format timestamps for frontend.
+    # The most recent chat messages (CHAT_RECENT_SIZE), in chronological order with ISO timestamps.
+    chat_messages = attach_chat_authors(load_recent_chat_messages(classroomId))
     for msg in chat_messages:
-        if 'timestamp' in msg and isinstance(msg['timestamp'], datetime):
-            msg['timestamp'] = msg['timestamp'].isoformat()
+        msg.pop('_id', None)
 
     # Fetch library files.
     library_files = list(library_files_collection.find({"classroomId": classroomId}, {"_id": 0}))
@@ -1257,6 +4493,148 @@ def get_classroom_details(classroomId):
     print(f"Fetched comprehensive details for classroom {classroomId} for user {user_id}.")
     return jsonify(classroom_details), 200
 
+@app.route('/api/classrooms/<classroomId>/chat', methods=['GET'])
+def get_chat_history(classroomId):
+    """
+    Returns one page of a classroom's chat history, in chronological order.
+    Without cursors the newest page is returned. `before=<cursor>` pages towards older messages and
+    `after=<cursor>` towards newer ones; a cursor is a message id or an ISO 8601 timestamp.
+    `limit` sets the page size (default CHAT_HISTORY_PAGE_SIZE, at most CHAT_HISTORY_MAX_PAGE_SIZE).
+
+    Returns:
+        {"messages", "has_more", "before", "after"}: `has_more` tells whether more messages exist in the
+        paging direction; `before`/`after` are the cursors for the adjacent older/newer pages.
+    """
+    user_id = session.get('user_id')
+    if not user_id:
+        print("GET /api/classrooms/<classroomId>/chat: Unauthorized - No user_id in session.")
+        return jsonify({"error": "Unauthorized"}), 401
+
+    # Ensure user is a participant of the classroom.
+    if not is_classroom_member(classroomId, user_id):
+        print(f"GET /api/classrooms/<classroomId>/chat: Classroom {classroomId} not found or user {user_id} not a participant.")
+        return jsonify({"error": "Classroom not found or access denied"}), 404
+
+    try:
+        limit = int(request.args.get('limit', CHAT_HISTORY_PAGE_SIZE))
+    except ValueError:
+        return jsonify({"error": "'limit' must be an integer"}), 400
+    limit = max(1, min(limit, CHAT_HISTORY_MAX_PAGE_SIZE))
+
+    conditions = [{"classroomId": classroomId}]
+    positions = {}
+    for name, direction in (('before', '$lt'), ('after', '$gt')):
+        cursor = request.args.get(name)
+        if cursor is None:
+            continue
+        positions[name] = resolve_chat_cursor(classroomId, cursor)
+        if positions[name] is None:
+            return jsonify({"error": f"'{name}' must be a message id or an ISO 8601 timestamp"}), 400
+        conditions.append(chat_cursor_filter(positions[name], direction))
+
+    # The newest page is served from the recent chat cache when it holds more messages than requested
+    # (or all of the classroom's messages), so `has_more` is exact.
+    if not positions:
+        recent_messages = load_recent_chat_messages(classroomId)
+        if limit < CHAT_RECENT_SIZE or len(recent_messages) < CHAT_RECENT_SIZE:
+            chat_messages = attach_chat_authors(recent_messages[-limit:])
+            print(f"Fetched {len(chat_messages)} recent chat messages for classroom {classroomId}.")
+            return jsonify({
+                "messages": chat_messages,
+                "has_more": len(recent_messages) > limit,
+                "before": chat_message_cursor(chat_messages[0]) if chat_messages else None,
+                "after": chat_message_cursor(chat_messages[-1]) if chat_messages else None
+            }), 200
+
+    # Page forwards from 'after'; otherwise page backwards from 'before' (or from the newest message).
+    forward = 'after' in positions
+    sort_direction = 1 if forward else -1
+    chat_messages = list(chat_messages_collection.find(
+        {"$and": conditions} if len(conditions) > 1 else conditions[0]
+    ).sort([("timestamp", sort_direction), ("id", sort_direction)]).limit(limit + 1))
+    # Include messages still waiting in the write-behind buffer.
+    stored_ids = {chat_message.get('id') for chat_message in chat_messages}
+    pending_messages = [chat_message for chat_message in pending_chat_messages_for(classroomId, positions) if chat_message['id'] not in stored_ids]
+    if pending_messages:
+        chat_messages = sorted(chat_messages + pending_messages, key=chat_message_sort_key, reverse=not forward)
+
+    has_more = len(chat_messages) > limit
+    chat_messages = chat_messages[:limit]
+    if not forward:
+        chat_messages.reverse()
+    chat_messages = attach_chat_authors([serialize_chat_message(chat_message) for chat_message in chat_messages])
+
+    print(f"Fetched {len(chat_messages)} chat messages for classroom {classroomId} (before={request.args.get('before')}, after={request.args.get('after')}).")
+    return jsonify({
+        "messages": chat_messages,
+        "has_more": has_more,
+        "before": chat_message_cursor(chat_messages[0]) if chat_messages else request.args.get('before'),
+        "after": chat_message_cursor(chat_messages[-1]) if chat_messages else request.args.get('after')
+    }), 200
+
+@app.route('/api/classrooms/<classroomId>/chat/search', methods=['GET'])
+def search_chat_messages(classroomId):
+    """
+    Full-text search over a classroom's chat messages, most relevant first (newest first among equal scores).
+    `q` is the query in MongoDB $text syntax (words, "quoted phrases", -excluded words); `page` (from 1)
+    and `limit` (default CHAT_SEARCH_PAGE_SIZE, at most CHAT_SEARCH_MAX_PAGE_SIZE) select the result page.
+    Messages still in the write-behind buffer become searchable once they are flushed.
+
+    Returns:
+        {"query", "page", "has_more", "results"}: each result is the message plus its `score` and an
+        HTML `snippet` in which matched words are wrapped in <mark>.
+    """
+    user_id = session.get('user_id')
+    if not user_id:
+        print("GET /api/classrooms/<classroomId>/chat/search: Unauthorized - No user_id in session.")
+        return jsonify({"error": "Unauthorized"}), 401
+
+    # Ensure user is a participant of the classroom.
+    if not is_classroom_member(classroomId, user_id):
+        print(f"GET /api/classrooms/<classroomId>/chat/search: Classroom {classroomId} not found or user {user_id} not a participant.")
+        return jsonify({"error": "Classroom not found or access denied"}), 404
+
+    query = (request.args.get('q') or '').strip()
+    if not query:
+        return jsonify({"error": "'q' is required"}), 400
+    if len(query) > CHAT_SEARCH_MAX_QUERY_LENGTH:
+        return jsonify({"error": f"'q' must be at most {CHAT_SEARCH_MAX_QUERY_LENGTH} characters"}), 400
+    try:
+        page = int(request.args.get('page', 1))
+        limit = int(request.args.get('limit', CHAT_SEARCH_PAGE_SIZE))
+    except ValueError:
+        return jsonify({"error": "'page' and 'limit' must be integers"}), 400
+    page = max(1, page)
+    limit = max(1, min(limit, CHAT_SEARCH_MAX_PAGE_SIZE))
+
+    # The equality on classroomId is required by the compound text index and scopes the scan to this classroom.
+    try:
+        chat_messages = list(chat_messages_collection.find(
+            {"classroomId": classroomId, "$text": {"$search": query}},
+            {"score": {"$meta": "textScore"}}
+        ).sort([("score", {"$meta": "textScore"}), ("timestamp", -1)]).skip((page - 1) * limit).limit(limit + 1))
+    except OperationFailure as e:
+        # The text index is built at boot (or by `flask ensure-indexes`); until it exists $text cannot run.
+        print(f"Chat search in classroom {classroomId} failed: {e}")
+        return jsonify({"error": "Chat search is not available yet, please try again later."}), 503
+
+    has_more = len(chat_messages) > limit
+    terms = chat_search_terms(query)
+    results = []
+    for chat_message in chat_messages[:limit]:
+        chat_message['score'] = round(chat_message.get('score', 0), 4)
+        chat_message['snippet'] = highlight_chat_snippet(chat_message.get('message'), terms)
+        results.append(serialize_chat_message(chat_message))
+    attach_chat_authors(results)
+
+    print(f"Chat search in classroom {classroomId} for '{query}' returned {len(results)} results (page {page}).")
+    return jsonify({
+        "query": query,
+        "page": page,
+        "has_more": has_more,
+        "results": results
+    }), 200
+
 @app.route('/api/classrooms/<classroomId>/join', methods=['POST'])
 def join_classroom(classroomId):
     """
@@ -1281,6 +4659,7 @@ def join_classroom(classroomId):
             {"$addToSet": {"participants": user_id}, "$set": {"updated_at": datetime.utcnow()}} # Update timestamp
         )
         cache.delete_memoized(get_classrooms) # Invalidate classroom cache.
+        classroom_membership_cache.invalidate(classroomId)
         print(f"User {username} ({user_id}) joined classroom {classroomId}.")
         return jsonify({"message": "Joined classroom successfully"}), 200
     else:
@@ -1310,6 +4689,7 @@ def leave_classroom(classroomId):
             {"$pull": {"participants": user_id}, "$set": {"updated_at": datetime.utcnow()}} # Update timestamp
         )
         cache.delete_memoized(get_classrooms) # Invalidate classroom cache.
+        classroom_membership_cache.invalidate(classroomId)
         print(f"User {username} ({user_id}) left classroom {classroomId}.")
         return jsonify({"message": "Left classroom successfully"}), 200
     else:
@@ -1333,11 +4713,35 @@ def get_classroom_participants(classroomId):
         return jsonify({"error": "Classroom not found or access denied"}), 404
 
     participant_ids = classroom.get('participants', [])
-    # Fetch details for each participant, excluding password and '_id'.
-    participants = list(users_collection.find({"id": {"$in": participant_ids}}, {"_id": 0, "password": 0}))
+    # Fetch details for each participant (cached, without password and '_id'), in participant order.
+    users = get_users_data(participant_ids)
+    participants = [users[participant_id] for participant_id in participant_ids if participant_id in users]
     print(f"Fetched {len(participants)} participants for classroom {classroomId}.")
     return jsonify(participants), 200
 
+@app.route('/api/classrooms/<classroomId>/online', methods=['GET'])
+def get_online_participants(classroomId):
+    """
+    Lists the participants currently connected to a classroom, from the presence registry.
+
+    Returns:
+        {"classroomId", "count", "users"}: `users` holds id, username and role of each online user.
+    """
+    user_id = session.get('user_id')
+    if not user_id:
+        print("GET /api/classrooms/<classroomId>/online: Unauthorized - No user_id in session.")
+        return jsonify({"error": "Unauthorized"}), 401
+
+    if not is_classroom_member(classroomId, user_id):
+        print(f"GET /api/classrooms/<classroomId>/online: Classroom {classroomId} not found or user {user_id} not a participant.")
+        return jsonify({"error": "Classroom not found or access denied"}), 404
+
+    online_ids = presence_registry.online_users(classroomId)
+    users = get_users_data(online_ids)
+    online_users = [{"id": online_id, "username": users[online_id].get('username'), "role": users[online_id].get('role')}
+                    for online_id in online_ids if online_id in users]
+    return jsonify({"classroomId": classroomId, "count": len(online_users), "users": online_users}), 200
+
 @app.route('/api/classrooms/<classroomId>', methods=['DELETE'])
 def delete_classroom(classroomId):
     """
@@ -1375,19 +4779,38 @@ def delete_classroom(classroomId):
     assessments = list(assessments_collection.find({"classroomId": classroomId}, {"id": 1}))
     assessment_ids = [a['id'] for a in assessments]
     assessment_questions_collection.delete_many({"classroomId": classroomId})
+    for assessment_id in assessment_ids:
+        invalidate_answer_key(assessment_id)
+        invalidate_assessment_analytics(assessment_id)
+        unschedule_assessment_lifecycle(assessment_id)
     assessment_submissions_collection.delete_many({"classroomId": classroomId})
     assessments_collection.delete_many({"classroomId": classroomId})
     print(f"Deleted {len(assessment_ids)} assessments and related questions/submissions for classroom {classroomId}.")
 
     # Delete whiteboard data and chat messages.
     whiteboard_collection.delete_many({"classroomId": classroomId})
+    whiteboard_checkpoints_collection.delete_many({"classroomId": classroomId})
+    whiteboard_counters_collection.delete_many({"classroomId": classroomId})
+    whiteboard_seq_high.pop(classroomId, None)
+    try:
+        redis_client.delete(WHITEBOARD_SEQ_KEY.format(classroomId))
+    except redis.RedisError as e:
+        print(f"Could not delete the whiteboard seq counter of classroom {classroomId}: {e}")
+    whiteboard_page_cache.invalidate_classroom(classroomId)
+    whiteboard_render_cache.invalidate_classroom(classroomId)
+    # Buffered chat messages of the classroom must not be stored after it is gone.
+    for chat_message in list(pending_chat_messages.values()):
+        if chat_message['classroomId'] == classroomId:
+            chat_message['deleted'] = True
     chat_messages_collection.delete_many({"classroomId": classroomId})
+    recent_chat_cache.invalidate(classroomId)
     print(f"Deleted whiteboard data and chat messages for classroom {classroomId}.")
 
     # Finally, delete the classroom itself.
     result = classrooms_collection.delete_one({"id": classroomId})
     if result.deleted_count > 0:
         cache.delete_memoized(get_classrooms) # Invalidate classroom cache.
+        classroom_membership_cache.invalidate(classroomId)
         # Emit admin action update.
         socketio.emit('admin_action_update', {
             'classroomId': classroomId,
@@ -1407,6 +4830,13 @@ def get_whiteboard_history(classroomId):
     **UPDATED**: Retrieves the complete whiteboard drawing history for a classroom,
     organized into an array of pages. Each page is an array of drawing commands.
     This format directly matches what the frontend `app.js` expects.
+    Pages are served from the in-memory page cache, or from their checkpoints on a miss,
+    so only the short tail of recent actions is ever replayed.
+    The response carries a 'cursor' for the next delta: the highest action sequence number included,
+    clamped to the settled seq like the delta cursor (clients skip seqs they already applied).
+
+    Delta mode: with `?since=<seq>` (and optionally `&page=<n>`), only the actions recorded
+    after that cursor are returned, grouped by page, with a reset marker on pages that were cleared.
     """
     user_id = session.get('user_id')
     if not user_id:
@@ -1414,47 +4844,127 @@ def get_whiteboard_history(classroomId):
         return jsonify({"error": "Unauthorized"}), 401
 
     # Ensure user is a participant of the classroom.
-    classroom = classrooms_collection.find_one({"id": classroomId, "participants": user_id})
-    if not classroom:
+    if not is_classroom_member(classroomId, user_id):
         print(f"GET /api/whiteboard-history/<classroomId>: Classroom {classroomId} not found or user {user_id} not a participant.")
         return jsonify({"error": "Classroom not found or access denied"}), 404
 
-    # Fetch all whiteboard actions, sorted by timestamp to ensure correct order of operations.
-    whiteboard_actions = list(whiteboard_collection.find(
-        {"classroomId": classroomId},
-        {"_id": 0, "action": 1, "data": 1, "pageIndex": 1, "timestamp": 1} # Project only necessary fields.
-    ).sort("timestamp", 1))
-
-    # Reconstruct the whiteboard state page by page.
-    pages_data = {} # Dictionary to hold drawing commands for each page index.
-    max_page_index = 0
+    since = request.args.get('since')
+    if since is not None:
+        page = request.args.get('page')
+        try:
+            since = int(since)
+            page = int(page) if page is not None else None
+        except ValueError:
+            print(f"GET /api/whiteboard-history/<classroomId>: Invalid since={since} or page={page}.")
+            return jsonify({"error": "'since' and 'page' must be integers"}), 400
+        if since < 0 or (page is not None and page < 0):
+            print(f"GET /api/whiteboard-history/<classroomId>: Negative since={since} or page={page}.")
+            return jsonify({"error": "'since' and 'page' must not be negative"}), 400
+
+        delta = load_whiteboard_delta(classroomId, since, page)
+        print(f"Fetched whiteboard delta for classroom {classroomId} since seq {since} (page={page}). New cursor: {delta['cursor']}.")
+        return jsonify(delta), 200
+
+    # Serve the pages from this worker's page cache, reconstructing them from checkpoints on a miss.
+    history, _, cursor = get_whiteboard_pages(classroomId)
 
-    for action_doc in whiteboard_actions:
-        page_index = action_doc.get('pageIndex', 0) # Default to page 0 if not specified.
-        action_type = action_doc.get('action')
-        drawing_data = action_doc.get('data')
+    print(f"Fetched whiteboard history for classroom {classroomId}. Total pages reconstructed: {len(history)}.")
+    return jsonify({"history": history, "cursor": cursor}), 200
 
-        max_page_index = max(max_page_index, page_index) # Keep track of highest page index.
+@app.route('/api/whiteboard-render/<classroomId>/<int:pageIndex>', methods=['GET'])
+def render_whiteboard_page_image(classroomId, pageIndex):
+    """
+    Returns a whiteboard page rendered as an image, built from the same pages `get_whiteboard_history` returns.
+    Query parameters: `width` (rounded up to one of WHITEBOARD_RENDER_WIDTHS, default 1280) and
+    `format` ('png' or 'webp', default 'png').
+    The response carries an ETag of the page version and an `X-Whiteboard-Cursor` header with the
+    sequence number of the last action it reflects, so clients can draw newer live actions on top.
+    """
+    user_id = session.get('user_id')
+    if not user_id:
+        print("GET /api/whiteboard-render/<classroomId>/<pageIndex>: Unauthorized - No user_id in session.")
+        return jsonify({"error": "Unauthorized"}), 401
 
-        if page_index not in pages_data:
-            pages_data[page_index] = [] # Initialize page if it doesn't exist.
-        
-        if action_type == 'draw' and drawing_data:
-            # For 'draw' actions, append the drawing data.
-            pages_data[page_index].append(drawing_data)
-        elif action_type == 'clear':
-            # For 'clear' actions, clear all previous actions on that page.
-            pages_data[page_index] = []
-        # Other actions (e.g., page_change itself) are not drawing commands, so not stored here.
-    
-    # Format the reconstructed pages into a list of lists, as expected by app.js.
-    history = []
-    for i in range(max_page_index + 1):
-        # Ensure all pages up to max_page_index are included, even if empty.
-        history.append(pages_data.get(i, []))
+    # Ensure user is a participant of the classroom.
+    if not is_classroom_member(classroomId, user_id):
+        print(f"GET /api/whiteboard-render/<classroomId>/<pageIndex>: Classroom {classroomId} not found or user {user_id} not a participant.")
+        return jsonify({"error": "Classroom not found or access denied"}), 404
 
-    print(f"Fetched whiteboard history for classroom {classroomId}. Total pages reconstructed: {len(history)}.")
-    return jsonify({"history": history}), 200
+    image_format = request.args.get('format', 'png').lower()
+    if image_format not in WHITEBOARD_RENDER_FORMATS:
+        return jsonify({"error": f"'format' must be one of {', '.join(WHITEBOARD_RENDER_FORMATS)}"}), 400
+    try:
+        requested_width = int(request.args.get('width', 1280))
+    except ValueError:
+        return jsonify({"error": "'width' must be an integer"}), 400
+    if requested_width <= 0:
+        return jsonify({"error": "'width' must be positive"}), 400
+    width = next((w for w in WHITEBOARD_RENDER_WIDTHS if w >= requested_width), WHITEBOARD_RENDER_WIDTHS[-1])
+
+    # Look the page up in the page cache, loading the classroom into it on a miss.
+    page = whiteboard_page_cache.get_page(classroomId, pageIndex)
+    if page is None:
+        pages, cursor, _ = get_whiteboard_pages(classroomId)
+        if pageIndex >= len(pages):
+            return jsonify({"error": "Whiteboard page not found"}), 404
+        # The cache may not be able to hold the classroom; the cursor then stands in for the page version.
+        page = whiteboard_page_cache.get_page(classroomId, pageIndex) or (pages[pageIndex], cursor)
+    items, version = page
+
+    etag = f'"wb-{version}-{width}-{image_format}"'
+    if etag in request.headers.get('If-None-Match', ''):
+        response = make_response('', 304)
+    else:
+        key = (classroomId, pageIndex, width, image_format)
+        body = whiteboard_render_cache.get(key, version)
+        if body is None:
+            started = time.perf_counter()
+            try:
+                # Rendered off the event loop, so live strokes and signaling keep flowing meanwhile.
+                body = run_image_job(encode_whiteboard_page_image, visible_whiteboard_items(items), width, WHITEBOARD_RENDER_FORMATS[image_format][0])
+            except ImageProcessingBusy:
+                print(f"GET /api/whiteboard-render/<classroomId>/<pageIndex>: Image processing pool busy, render of page {pageIndex} for classroom {classroomId} rejected.")
+                return jsonify({"error": "Server busy, please try again"}), 503, {"Retry-After": "1"}
+            whiteboard_render_cache.stats["renders"] += 1
+            whiteboard_render_cache.stats["render_ms"] += (time.perf_counter() - started) * 1000
+            whiteboard_render_cache.put(key, version, body)
+        response = make_response(body)
+        response.headers['Content-Type'] = WHITEBOARD_RENDER_FORMATS[image_format][1]
+
+    response.headers['ETag'] = etag
+    response.headers['Cache-Control'] = 'private, no-cache' # Revalidate each time; unchanged pages answer 304.
+    response.headers['X-Whiteboard-Cursor'] = str(version)
+    return response
+
+# --- Metrics API Endpoint ---
+
+@app.route('/api/metrics', methods=['GET'])
+def get_metrics():
+    """
+    Reports the in-process performance counters of the worker serving the request.
+    Requires admin role.
+    """
+    user_id = session.get('user_id')
+    if not user_id or session.get('role') != 'admin':
+        print("GET /api/metrics: Unauthorized - Only administrators can view metrics.")
+        return jsonify({"error": "Unauthorized: Only administrators can view metrics."}), 401
+
+    metrics = {
+        "whiteboard_write_behind": whiteboard_write_behind.get_stats(),
+        "chat_write_behind": chat_write_behind.get_stats(),
+        "submission_write_behind": dict(submission_write_behind.get_stats(), mode=SUBMISSION_INGESTION_MODE),
+        "recent_chat_cache": recent_chat_cache.get_stats(),
+        "classroom_membership_cache": classroom_membership_cache.get_stats(),
+        "password_hashing": get_password_hash_stats(),
+        "image_processing": get_image_processing_stats(),
+        "presence": presence_registry.get_stats(),
+        "whiteboard_simplification": get_whiteboard_simplify_stats(),
+        "whiteboard_page_cache": whiteboard_page_cache.get_stats(),
+        "whiteboard_broadcast": whiteboard_broadcaster.get_stats(),
+        "snapshot_blobs": dict(snapshot_blob_stats),
+        "whiteboard_render_cache": whiteboard_render_cache.get_stats()
+    }
+    return jsonify(metrics), 200
 
 # --- Socket.IO Event Handlers ---
 # These handlers enable real-time communication between the server and connected clients.
@@ -1463,13 +4973,15 @@ def get_whiteboard_history(classroomId):
 def handle_connect():
     """
     Handles new Socket.IO client connections.
-    If the user is authenticated, they join a personal room named after their user_id.
+    If the user is authenticated, they join a personal room named after their user_id
+    and the socket is registered in the presence registry (used to relay WebRTC signaling).
     """
     user_id = session.get('user_id')
     username = session.get('username')
     if user_id:
         # Join a private room for the user, allowing direct messages.
         join_room(user_id)
+        presence_registry.connect(request.sid, user_id)
         print(f"User '{username}' ({user_id}) connected with SID: {request.sid}. Joined personal room '{user_id}'.")
     else:
         print(f"Unauthenticated user connected with SID: {request.sid}.")
@@ -1478,10 +4990,12 @@ def handle_connect():
 def handle_disconnect():
     """
     Handles Socket.IO client disconnections.
-    Logs the disconnection and can be extended for cleanup.
+    Removes the socket from the presence registry, which also takes the user offline
+    in the classrooms this socket had joined.
     """
     user_id = session.get('user_id')
     username = session.get('username')
+    presence_registry.disconnect(request.sid)
     if user_id:
         # Implicitly leaves rooms on disconnect, but explicit logic can be added.
         print(f"User '{username}' ({user_id}) disconnected. SID: {request.sid}.")
@@ -1511,16 +5025,17 @@ def handle_join_classroom(data):
 
     # Join the specific classroom room
     join_room(class_id)
+    # Whiteboard events are delivered through a sub-room matching the client's capabilities:
+    # clients that send `batchedWhiteboard` receive per-tick 'whiteboard_batch' frames.
+    if data.get('batchedWhiteboard'):
+        join_room(whiteboard_batched_room(class_id))
+    else:
+        join_room(whiteboard_legacy_room(class_id))
     # Also join a personal room based on user_id, for direct messaging/signaling
     join_room(user_id)
 
-    # Update participant's sid in the database (or add if new)
-    # This is crucial for matching userId to SID for direct emits
-    users_collection.update_one(
-        {"id": user_id},
-        {"$set": {"last_sid": request.sid}}, # Store current SID
-        upsert=True # Create user if not exists (though typically user exists from auth)
-    )
+    # Register the socket as online in the classroom (this is what matches userId to SID for direct emits).
+    presence_registry.join(request.sid, user_id, class_id)
 
     # If the user is not already in the classroom's participant list, add them.
     # Note: Assumes `classrooms_collection` and `users_collection` are globally accessible PyMongo collections.
@@ -1530,11 +5045,14 @@ def handle_join_classroom(data):
             {"id": class_id},
             {"$addToSet": {"participants": user_id}} # Add only if not already present
         )
+        classroom_membership_cache.invalidate(class_id)
         print(f"User {username} ({user_id}) added to participants list for classroom {class_id}.")
     elif not classroom:
         print(f"Classroom {class_id} not found when user {username} ({user_id}) attempted to join.")
         # Consider emitting an error back to the client here
         return
+    # Populate the membership cache, so the events that follow the join are authorized without MongoDB.
+    is_classroom_member(class_id, user_id)
     
     # Notify other users in the classroom (but not the joining user themselves)
     emit('user_joined', {
@@ -1562,9 +5080,11 @@ def handle_leave_classroom(data):
         return
 
     # Verify user is a participant.
-    classroom = classrooms_collection.find_one({"id": classroom_id, "participants": user_id})
-    if classroom:
+    if is_classroom_member(classroom_id, user_id):
         leave_room(classroom_id) # Leave the Socket.IO room.
+        leave_room(whiteboard_batched_room(classroom_id))
+        leave_room(whiteboard_legacy_room(classroom_id))
+        presence_registry.leave(request.sid, classroom_id)
         print(f"User '{username}' ({user_id}) left Socket.IO room for classroom {classroom_id} from SID: {request.sid}.")
         
         # Emit 'user_left' event to all other participants in the classroom (excluding self).
@@ -1581,12 +5101,13 @@ def handle_leave_classroom(data):
 def handle_chat_message(data):
     """
     Handles incoming chat messages from clients.
-    Stores the message in the database and broadcasts it to all participants in the classroom.
+    Broadcasts the message to all participants in the classroom right away and hands it to the
+    chat write-behind buffer, which stores it in the database with the next batch.
     """
     user_id = session.get('user_id')
     username = session.get('username')
     role = session.get('role')
-    classroom_id = data.get('classroomId')
+    classroom_id = data.get('classroomId') or data.get('classroom_id')
     message_text = data.get('message')
 
     # Validate all required fields from session and payload.
@@ -1595,8 +5116,7 @@ def handle_chat_message(data):
         return
 
     # Verify user is a participant before processing and broadcasting message.
-    classroom = classrooms_collection.find_one({"id": classroom_id, "participants": user_id})
-    if not classroom:
+    if not is_classroom_member(classroom_id, user_id):
         print(f"User '{username}' ({user_id}) attempted to send message to classroom {classroom_id} without access.")
         return
 
@@ -1604,6 +5124,7 @@ def handle_chat_message(data):
     current_timestamp = datetime.utcnow()
 
     chat_message = {
+        "_id": ObjectId(), # Assigned here so clients can edit or delete the message before it is stored.
         "id": chat_message_id,
         "classroomId": classroom_id,
         "user_id": user_id,
@@ -1612,19 +5133,18 @@ def handle_chat_message(data):
         "message": message_text,
         "timestamp": current_timestamp
     }
-    
-    chat_messages_collection.insert_one(chat_message) # Store message in DB.
-    
-    # Emit the message to all users in the classroom, formatting timestamp to ISO string.
-    emit('message', {
-        "id": chat_message_id,
-        "user_id": user_id,
-        "username": username,
-        "role": role,
-        "message": message_text,
-        "timestamp": current_timestamp.isoformat()
-    }, room=classroom_id)
-    
+    if data.get('type') == 'file' and data.get('fileUrl'):
+        chat_message['type'] = 'file'
+        chat_message['fileUrl'] = data['fileUrl']
+
+    # Emit the message to all users in the classroom first, formatting '_id' and timestamp as strings.
+    emit('message', serialize_chat_message(dict(chat_message)), room=classroom_id)
+
+    # Store the message in DB with the next write-behind batch.
+    if chat_write_behind.put(chat_message):
+        pending_chat_messages[str(chat_message['_id'])] = chat_message
+        recent_chat_cache.push(classroom_id, serialize_chat_message(dict(chat_message)))
+
     print(f"Chat message from '{username}' ({user_id}) in classroom {classroom_id}: '{message_text}'.")
 
 # New: Handle message editing
@@ -1638,13 +5158,17 @@ def handle_edit_message(data):
         print("Edit message failed: Missing data.")
         return
 
-    # Assuming you have a chat_messages_collection
     try:
-        from bson.objectid import ObjectId
+        # A message still in the write-behind buffer is edited there; the stored copy is updated as well
+        # in case its batch is being written right now.
+        pending_message = pending_chat_messages.get(message_id)
+        if pending_message:
+            pending_message['message'] = new_text
         chat_messages_collection.update_one(
             {'_id': ObjectId(message_id)},
             {'$set': {'message': new_text}}
         )
+        recent_chat_cache.edit(classroom_id, message_id, new_text)
         # Emit the update to all clients in the room
         emit('message_edited', {'messageId': message_id, 'newText': new_text}, room=classroom_id)
     except Exception as e:
@@ -1661,8 +5185,12 @@ def handle_delete_message(data):
         return
 
     try:
-        from bson.objectid import ObjectId
+        # A message still in the write-behind buffer is flagged so it is never stored.
+        pending_message = pending_chat_messages.get(message_id)
+        if pending_message:
+            pending_message['deleted'] = True
         chat_messages_collection.delete_one({'_id': ObjectId(message_id)})
+        recent_chat_cache.invalidate(classroom_id)
         # Emit the deletion event to all clients in the room
         emit('message_deleted', {'messageId': message_id}, room=classroom_id)
     except Exception as e:
@@ -1671,24 +5199,46 @@ def handle_delete_message(data):
 # New: Handle whiteboard snapshots
 @socketio.on('whiteboard_snapshot')
 def handle_whiteboard_snapshot(data):
-    classroom_id = data.get('classroom_id')
-    user_id = data.get('user_id')
-    username = data.get('username')
+    """
+    Handles a shared whiteboard snapshot.
+    The image is moved into the snapshot blob store; the chat message stored and broadcast
+    to the classroom only carries the image and thumbnail URLs.
+    """
+    classroom_id = data.get('classroomId') or data.get('classroom_id')
+    user_id = session.get('user_id') or data.get('user_id')
+    username = session.get('username') or data.get('username')
     image_data = data.get('imageData')
 
     if not all([classroom_id, user_id, username, image_data]):
         print("Whiteboard snapshot failed: Missing data.")
         return
 
+    # Verify user is a participant before storing anything.
+    if not is_classroom_member(classroom_id, user_id):
+        print(f"User '{username}' ({user_id}) attempted to share a whiteboard snapshot in classroom {classroom_id} without access.")
+        return
+
+    try:
+        blob = store_snapshot_blob(image_data)
+    except ValueError as e:
+        snapshot_blob_stats["rejected"] += 1
+        print(f"Whiteboard snapshot from '{username}' ({user_id}) in classroom {classroom_id} rejected: {e}")
+        return
+
     # Save the snapshot as a message in the database
     new_message = {
-        'classroom_id': classroom_id,
+        'id': str(uuid.uuid4()),
+        'classroomId': classroom_id,
         'user_id': user_id,
         'username': username,
         'message': 'Whiteboard Snapshot',
         'timestamp': datetime.utcnow(),
         'type': 'whiteboard_snapshot',
-        'imageData': image_data
+        'blobId': blob['blobId'],
+        'imageUrl': blob['imageUrl'],
+        'thumbnailUrl': blob['thumbnailUrl'],
+        'width': blob['width'],
+        'height': blob['height']
     }
     result = chat_messages_collection.insert_one(new_message)
     message_id = str(result.inserted_id)
@@ -1696,9 +5246,10 @@ def handle_whiteboard_snapshot(data):
     # Emit the new message to all clients in the room
     new_message['_id'] = message_id
     new_message['timestamp'] = new_message['timestamp'].isoformat()
+    recent_chat_cache.push(classroom_id, new_message)
     emit('message', new_message, room=classroom_id)
 
-    print(f"Whiteboard snapshot shared by {username} in classroom {classroom_id}.")
+    print(f"Whiteboard snapshot {blob['blobId']} ({blob['size']} bytes) shared by {username} in classroom {classroom_id}.")
 
 # --- Whiteboard Socket.IO Event Handlers ---
 @socketio.on('draw')
@@ -1709,7 +5260,7 @@ def handle_draw(data):
     """
     classroomId = data.get('classroomId')
     if classroomId:
-        emit('draw', data, room=classroomId, include_self=False)
+        whiteboard_broadcaster.publish(classroomId, 'draw', data, skip_sid=request.sid)
         print(f"Whiteboard draw data received and broadcasted to room {classroomId}")
     else:
         print("Warning: Received draw event without a classroomId.")
@@ -1719,10 +5270,13 @@ def handle_whiteboard_clear(data):
     """
     Handles whiteboard clear events.
     Broadcasts the clear event to all participants in the same classroom.
+    This event is not persisted, so the cached pages are dropped and reloaded from the database.
     """
     classroomId = data.get('classroomId')
     if classroomId:
-        emit('whiteboard_clear', data, room=classroomId, include_self=False)
+        whiteboard_page_cache.invalidate_classroom(classroomId)
+        whiteboard_render_cache.invalidate_classroom(classroomId)
+        whiteboard_broadcaster.publish(classroomId, 'whiteboard_clear', data, skip_sid=request.sid)
         print(f"Whiteboard clear event broadcasted to room {classroomId}")
     else:
         print("Warning: Received whiteboard_clear event without a classroomId.")
@@ -1730,21 +5284,105 @@ def handle_whiteboard_clear(data):
 @socketio.on('whiteboard_undo_redo')
 def handle_undo_redo(data):
     """
-    Handles whiteboard undo/redo events.
-    Broadcasts the new page state to all participants in the same classroom.
+    Handles whiteboard undo/redo ops.
+    Expects {classroomId, pageIndex, op: 'undo' | 'redo', actionId} where actionId identifies the
+    drawing command being undone or restored. The op is broadcast by id and persisted as a tombstone,
+    so history reconstruction reflects it; the page contents themselves are never sent.
     """
-    classroomId = data.get('classroomId')
-    if classroomId:
-        emit('whiteboard_undo_redo', data, room=classroomId, include_self=False)
-        print(f"Whiteboard undo/redo event broadcasted to room {classroomId}")
-    else:
-        print("Warning: Received whiteboard_undo_redo event without a classroomId.")
+    user_id = session.get('user_id')
+    username = session.get('username')
+    classroom_id = data.get('classroomId')
+    op = data.get('op')
+    target_id = data.get('actionId')
+    page_index = data.get('pageIndex', 0)
+
+    # Validate required fields.
+    if not all([user_id, classroom_id]) or op not in WHITEBOARD_UNDO_OPS or not is_valid_whiteboard_action_id(target_id):
+        print(f"Socket.IO 'whiteboard_undo_redo' failed: Invalid op for user_id={user_id}, classroom_id={classroom_id}, op={op}, actionId={target_id}.")
+        return
+    if not is_valid_whiteboard_page_index(page_index):
+        print(f"Socket.IO 'whiteboard_undo_redo' failed: Invalid pageIndex {page_index!r} from user {user_id}.")
+        return
+
+    # Verify user is a participant of the classroom.
+    if not is_classroom_member(classroom_id, user_id):
+        print(f"User '{username}' ({user_id}) attempted whiteboard {op} in classroom {classroom_id} without access.")
+        return
+
+    # Only admins can undo/redo, like drawing itself.
+    user_role = session.get('role')
+    if user_role != 'admin':
+        print(f"User '{username}' ({user_id}) (role: {user_role}) attempted whiteboard {op} but is not an admin.")
+        return
+
+    broadcast_data = None
+    if op == 'redo':
+        # Clients that loaded the page while the command was undone never received it, so the
+        # broadcast (not the stored op) carries the restored command. Loading fills the page cache.
+        if classroom_id not in whiteboard_page_cache.classrooms:
+            get_whiteboard_pages(classroom_id)
+        item = whiteboard_page_cache.find_item(classroom_id, page_index, target_id)
+        if item:
+            broadcast_data = {"targetId": target_id, "item": item}
+
+    publish_whiteboard_action(classroom_id, page_index, op, {"targetId": target_id}, user_id, username,
+                              broadcast_data=broadcast_data)
+    print(f"Whiteboard {op} of action {target_id} by '{username}' ({user_id}) in classroom {classroom_id}, page {page_index}.")
+
+def publish_whiteboard_action(classroom_id, page_index, action, drawing_data, user_id, username, action_id=None, broadcast_data=None):
+    """
+    Broadcasts an accepted whiteboard action to the classroom, applies it to the page cache
+    and queues it for persistence.
+
+    Args:
+        classroom_id (str): The classroom the action belongs to.
+        page_index (int): The whiteboard page index.
+        action (str): The action type ('draw', 'clear', 'undo', 'redo', ...).
+        drawing_data (dict): The drawing command, or {"targetId": ...} for undo/redo ops.
+        user_id (str): The acting user's ID.
+        username (str): The acting user's name.
+        action_id (str, optional): ID of the action document; a new one is generated if omitted.
+        broadcast_data (dict, optional): Payload sent to the room instead of `drawing_data`.
+    """
+    current_timestamp = datetime.utcnow()
+    seq = allocate_whiteboard_seq(classroom_id) # Per-classroom sequence number used for delta sync.
+
+    # Broadcast the whiteboard data to all users in the classroom (including sender for immediate feedback).
+    # Broadcasting happens before persistence so database latency never delays the room.
+    whiteboard_broadcaster.publish(classroom_id, 'whiteboard_data', {
+        'action': action,
+        'data': broadcast_data or drawing_data,
+        'pageIndex': page_index,
+        'userId': user_id,
+        'username': username,
+        'timestamp': current_timestamp.isoformat(),
+        'seq': seq
+    }) # No skip_sid: the sender receives its own action too, for real-time local feedback.
+
+    # Keep this worker's cached copy of the page current; its renders are outdated now.
+    whiteboard_page_cache.apply_action(classroom_id, page_index, action, drawing_data, seq)
+    whiteboard_render_cache.invalidate_page(classroom_id, page_index)
+
+    # Queue the whiteboard action for batched (write-behind) persistence.
+    whiteboard_write_behind.put({
+        "id": action_id or str(uuid.uuid4()), # Unique ID for each whiteboard action document
+        "classroomId": classroom_id,
+        "action": action,
+        "data": drawing_data, # This contains the actual pen strokes, shape data, etc.
+        "pageIndex": page_index,
+        "userId": user_id,
+        "username": username,
+        "timestamp": current_timestamp,
+        "seq": seq
+    })
+
 @socketio.on('whiteboard_data')
 def handle_whiteboard_data(data):
     """
     **UPDATED**: Handles incoming whiteboard drawing data from clients.
-    Stores the drawing command in the database and broadcasts it to all participants in the classroom.
-    Includes page indexing.
+    Broadcasts the drawing command to all participants in the classroom, then queues it
+    for batched persistence through `whiteboard_write_behind`.
+    Includes page indexing. Drawing commands carry an 'actionId' that undo/redo ops refer to.
     """
     user_id = session.get('user_id')
     username = session.get('username')
@@ -1758,15 +5396,23 @@ def handle_whiteboard_data(data):
         print(f"Socket.IO 'whiteboard_data' failed: Missing required fields for user_id={user_id}, classroom_id={classroom_id}, action={action}.")
         return
     
+    # The page index keys the page cache and stored actions, so it must be a bounded, non-negative int.
+    if not is_valid_whiteboard_page_index(page_index):
+        print(f"Socket.IO 'whiteboard_data' failed: Invalid pageIndex {page_index!r} from user {user_id}.")
+        return
+
     # Ensure drawing_data is present for 'draw' action.
     if action == 'draw' and not drawing_data:
         print(f"Socket.IO 'whiteboard_data' failed: Missing 'data' for 'draw' action by user {user_id} in classroom {classroom_id}.")
         return
 
+    # Undo/redo ops are validated by their own event.
+    if action in WHITEBOARD_UNDO_OPS:
+        print(f"Socket.IO 'whiteboard_data' failed: '{action}' must be sent as 'whiteboard_undo_redo' (user {user_id}, classroom {classroom_id}).")
+        return
 
     # Verify user is a participant of the classroom.
-    classroom = classrooms_collection.find_one({"id": classroom_id, "participants": user_id})
-    if not classroom:
+    if not is_classroom_member(classroom_id, user_id):
         print(f"User '{username}' ({user_id}) attempted to send whiteboard data to classroom {classroom_id} without access.")
         return
     
@@ -1776,32 +5422,16 @@ def handle_whiteboard_data(data):
         print(f"User '{username}' ({user_id}) (role: {user_role}) attempted whiteboard {action} but is not an admin.")
         return # Silently ignore non-admin drawing attempts.
 
-    current_timestamp = datetime.utcnow()
-
-    # Store whiteboard data in the database.
-    whiteboard_doc = {
-        "id": str(uuid.uuid4()), # Unique ID for each whiteboard action document
-        "classroomId": classroom_id,
-        "action": action,
-        "data": drawing_data, # This contains the actual pen strokes, shape data, etc.
-        "pageIndex": page_index,
-        "userId": user_id,
-        "username": username,
-        "timestamp": current_timestamp
-    }
-    
-    whiteboard_collection.insert_one(whiteboard_doc)
+    action_id = None
+    if action == 'draw' and isinstance(drawing_data, dict):
+        # Drawing commands are identified by the client's action id so undo/redo can reference them.
+        # Clients that do not send one (or send something that is not a UUID) get one assigned here.
+        action_id = drawing_data.get('actionId')
+        if not is_valid_whiteboard_action_id(action_id):
+            action_id = str(uuid.uuid4())
+            drawing_data = dict(drawing_data, actionId=action_id)
 
-    # Broadcast the whiteboard data to all users in the classroom (including sender for immediate feedback).
-    emit('whiteboard_data', {
-        'action': action,
-        'data': drawing_data,
-        'pageIndex': page_index,
-        'userId': user_id,
-        'username': username,
-        'timestamp': current_timestamp.isoformat()
-    }, room=classroom_id, include_self=True) # include_self=True for real-time local feedback.
-    
+    publish_whiteboard_action(classroom_id, page_index, action, drawing_data, user_id, username, action_id)
     print(f"Whiteboard '{action}' from '{username}' ({user_id}) in classroom {classroom_id}, page {page_index}.")
 
 
@@ -1828,8 +5458,7 @@ def handle_whiteboard_page_change(data):
         return
 
     # Verify user is a participant.
-    classroom = classrooms_collection.find_one({"id": classroom_id, "participants": user_id})
-    if not classroom:
+    if not is_classroom_member(classroom_id, user_id):
         print(f"User '{username}' ({user_id}) attempted to change page in classroom {classroom_id} without access.")
         return
 
@@ -1840,35 +5469,18 @@ def handle_whiteboard_page_change(data):
         return # Silently ignore non-admin page change attempts.
 
     # Broadcast page change to all users in the classroom (excluding sender, as sender already updated UI locally).
-    emit('whiteboard_page_change', {
+    whiteboard_broadcaster.publish(classroom_id, 'whiteboard_page_change', {
         'newPageIndex': new_page_index,
         'action': client_action,
         'userId': user_id,
         'username': username
-    }, room=classroom_id, include_self=False)
+    }, skip_sid=request.sid)
     
     print(f"Whiteboard page change to index {new_page_index} by '{username}' in classroom {classroom_id}. Client action: {client_action}.")
 
 
         
 # New SocketIO events for WebRTC signaling
-@socketio.on('connect')
-def handle_connect():
-    user_id = session.get('user_id')
-    if user_id:
-        user_to_socket_map[user_id] = request.sid
-        print(f"User {user_id} connected with SID: {request.sid}")
-    else:
-        print("Unauthenticated user connected.")
-
-@socketio.on('disconnect')
-def handle_disconnect():
-    user_id = session.get('user_id')
-    if user_id in user_to_socket_map and user_to_socket_map[user_id] == request.sid:
-        del user_to_socket_map[user_id]
-        print(f"User {user_id} disconnected.")
-    print("A client disconnected.")
-
 @socketio.on('join_classroom')
 def handle_join_classroom(data):
     classroom_id = data.get('classroomId')
@@ -1877,6 +5489,8 @@ def handle_join_classroom(data):
         return
     
     join_room(classroom_id)
+    join_room(whiteboard_legacy_room(classroom_id)) # This path predates batched whiteboard frames.
+    presence_registry.join(request.sid, user_id, classroom_id)
     print(f"User {user_id} joined classroom {classroom_id}")
     
     # Notify others in the room that a new user has joined
@@ -1885,7 +5499,9 @@ def handle_join_classroom(data):
 @socketio.on('webrtc_offer')
 def handle_webrtc_offer(data):
     recipient_id = data.get('recipient_id')
-    if recipient_id and recipient_id in user_to_socket_map:
+    # The recipient's latest socket, wherever it is connected.
+    recipient_sid = presence_registry.get_sid(recipient_id) if recipient_id else None
+    if recipient_sid:
         # Get the sender's details
         sender_id = session.get('user_id')
         offer_data = {
@@ -1893,31 +5509,35 @@ def handle_webrtc_offer(data):
             'offer': data.get('offer')
         }
         # Emit the offer directly to the recipient's socket
-        emit('webrtc_offer', offer_data, room=user_to_socket_map[recipient_id])
+        emit('webrtc_offer', offer_data, room=recipient_sid)
         print(f"Relayed WebRTC offer from {sender_id} to {recipient_id}")
 
 @socketio.on('webrtc_answer')
 def handle_webrtc_answer(data):
     recipient_id = data.get('recipient_id')
-    if recipient_id and recipient_id in user_to_socket_map:
+    # The recipient's latest socket, wherever it is connected.
+    recipient_sid = presence_registry.get_sid(recipient_id) if recipient_id else None
+    if recipient_sid:
         sender_id = session.get('user_id')
         answer_data = {
             'senderId': sender_id,
             'answer': data.get('answer')
         }
-        emit('webrtc_answer', answer_data, room=user_to_socket_map[recipient_id])
+        emit('webrtc_answer', answer_data, room=recipient_sid)
         print(f"Relayed WebRTC answer from {sender_id} to {recipient_id}")
 
 @socketio.on('webrtc_ice_candidate')
 def handle_webrtc_ice_candidate(data):
     recipient_id = data.get('recipient_id')
-    if recipient_id and recipient_id in user_to_socket_map:
+    # The recipient's latest socket, wherever it is connected.
+    recipient_sid = presence_registry.get_sid(recipient_id) if recipient_id else None
+    if recipient_sid:
         sender_id = session.get('user_id')
         candidate_data = {
             'senderId': sender_id,
             'candidate': data.get('candidate')
         }
-        emit('webrtc_ice_candidate', candidate_data, room=user_to_socket_map[recipient_id])
+        emit('webrtc_ice_candidate', candidate_data, room=recipient_sid)
         print(f"Relayed WebRTC ICE candidate from {sender_id} to {recipient_id}")
 
 @socketio.on('broadcast_status_update')
@@ -1957,6 +5577,195 @@ def handle_broadcast_status_update(data):
     print(f"Broadcast status update from Admin '{admin_username}' ({user_id}) in classroom {classroom_id}: '{message}'.")
 
 
+# --- CLI Commands ---
+# Maintenance commands, run with `flask --app server <command>`.
+
+@app.cli.command('encode-whiteboard-strokes')
+@click.option('--classroom', 'classroom_id', default=None, help='Only migrate this classroom.')
+@click.option('--batch-size', default=500, show_default=True, help='Documents per bulk write.')
+def encode_whiteboard_strokes_command(classroom_id, batch_size):
+    """
+    Migrates stored whiteboard strokes (actions and page checkpoints) to the compact stroke codec.
+    Safe to run repeatedly: already-encoded strokes are skipped.
+    """
+    query = {"action": "draw", "data.pointsCodec": {"$exists": False}, "data.points": {"$type": "array"}}
+    if classroom_id:
+        query["classroomId"] = classroom_id
+
+    operations = []
+    migrated = 0
+    skipped = 0
+    for whiteboard_doc in whiteboard_collection.find(query, {"_id": 1, "data": 1}):
+        encoded = encode_whiteboard_item(whiteboard_doc['data'])
+        if encoded is whiteboard_doc['data']:
+            skipped += 1 # Points with an unexpected shape are kept as they are.
+            continue
+        operations.append(UpdateOne({"_id": whiteboard_doc['_id']}, {"$set": {"data": encoded}}))
+        if len(operations) >= batch_size:
+            whiteboard_collection.bulk_write(operations, ordered=False)
+            migrated += len(operations)
+            operations = []
+    if operations:
+        whiteboard_collection.bulk_write(operations, ordered=False)
+        migrated += len(operations)
+
+    checkpoint_query = {"classroomId": classroom_id} if classroom_id else {}
+    checkpoints_migrated = 0
+    for checkpoint in whiteboard_checkpoints_collection.find(checkpoint_query, {"_id": 1, "items": 1, "through": 1, "through_seq": 1}):
+        items = [encode_whiteboard_item(item) for item in checkpoint.get('items', [])]
+        # Only rewrite the checkpoint if compaction has not advanced it in the meantime.
+        result = whiteboard_checkpoints_collection.update_one(
+            {"_id": checkpoint['_id'], "through": checkpoint.get('through'), "through_seq": checkpoint.get('through_seq')},
+            {"$set": {"items": items}}
+        )
+        checkpoints_migrated += result.modified_count
+
+    click.echo(f"Encoded {migrated} whiteboard strokes ({skipped} left as-is) and {checkpoints_migrated} page checkpoints.")
+
+@app.cli.command('whiteboard-codec-benchmark')
+@click.option('--classroom', 'classroom_id', default=None, help='Sample strokes from this classroom only.')
+@click.option('--samples', default=1000, show_default=True, help='Number of strokes to measure.')
+def whiteboard_codec_benchmark_command(classroom_id, samples):
+    """
+    Reports bytes per stroke (BSON storage and JSON wire size) before and after the compact codec.
+    Uses stored strokes when available, synthetic freehand strokes otherwise.
+    """
+    query = {"action": "draw", "data.points": {"$exists": True}}
+    if classroom_id:
+        query["classroomId"] = classroom_id
+    strokes = [decode_whiteboard_item(doc['data']) for doc in whiteboard_collection.find(query, {"_id": 0, "data": 1}).limit(samples)]
+    strokes = [stroke for stroke in strokes if isinstance(stroke, dict) and isinstance(stroke.get('points'), list)]
+    source = "stored"
+
+    if not strokes:
+        source = "synthetic"
+        for _ in range(samples):
+            x, y = random.random(), random.random()
+            points = []
+            for _ in range(random.randint(20, 200)):
+                x = min(max(x + random.uniform(-0.004, 0.004), 0.0), 1.0)
+                y = min(max(y + random.uniform(-0.004, 0.004), 0.0), 1.0)
+                points.append({"x": x, "y": y, "width": 5})
+            strokes.append({"type": "pen", "points": points, "color": "#FFFFFF", "size": 5})
+
+    encoded = [encode_whiteboard_item(stroke) for stroke in strokes]
+    raw_storage = sum(len(bson.encode({"data": stroke})) for stroke in strokes)
+    encoded_storage = sum(len(bson.encode({"data": item})) for item in encoded)
+    raw_wire = sum(len(json.dumps(stroke)) for stroke in strokes)
+    encoded_wire = sum(len(json.dumps(decode_whiteboard_item(item))) for item in encoded)
+    count = len(strokes)
+
+    click.echo(f"Measured {count} {source} strokes ({sum(len(s['points']) for s in strokes)} points).")
+    click.echo(f"Storage (BSON): {raw_storage / count:.1f} -> {encoded_storage / count:.1f} bytes/stroke ({raw_storage / max(encoded_storage, 1):.1f}x smaller).")
+    click.echo(f"Wire (JSON):    {raw_wire / count:.1f} -> {encoded_wire / count:.1f} bytes/stroke ({raw_wire / max(encoded_wire, 1):.1f}x smaller).")
+
+
+@app.cli.command('assessment-list-benchmark')
+@click.option('--assessments', 'assessment_count', default=200, show_default=True, help='Assessments in the synthetic classroom.')
+@click.option('--rounds', default=20, show_default=True, help='Timed repetitions of each strategy.')
+def assessment_list_benchmark_command(assessment_count, rounds):
+    """
+    Regression benchmark for the has_submitted check of the assessment list: compares one find_one per
+    assessment with the single $in query of submitted_assessment_ids(). Runs against a scratch
+    database that is dropped afterwards, and fails if the list needs more than one submissions query.
+    """
+    scratch_name = f"{mongo.db.name}_assessment_benchmark"
+    scratch_db = mongo.cx[scratch_name]
+    submissions = scratch_db.assessment_submissions
+    for keys, options in REQUIRED_INDEXES["assessment_submissions"]:
+        submissions.create_index(keys, **options)
+
+    try:
+        student_id = str(uuid.uuid4())
+        assessment_ids = [str(uuid.uuid4()) for _ in range(assessment_count)]
+        # The student submitted every other assessment; other students submitted all of them.
+        docs = [{"id": str(uuid.uuid4()), "assessmentId": assessment_id, "student_id": other_id}
+                for assessment_id in assessment_ids for other_id in [str(uuid.uuid4()) for _ in range(5)]]
+        docs += [{"id": str(uuid.uuid4()), "assessmentId": assessment_id, "student_id": student_id}
+                 for assessment_id in assessment_ids[::2]]
+        submissions.insert_many(docs)
+
+        def per_assessment(collection):
+            return {assessment_id for assessment_id in assessment_ids
+                    if collection.find_one({"assessmentId": assessment_id, "student_id": student_id})}
+
+        def batched(collection):
+            return submitted_assessment_ids(student_id, assessment_ids, collection)
+
+        results = {}
+        for name, strategy in (("per-assessment find_one", per_assessment), ("single $in query", batched)):
+            counting = QueryCountingCollection(submissions)
+            submitted = strategy(counting)
+            queries = counting.queries
+            started = time.perf_counter()
+            for _ in range(rounds):
+                strategy(submissions)
+            elapsed_ms = (time.perf_counter() - started) * 1000 / rounds
+            results[name] = (submitted, queries, elapsed_ms)
+            click.echo(f"{name}: {queries} queries, {elapsed_ms:.2f} ms per list of {assessment_count} assessments.")
+
+        (old_submitted, old_queries, old_ms), (new_submitted, new_queries, new_ms) = results.values()
+        if old_submitted != new_submitted:
+            raise click.ClickException("The strategies disagree on which assessments were submitted.")
+        if new_queries > 1:
+            raise click.ClickException(f"Regression: has_submitted took {new_queries} queries instead of 1.")
+        click.echo(f"Submissions queries per list: {old_queries} -> {new_queries} (plus 1 for the assessments); {old_ms / max(new_ms, 0.001):.1f}x faster.")
+    finally:
+        mongo.cx.drop_database(scratch_name)
+
+
+@app.cli.command('migrate-snapshot-blobs')
+@click.option('--batch-size', default=100, show_default=True, help='Messages per bulk write.')
+def migrate_snapshot_blobs_command(batch_size):
+    """
+    Moves whiteboard snapshot images embedded in chat messages ('imageData') into the snapshot
+    blob store, leaving only the image and thumbnail URLs in the messages.
+    Safe to run repeatedly: migrated messages no longer match.
+    """
+    query = {"type": "whiteboard_snapshot", "imageData": {"$exists": True}}
+    operations = []
+    migrated = 0
+    failed = 0
+    deduplicated_before = snapshot_blob_stats['deduplicated']
+    for chat_message in chat_messages_collection.find(query, {"_id": 1, "imageData": 1, "classroom_id": 1, "classroomId": 1}):
+        try:
+            blob = store_snapshot_blob(chat_message['imageData'])
+        except ValueError as e:
+            failed += 1
+            click.echo(f"Skipping snapshot message {chat_message['_id']}: {e}")
+            continue
+        fields = {key: blob[key] for key in ('blobId', 'imageUrl', 'thumbnailUrl', 'width', 'height')}
+        # Older snapshots were stored under 'classroom_id', which chat history queries never matched.
+        fields['classroomId'] = chat_message.get('classroomId') or chat_message.get('classroom_id')
+        operations.append(UpdateOne({"_id": chat_message['_id']}, {"$set": fields, "$unset": {"imageData": ""}}))
+        if len(operations) >= batch_size:
+            chat_messages_collection.bulk_write(operations, ordered=False)
+            migrated += len(operations)
+            operations = []
+    if operations:
+        chat_messages_collection.bulk_write(operations, ordered=False)
+        migrated += len(operations)
+
+    click.echo(f"Moved {migrated} whiteboard snapshots into the blob store ({failed} could not be decoded). "
+               f"{snapshot_blob_stats['deduplicated'] - deduplicated_before} were duplicates of stored images.")
+
+@app.cli.command('ensure-indexes')
+@click.option('--explain', 'run_explain', is_flag=True, help='Afterwards, report diagnostic queries that still scan a whole collection.')
+def ensure_indexes_command(run_explain):
+    """Creates every index in REQUIRED_INDEXES (idempotent)."""
+    ensured_index_collections.clear()
+    failures = ensure_all_indexes()
+    for name in REQUIRED_INDEXES:
+        status = "ok" if not failures[name] else f"{len(failures[name])} failed"
+        click.echo(f"{name}: {len(REQUIRED_INDEXES[name])} indexes, {status}")
+        for index_name, error in failures[name]:
+            click.echo(f"  {index_name}: {error}")
+    if run_explain:
+        scans = diagnose_index_usage()
+        click.echo(f"{len(scans)} of {len(INDEX_DIAGNOSTIC_QUERIES)} diagnostic queries scan a whole collection.")
+        for scan in scans:
+            click.echo(f"  {scan['collection']}: filter={scan['filter']} sort={scan['sort']}")
+
 if __name__ == '__main__':
     print("Starting OneClass server...")
     socketio.run(app, debug=True, port=int(os.environ.get('PORT', 5000)), host='0.0.0.0')